@@ -1,14 +1,23 @@
-from flask import Flask, render_template, request, flash, redirect, url_for
-import os
-import re
+from flask import (
+    Flask, Response, render_template, request, flash, redirect, url_for,
+    send_file, abort, jsonify, g, make_response
+)
+import functools
+import json
+import logging
 import io
-import base64
-from pathlib import Path
-from PIL import Image, ImageDraw, ImageFont
+import os
+import threading
 
-from tempfile import NamedTemporaryFile
-import difflib
-from utils.image_processor import process_images
+# 这里只导入轻量的模块；图片处理（Pillow、NumPy）、Icon 工具和文件对比在各自的路由中导入，
+# 只用到其中一种工具的进程不必加载其它工具，启动更快、占用内存更少（见 benchmarks/import_report.py）
+from utils.result_store import ResultStore
+from utils.cache import ResultCache, make_cache_key
+from utils.worker_pool import WorkerPool, PoolBusyError, JobTimeoutError
+from utils.jobs import JobManager
+from utils.uploads import SpooledRequest, MemoryBudget, UploadBudgetError, detach_stream, stream_size, upload_buffers
+from utils.warmup import warm_up
+from utils import metrics
 from config import Config
 
 app = Flask(__name__)
@@ -16,22 +25,185 @@ app = Flask(__name__)
 # Apply configurations from Config class
 app.config.from_object(Config)
 
+# 上传的文件超过 UPLOAD_SPOOL_THRESHOLD 时转存到磁盘，处理时用 upload_buffer 映射而不是读成 bytes
+app.request_class = SpooledRequest
+
+# 各路由正在处理的上传数据占用的内存预算，超出时返回 503（见 _upload_budget）
+upload_budgets = {name: MemoryBudget(max_bytes) for name, max_bytes in app.config['UPLOAD_MEMORY_BUDGETS'].items()}
+
+# 处理结果按内容哈希保存，页面里只放下载地址
+result_store = ResultStore(app.config['RESULT_STORE_MAX_BYTES'])
+
+# Icon 制作的上传会话，原图只上传和解码一次（第一次使用时创建，见 _icon_sessions）
+icon_sessions = None
+_icon_sessions_lock = threading.Lock()
+
+# 文件对比结果（hunk 索引），页面滚动时按需取出表格行（第一次使用时创建，见 _diff_store）
+diff_store = None
+_diff_store_lock = threading.Lock()
+
+# 多图拼接去重用的感知哈希索引（第一次使用时打开，见 _dedup_index）
+dedup_index = None
+_dedup_index_lock = threading.Lock()
+
+# 相同输入 + 相同参数的处理结果缓存
+result_cache = ResultCache(
+    app.config['CACHE_MAX_BYTES'],
+    disk_dir=app.config['CACHE_DIR'],
+    disk_max_bytes=app.config['CACHE_DISK_MAX_BYTES']
+)
+
+# 图片处理放到进程池中执行，队列满时返回 503
+worker_pool = WorkerPool(
+    app.config['WORKER_PROCESSES'],
+    app.config['WORKER_QUEUE_SIZE'],
+    app.config['JOB_TIMEOUT'],
+    initializer=warm_up
+)
+
+# 多图拼接的后台任务
+job_manager = JobManager(
+    app.config['ASYNC_JOB_THREADS'],
+    app.config['ASYNC_JOB_MAX_PENDING'],
+    app.config['ASYNC_JOB_TTL'],
+    use_processes=app.config['WORKER_PROCESSES'] > 0
+)
+
+def _encoder(name):
+    return app.config['ENCODER_PROFILES'][name]
+
+def _icon_sessions():
+    global icon_sessions
+    with _icon_sessions_lock:
+        if icon_sessions is None:
+            from utils.icon_sessions import IconSessionStore
+            icon_sessions = IconSessionStore(app.config['ICON_SESSION_MAX_BYTES'])
+        return icon_sessions
+
+# 按比例采样请求，记录各处理阶段的耗时
+metrics.configure(app.config['METRICS_SAMPLE_RATE'])
+logger = logging.getLogger(__name__)
+
+def _diff_store():
+    global diff_store
+    with _diff_store_lock:
+        if diff_store is None:
+            from utils.diff_store import DiffStore
+            diff_store = DiffStore(app.config['DIFF_STORE_MAX_BYTES'])
+        return diff_store
+
+def _dedup_index():
+    global dedup_index
+    with _dedup_index_lock:
+        if dedup_index is None:
+            from utils.dedup import HashIndex
+            path = app.config['DEDUP_INDEX_PATH'] or os.path.join(app.instance_path, 'dedup_index.sqlite3')
+            dedup_index = HashIndex(path, app.config['DEDUP_INDEX_MAX_ENTRIES'])
+        return dedup_index
+
+@app.before_request
+def start_metrics():
+    g.metrics_token = metrics.start()
+
+@app.teardown_request
+def stop_metrics(exc):
+    token = g.pop('metrics_token', None)
+    if token is not None:
+        metrics.stop(token)
+
+@app.errorhandler(PoolBusyError)
+def handle_pool_busy(e):
+    return '服务器繁忙，请稍后重试', 503, {'Retry-After': str(app.config['WORKER_RETRY_AFTER'])}
+
+@app.errorhandler(UploadBudgetError)
+def handle_upload_budget(e):
+    return '服务器正在处理较多的上传文件，请稍后重试', 503, {'Retry-After': str(app.config['WORKER_RETRY_AFTER'])}
+
+def _with_budget(name, nbytes, view, *args, **kwargs):
+    """预留 name 路由 nbytes 字节的内存预算后调用 view；预留不到时抛出 UploadBudgetError
+
+    普通响应返回时归还；流式响应（逐个生成的 ZIP、NDJSON 等）在生成过程中还在处理数据，发送完关闭时才归还。
+    """
+    budget = upload_budgets[name]
+    nbytes = budget.acquire(nbytes)
+    try:
+        response = make_response(view(*args, **kwargs))
+    except BaseException:
+        budget.release(nbytes)
+        raise
+    if response.is_streamed:
+        response.call_on_close(functools.partial(budget.release, nbytes))
+    else:
+        budget.release(nbytes)
+    return response
+
+def _upload_budget(name):
+    """按请求的大小预留 name 路由的内存预算（见 _with_budget）"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            return _with_budget(name, request.content_length or 0, view, *args, **kwargs)
+        return wrapper
+    return decorator
+
+@app.errorhandler(JobTimeoutError)
+def handle_job_timeout(e):
+    return '处理超时，请减少图片数量或尺寸后重试', 504
+
+@app.route('/result/<result_id>')
+def get_result(result_id):
+    """下载处理结果，支持 ETag 和 Range 请求"""
+    item = result_store.get(result_id)
+    if item is None:
+        abort(404)
+    data, mimetype = item
+    return send_file(
+        io.BytesIO(data),
+        mimetype=mimetype,
+        download_name=request.args.get('name'),
+        as_attachment='name' in request.args,
+        etag=result_id,
+        conditional=True,
+        max_age=app.config['RESULT_MAX_AGE']
+    )
+
+@app.route('/cache_stats')
+def cache_stats():
+    """结果缓存的命中/未命中统计"""
+    return jsonify(result_cache.stats())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 文本格式的指标：各阶段耗时、像素和字节数、缓存命中和进程池负载"""
+    lines = [metrics.REGISTRY.render()]
+    for name, value in result_cache.stats().items():
+        if isinstance(value, (int, float)):
+            lines.append(f'# TYPE flask_utils_cache_{name} gauge\nflask_utils_cache_{name} {value:g}\n')
+    lines.append(f'# TYPE flask_utils_worker_in_flight gauge\nflask_utils_worker_in_flight {worker_pool.in_flight()}\n')
+    return ''.join(lines), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 @app.route('/')
 def index():
     return render_template('merge.html')
 
 @app.route('/merge', methods=['POST'])
+@_upload_budget('merge')
 def merge_images():
+    from utils.encoders import mimetype_for, extension_for
+    from utils.merge_engine import process_images, BEFORE_AFTER_LABELS
+    from utils.validation import ValidationError, check_images
+    
     files = request.files.getlist('image1')
     if len(files) != 2:
         flash('请选择两张图片', 'error')
         return render_template('merge.html')
     
-    # Check file types
-    for file in files:
-        if not file.filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp')):
-            flash('只支持图片文件 (PNG, JPG, JPEG, GIF, WEBP)', 'error')
-            return render_template('merge.html')
+    # Check file types and sizes from the headers before decoding anything
+    try:
+        check_images(files, app.config['PIXEL_BUDGETS']['merge'])
+    except ValidationError as e:
+        flash(str(e), 'error')
+        return render_template('merge.html')
     
     file1 = files[0]
     file2 = files[1]
@@ -40,52 +212,63 @@ def merge_images():
     files = [(file1.filename, file1), (file2.filename, file2)]
     files.sort(key=lambda x: x[0])
     
-    # Open images
+    # Visual diff mode: highlight the changed pixels instead of merging side by side
+    if request.form.get('mode') == 'diff':
+        return _merge_visual_diff(files)
+    
+    # Decode, merge and encode through the shared merge engine
     try:
-        img1 = Image.open(files[0][1]).convert('RGBA')
-        img2 = Image.open(files[1][1]).convert('RGBA')
-        
-        # Resize images to same height
-        target_height = max(img1.size[1], img2.size[1])
-        ratio1 = target_height / img1.size[1]
-        ratio2 = target_height / img2.size[1]
+        encoder = _encoder('merge')
+        merged_bytes = process_images(
+            files, app.config['MERGE_MAX_OUTPUT_PIXELS'], result_cache, worker_pool,
+            backend=app.config['MERGE_COMPOSE_BACKEND'], encoder=encoder,
+            labels=BEFORE_AFTER_LABELS if 'add_text' in request.form else None, operation='merge'
+        )
         
-        new_width1 = int(img1.size[0] * ratio1)
-        new_width2 = int(img2.size[0] * ratio2)
+        # Store the result and only hand its URL to the page
+        with metrics.stage('merge', 'serialize'):
+            result_id = result_store.put(merged_bytes, mimetype_for(encoder))
         
-        img1 = img1.resize((new_width1, target_height), Image.Resampling.LANCZOS)
-        img2 = img2.resize((new_width2, target_height), Image.Resampling.LANCZOS)
-        
-        # Create new image
-        new_width = new_width1 + new_width2
-        merged_image = Image.new('RGBA', (new_width, target_height), (0, 0, 0, 0))
-        
-        # Paste images
-        merged_image.paste(img1, (0, 0))
-        merged_image.paste(img2, (new_width1, 0))
-        
-        # Add text
-        draw = ImageDraw.Draw(merged_image)
-        text_size = int(target_height * 0.05)  # 5% of image height
-          # Add text if requested
-        if 'add_text' in request.form:
-            draw.text((20, 20), "修改前", fill="black", font=ImageFont.load_default())
-            draw.text((new_width1 + 20, 20), "修改后", fill="black", font=ImageFont.load_default())
-        
-        # Convert to RGB for JPEG
-        merged_image = merged_image.convert('RGB')
-        
-        # Save to bytes
-        img_bytes = io.BytesIO()
-        merged_image.save(img_bytes, format='JPEG', quality=95)
-        img_bytes.seek(0)
+        flash('图片拼接成功！', 'success')
+        return render_template('merge.html', merged_url=url_for('get_result', result_id=result_id),
+                               merged_filename=f'merged_image.{extension_for(encoder)}')
         
-        # Convert to base64 for display
-        img_base64 = base64.b64encode(img_bytes.getvalue()).decode()
+    except (PoolBusyError, JobTimeoutError):
+        raise
+    except Exception as e:
+        flash(f'处理图片时出错：{str(e)}', 'error')
+        return render_template('merge.html')
+
+def _merge_visual_diff(files):
+    """比较修改前后的两张图片（按文件名排序后第一张为修改前），页面显示高亮图和变化统计"""
+    from utils.encoders import mimetype_for, extension_for
+    from utils.visual_diff import visual_diff
+    
+    try:
+        encoder = _encoder('visual_diff')
+        threshold = app.config['VISUAL_DIFF_THRESHOLD']
+        max_shift = app.config['VISUAL_DIFF_MAX_SHIFT']
+        # 直接对上传文件的缓冲区计算缓存键，命中缓存时不需要把内容读成 bytes
+        with upload_buffers([file for filename, file in files]) as buffers:
+            cache_key = make_cache_key('visual_diff', buffers,
+                                       {'threshold': threshold, 'encoder': encoder, 'max_shift': max_shift})
+            result = result_cache.get(cache_key)
+            blobs = None if result is not None else [bytes(buffer) for buffer in buffers]
+        if result is None:
+            result = worker_pool.run(visual_diff, blobs[0], blobs[1], threshold, encoder, max_shift)
+            result_cache.set(cache_key, result)
         
-        flash('图片拼接成功！', 'success')
-        return render_template('merge.html', merged_image=img_base64)
+        with metrics.stage('visual_diff', 'serialize'):
+            result_id = result_store.put(result['overlay'], mimetype_for(encoder))
+        stats = json.loads(result['stats'])
         
+        flash('没有发现差异' if stats['identical'] else f'发现 {stats["region_count"]} 处变化', 'success')
+        return render_template('merge.html', merged_url=url_for('get_result', result_id=result_id),
+                               merged_filename=f'visual_diff.{extension_for(encoder)}', diff_stats=stats,
+                               before_name=files[0][0], after_name=files[1][0])
+    
+    except (PoolBusyError, JobTimeoutError):
+        raise
     except Exception as e:
         flash(f'处理图片时出错：{str(e)}', 'error')
         return render_template('merge.html')
@@ -95,156 +278,540 @@ def multi_merge():
     """多图拼接页面"""
     return render_template('multi_merge.html')
 
+def _check_multi_merge_files(files):
+    """检查多图拼接的上传文件，有问题时返回错误信息"""
+    from utils.contact_sheet import LAYOUTS
+    from utils.dedup import DEDUP_MODES
+    from utils.validation import ValidationError, check_images
+    
+    # 验证文件数量
+    max_images = app.config['MULTI_MERGE_MAX_IMAGES']
+    if not (2 <= len(files) <= max_images):
+        return f'请选择2-{max_images}张图片'
+    
+    if request.form.get('layout', 'grid') not in LAYOUTS:
+        return '不支持的布局'
+    
+    if request.form.get('dedup', 'flag') not in DEDUP_MODES:
+        return '不支持的去重方式'
+    
+    # 根据文件内容验证类型和尺寸（只读取文件头）
+    budget = app.config['PIXEL_BUDGETS']['multi_merge' if len(files) <= 6 else 'contact_sheet']
+    try:
+        check_images(files, budget)
+    except ValidationError as e:
+        return str(e)
+    return None
+
 @app.route('/multi_merge_process', methods=['POST'])
+@_upload_budget('multi_merge')
 def multi_merge_process():
     """多图拼接处理"""
-    print("\n=== 开始处理多图拼接 ===")
+    from utils.encoders import mimetype_for, extension_for
+    
     files = request.files.getlist('images')
-    print(f"收到的文件数量: {len(files)}")
-    print(f"文件名列表: {[f.filename for f in files]}")
     
-    # 验证文件数量
-    if not (2 <= len(files) <= 6):
-        print(f"错误：文件数量不正确({len(files)})")
-        flash('请选择2-6张图片', 'error')
+    error = _check_multi_merge_files(files)
+    if error:
+        flash(error, 'error')
         return render_template('multi_merge.html')
     
-    # 验证文件类型
-    for file in files:
-        if not file.filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp')):
-            print(f"错误：文件类型不支持({file.filename})")
-            flash('只支持图片文件 (PNG, JPG, JPEG, GIF, WEBP)', 'error')
-            return render_template('multi_merge.html')
-    
-    # 处理图片
-    print("开始进行图片合并...")
+    # 处理图片（按文件名排序）
     files_with_names = [(f.filename, f) for f in files]
-    print(f"排序前的文件顺序: {[f[0] for f in files_with_names]}")
     files_with_names.sort(key=lambda x: x[0])
-    print(f"排序后的文件顺序: {[f[0] for f in files_with_names]}")
     
-    # 调用处理函数
-    print("调用 process_images 函数")
-    merged_base64 = process_images(files_with_names)
+    # 解码之前先找出重复的图片，按 dedup 选项提示或去掉
+    dedup = request.form.get('dedup', 'flag')
+    files_with_names, duplicates = _dedup_uploads(files_with_names, dedup)
+    if len(files_with_names) < 2:
+        flash('去掉重复的图片后不足两张', 'error')
+        return render_template('multi_merge.html')
+    
+    merged_bytes = _merge_uploads(files_with_names, request.form.get('layout', 'grid'),
+                                  'add_text' in request.form)
     
-    if merged_base64:
-        print("图片合并成功")
+    if merged_bytes:
+        encoder = _merge_encoder(len(files_with_names))
+        with metrics.stage('multi_merge', 'serialize'):
+            result_id = result_store.put(merged_bytes, mimetype_for(encoder))
         flash('图片拼接成功！', 'success')
-        return render_template('multi_merge.html', merged_image=merged_base64)
+        if duplicates:
+            flash(_duplicates_message(duplicates, dedup), 'warning')
+        return render_template('multi_merge.html', merged_url=url_for('get_result', result_id=result_id),
+                               merged_filename=f'merged_image.{extension_for(encoder)}')
     else:
-        print("图片合并失败")
         flash('处理图片时出错', 'error')
         return render_template('multi_merge.html')
 
+def _dedup_uploads(files_with_names, mode, wait=False):
+    """用感知哈希找出重复或几乎相同的图片，返回 (要拼接的文件, 重复组的文件名列表)
+
+    mode 为 drop 时每组只保留第一张；flag 时文件不变，只返回重复组；off 不检查。
+    """
+    if mode not in ('flag', 'drop'):
+        return files_with_names, []
+    from utils.dedup import find_duplicates
+    
+    groups = find_duplicates(files_with_names, _dedup_index(), worker_pool,
+                             app.config['DEDUP_MAX_DISTANCE'], wait=wait)
+    duplicates = [[files_with_names[i][0] for i in group] for group in groups]
+    if mode == 'drop':
+        dropped = {i for group in groups for i in group[1:]}
+        files_with_names = [item for i, item in enumerate(files_with_names) if i not in dropped]
+    return files_with_names, duplicates
+
+def _duplicates_message(duplicates, mode):
+    if mode == 'drop':
+        return '已去掉重复的图片：' + '；'.join(
+            f'{"、".join(names[1:])}（与 {names[0]} 重复）' for names in duplicates
+        )
+    return '发现重复的图片：' + '；'.join('、'.join(names) for names in duplicates)
+
+def _merge_encoder(count):
+    return _encoder('multi_merge' if count <= 6 else 'contact_sheet')
+
+def _merge_uploads(files_with_names, layout, add_text, progress=None):
+    """2-6 张图片使用固定布局，更多的图片拼成联系表；add_text 时在每张图片上标出序号"""
+    from utils.contact_sheet import process_contact_sheet
+    from utils.merge_engine import process_images, index_labels
+    
+    encoder = _merge_encoder(len(files_with_names))
+    labels = index_labels(len(files_with_names)) if add_text else None
+    if len(files_with_names) <= 6:
+        return process_images(files_with_names, app.config['MERGE_MAX_OUTPUT_PIXELS'],
+                              result_cache, worker_pool, progress,
+                              backend=app.config['MERGE_COMPOSE_BACKEND'], encoder=encoder, labels=labels)
+    return process_contact_sheet(
+        files_with_names, layout,
+        tile_width=app.config['CONTACT_SHEET_TILE_WIDTH'],
+        max_output_pixels=app.config['CONTACT_SHEET_MAX_OUTPUT_PIXELS'],
+        memmap_pixels=app.config['CONTACT_SHEET_MEMMAP_PIXELS'],
+        encoder=encoder, labels=labels, cache=result_cache, pool=worker_pool, progress=progress,
+        spool_dir=app.config['UPLOAD_SPOOL_DIR']
+    )
+
+def _run_multi_merge_job(files_with_names, layout, add_text, dedup, progress):
+    """后台执行多图拼接，返回结果 ID、下载文件名和重复图片的提示"""
+    from utils.encoders import mimetype_for, extension_for
+    
+    # 开始处理时才把文件读进内存，同样受内存预算限制（后台任务排队等待，而不是报错）
+    uploads = files_with_names
+    try:
+        total = sum(stream_size(stream) for filename, stream in uploads)
+        with upload_budgets['multi_merge'].reserve(total, wait=True):
+            progress('dedup')
+            files_with_names, duplicates = _dedup_uploads(uploads, dedup, wait=True)
+            if len(files_with_names) < 2:
+                raise ValueError('去掉重复的图片后不足两张')
+            merged_bytes = _merge_uploads(files_with_names, layout, add_text, progress)
+    finally:
+        # 去掉的重复图片也要关闭
+        for filename, stream in uploads:
+            stream.close()
+    if not merged_bytes:
+        raise ValueError('处理图片时出错')
+    encoder = _merge_encoder(len(files_with_names))
+    with metrics.stage('multi_merge', 'serialize'):
+        result_id = result_store.put(merged_bytes, mimetype_for(encoder))
+    return {
+        'result_id': result_id,
+        'filename': f'merged_image.{extension_for(encoder)}',
+        'duplicates': _duplicates_message(duplicates, dedup) if duplicates else None,
+    }
+
+def _job_status_json(job_id, status):
+    data = {
+        'job_id': job_id,
+        'state': status['state'],
+        'stage': status['stage'],
+        'current': status['current'],
+        'total': status['total'],
+        'error': status['error'],
+    }
+    if status['state'] == 'done':
+        data['result_url'] = url_for('get_result', result_id=status['result']['result_id'])
+        data['result_filename'] = status['result']['filename']
+        data['duplicates'] = status['result']['duplicates']
+    return data
+
+@app.route('/multi_merge_jobs', methods=['POST'])
+@_upload_budget('multi_merge')
+def submit_multi_merge_job():
+    """提交多图拼接后台任务，立即返回任务 ID"""
+    files = request.files.getlist('images')
+    error = _check_multi_merge_files(files)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    
+    # 请求结束时 Flask 会关闭上传的文件，取出文件对象交给后台任务（大文件仍在磁盘上，不读进内存）
+    files_with_names = sorted(((f.filename, detach_stream(f)) for f in files), key=lambda x: x[0])
+    try:
+        job_id = job_manager.submit(_run_multi_merge_job, files_with_names, request.form.get('layout', 'grid'),
+                                    'add_text' in request.form, request.form.get('dedup', 'flag'))
+    except PoolBusyError:
+        for filename, stream in files_with_names:
+            stream.close()
+        raise
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status_url': url_for('multi_merge_job_status', job_id=job_id),
+        'result_url': url_for('multi_merge_job_result', job_id=job_id)
+    }), 202
+
+@app.route('/multi_merge_jobs/<job_id>')
+def multi_merge_job_status(job_id):
+    """查询后台任务状态：queued / running（dedup、decode（解码并缩放到格子尺寸）、paste、encode）/ done / failed"""
+    status = job_manager.status(job_id)
+    if status is None:
+        return jsonify({'success': False, 'error': '任务不存在或已过期'}), 404
+    return jsonify(_job_status_json(job_id, status))
+
+@app.route('/multi_merge_jobs/<job_id>/result')
+def multi_merge_job_result(job_id):
+    """任务完成后跳转到结果图片，未完成时返回当前状态"""
+    status = job_manager.status(job_id)
+    if status is None:
+        return jsonify({'success': False, 'error': '任务不存在或已过期'}), 404
+    if status['state'] == 'done':
+        return redirect(url_for('get_result', result_id=status['result']['result_id']))
+    if status['state'] == 'failed':
+        return jsonify(_job_status_json(job_id, status)), 500
+    return jsonify(_job_status_json(job_id, status)), 202
+
 @app.route('/icon_maker')
 def icon_maker():
     """Icon 制作页面"""
     return render_template('icon_maker.html')
 
+def _get_icon_upload():
+    """取出上传的图片并检查，有问题时返回 (None, 错误响应)"""
+    from utils.validation import ValidationError, check_images, ICON_MIMETYPES
+    
+    file = request.files.get('image')
+    if file is None or file.filename == '':
+        return None, ('No image file', 400)
+    
+    # 根据文件内容检查类型和尺寸（只读取文件头）
+    try:
+        check_images([file], app.config['PIXEL_BUDGETS']['icon'], ICON_MIMETYPES)
+    except ValidationError as e:
+        return None, (str(e), 400)
+    return file, None
+
+@app.route('/icon_maker_upload', methods=['POST'])
+@_upload_budget('icon')
+def icon_maker_upload():
+    """上传原图并创建会话，之后的裁剪请求只需要提交会话 ID 和裁剪参数"""
+    file, error = _get_icon_upload()
+    if error:
+        return error
+    try:
+        session_id, (width, height) = _icon_sessions().create(file.stream, worker_pool)
+    except (PoolBusyError, JobTimeoutError):
+        raise
+    except Exception as e:
+        logger.exception('读取图片失败')
+        return jsonify({'success': False, 'error': str(e)}), 500
+    return jsonify({'success': True, 'session_id': session_id, 'width': width, 'height': height})
+
 @app.route('/icon_maker_process', methods=['POST'])
+@_upload_budget('icon')
 def icon_maker_process():
-    """处理 Icon 制作请求"""
+    """处理 Icon 制作请求：提交 session_id 时从会话的金字塔裁剪，否则使用上传的原图"""
+    from utils.icon_maker import make_icon, make_icon_bundle, crop_from_levels
+    
     try:
-        # 获取上传的图片
-        if 'image' not in request.files:
-            return 'No image file', 400
-        
-        file = request.files['image']
-        if file.filename == '':
-            return 'No image file', 400
-        
-        # 检查文件类型
-        if not file.filename.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
-            return 'Unsupported file format', 400
-        
         # 获取裁剪参数
         crop_x = int(request.form.get('crop_x', 0))
         crop_y = int(request.form.get('crop_y', 0))
         crop_size = int(request.form.get('crop_size', 100))
         scale = float(request.form.get('scale', 1.0))
+        encoder = _encoder('icon')
+        params = {'crop_x': crop_x, 'crop_y': crop_y, 'crop_size': crop_size, 'scale': scale, 'encoder': encoder}
         
-        # 打开图片
-        img = Image.open(file).convert('RGBA')
-        
-        # 应用缩放
-        if scale != 1.0:
-            new_width = int(img.size[0] * scale)
-            new_height = int(img.size[1] * scale)
-            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        
-        # 裁剪正方形区域
-        crop_box = (crop_x, crop_y, crop_x + crop_size, crop_y + crop_size)
-        cropped_img = img.crop(crop_box)
-        
-        # 生成PNG文件
-        png_bytes = io.BytesIO()
-        cropped_img.save(png_bytes, format='PNG', optimize=True)
-        png_base64 = base64.b64encode(png_bytes.getvalue()).decode()
+        session_id = request.form.get('session_id')
+        if session_id:
+            # 会话 ID 就是原图内容的哈希，可以直接作为缓存键的一部分
+            cache_key = make_cache_key('icon_bundle', [], dict(params, source=session_id))
+            icon_files = result_cache.get(cache_key)
+            if icon_files is None:
+                levels = _icon_sessions().get(session_id)
+                if levels is None:
+                    return jsonify({'success': False, 'error': '会话已过期，请重新上传', 'expired': True}), 404
+                # 金字塔保存在主进程中，这里只裁剪出需要的区域，缩放和编码仍在进程池中执行
+                cropped_img = crop_from_levels(levels, crop_x, crop_y, crop_size, scale)
+                icon_files = worker_pool.run(make_icon_bundle, cropped_img, encoder)
+                result_cache.set(cache_key, icon_files)
+        else:
+            file, error = _get_icon_upload()
+            if error:
+                return error
+            with upload_buffers([file]) as (buffer,):
+                cache_key = make_cache_key('icon_bundle', [buffer], params)
+                icon_files = result_cache.get(cache_key)
+                blob = None if icon_files is not None else bytes(buffer)
+            if icon_files is None:
+                icon_files = worker_pool.run(make_icon, blob, crop_x, crop_y, crop_size, scale, encoder)
+                result_cache.set(cache_key, icon_files)
+        with metrics.stage('icon', 'serialize'):
+            png_id = result_store.put(icon_files['png'], 'image/png')
+            ico_id = result_store.put(icon_files['ico'], 'image/x-icon')
+            zip_id = result_store.put(icon_files['zip'], 'application/zip')
         
-        # 生成ICO文件 - 固定为128x128尺寸
-        ico_bytes = io.BytesIO()
-        # 将裁剪后的图片调整为128x128
-        ico_image = cropped_img.resize((128, 128), Image.Resampling.LANCZOS)
-        
-        # 保存为ICO格式，明确指定尺寸
-        ico_image.save(ico_bytes, format='ICO', sizes=[(128, 128)])
-        ico_base64 = base64.b64encode(ico_bytes.getvalue()).decode()
-        
-        # 返回JSON响应，包含两个文件的base64数据
-        from flask import jsonify
+        # 返回JSON响应，包含 PNG、ICO 和整套图标压缩包的下载地址
         return jsonify({
             'success': True,
-            'png_data': png_base64,
-            'ico_data': ico_base64,
+            'png_url': url_for('get_result', result_id=png_id, name='cropped_image.png'),
+            'ico_url': url_for('get_result', result_id=ico_id, name='cropped_image.ico'),
+            'zip_url': url_for('get_result', result_id=zip_id, name='icons.zip'),
             'png_filename': 'cropped_image.png',
-            'ico_filename': 'cropped_image.ico'
+            'ico_filename': 'cropped_image.ico',
+            'zip_filename': 'icons.zip'
         })
         
+    except (PoolBusyError, JobTimeoutError):
+        raise
     except Exception as e:
-        from flask import jsonify
+        logger.exception('生成图标失败')
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/icon_maker_batch', methods=['POST'])
+@_upload_budget('icon_batch')
+def icon_maker_batch():
+    """批量生成图标：上传多张图片或 ZIP 压缩包，返回包含每张图片整套图标的 ZIP（边处理边发送）
+
+    policy 为裁剪方式（center / saliency / boxes）；boxes 为 JSON {文件名: [x, y, 边长]}，
+    没有指定裁剪框的文件居中裁剪。
+    """
+    from utils.icon_batch import CROP_POLICIES, list_batch_entries, iter_icon_archive
+    from utils.validation import ValidationError
+    
+    policy = request.form.get('policy', 'center')
+    if policy not in CROP_POLICIES:
+        return '不支持的裁剪方式', 400
+    try:
+        boxes = json.loads(request.form.get('boxes') or '{}')
+        if not isinstance(boxes, dict):
+            raise ValueError
+    except ValueError:
+        return 'boxes 格式错误', 400
+    
+    # 响应开始发送时请求已经结束，取出上传的文件对象，处理到某张图片时才读取它
+    uploads = [(f.filename, detach_stream(f)) for f in request.files.getlist('images') if f.filename]
+    
+    def close_uploads():
+        for filename, upload in uploads:
+            upload.close()
+    
+    try:
+        entries = list_batch_entries(uploads, app.config['ICON_BATCH_MAX_IMAGES'], app.config['ICON_BATCH_MAX_BYTES'])
+    except ValidationError as e:
+        close_uploads()
+        return str(e), 400
+    
+    stream = iter_icon_archive(
+        entries, policy, boxes, _encoder('icon'), worker_pool,
+        parallel=max(1, app.config['WORKER_PROCESSES']),
+        max_pixels=app.config['PIXEL_BUDGETS']['icon']['image'], sampled=metrics.enabled()
+    )
+    response = Response(stream, mimetype='application/zip',
+                        headers={'Content-Disposition': 'attachment; filename=icons_batch.zip'})
+    response.call_on_close(close_uploads)
+    return response
+
 @app.route('/file_diff', methods=['GET', 'POST'])
+@_upload_budget('file_diff')
 def file_diff():
     """文件对比页面"""
+    import zipfile
+    from utils.diff_engine import is_binary, detect_encoding, decode_lines, compare_binary
+    from utils.diff_store import DiffIndex
+    
     if request.method == 'POST':
         files = request.files.getlist('files')
         if len(files) != 2:
             return 'Please select exactly two files', 400
         
-        # Create temp files and save uploads
-        temp_files = []
-        try:
-            for file in files:
-                temp = NamedTemporaryFile(delete=False)
-                file.save(temp.name)
-                temp_files.append(temp)
-            
-            # Read file contents
-            fromlines = open(temp_files[0].name, encoding='utf-8').readlines()
-            tolines = open(temp_files[1].name, encoding='utf-8').readlines()
-            
-            # Generate HTML diff
-            diff = difflib.HtmlDiff().make_file(
-                fromlines, 
-                tolines,
-                files[0].filename,
-                files[1].filename,
-                context=True
-            )
-            
-            return render_template('file_diff.html', diff_content=diff)
+        # 两个都是 ZIP 时比较压缩包中的目录树
+        if all(zipfile.is_zipfile(file.stream) for file in files):
+            return _tree_diff(files)
+        
+        # Read the uploads in place (memory or mmap) instead of via temp files
+        with upload_buffers(files) as buffers:
+            if is_binary(buffers[0]) or is_binary(buffers[1]):
+                return render_template(
+                    'file_diff.html',
+                    binary_result=compare_binary(buffers[0], buffers[1]),
+                    from_name=files[0].filename,
+                    to_name=files[1].filename
+                )
             
-        finally:
-            # Clean up temp files
-            for temp in temp_files:
-                try:
-                    os.unlink(temp.name)
-                except:
-                    pass
+            with metrics.stage('file_diff', 'decode'):
+                encodings = [detect_encoding(buffer) for buffer in buffers]
+                fromlines = decode_lines(buffers[0], encodings[0])
+                tolines = decode_lines(buffers[1], encodings[1])
+        
+        # 只计算一次 hunk 索引并保存，页面只渲染表格框架，滚动时再通过 /file_diff/<diff_id>/rows 取出可见的行
+        with metrics.stage('file_diff', 'diff'):
+            index = DiffIndex(fromlines, tolines, info={
+                'from_name': files[0].filename,
+                'to_name': files[1].filename,
+                'from_encoding': encodings[0],
+                'to_encoding': encodings[1],
+            })
+        del fromlines, tolines
+        diff_id = _diff_store().add(index)
+        return render_template('file_diff.html', diff_id=diff_id, diff=index.summary())
                     
     return render_template('file_diff.html')
 
+def _tree_diff(files):
+    """压缩包对比：只读取两边的中央目录，按路径比较大小和 CRC32，修改过的文件由页面通过 /stats 流式取得增删行数"""
+    from utils.tree_diff import TreeCompare
+    from utils.validation import ValidationError
+
+    try:
+        with metrics.stage('tree_diff', 'index'):
+            # TreeCompare 接管上传的文件，请求结束后查看单个文件时还要从中解压
+            tree = TreeCompare(detach_stream(files[0]), detach_stream(files[1]), app.config['TREE_DIFF_MAX_ENTRIES'], info={
+                'from_name': files[0].filename,
+                'to_name': files[1].filename,
+            })
+    except ValidationError as e:
+        return str(e), 400
+    tree_id = _diff_store().add(tree)
+    return render_template('file_diff.html', tree_id=tree_id, tree=tree.summary(), changes=tree.changes)
+
+def _expired():
+    return jsonify({'error': '比较结果已过期，请重新上传文件', 'expired': True}), 404
+
+def _get_diff(diff_id, kind):
+    """取出保存的比较结果（kind 为 DiffIndex 或 TreeCompare），不存在或已过期时返回 (None, 404 响应)"""
+    index = _diff_store().get(diff_id)
+    if not isinstance(index, kind):
+        return None, _expired()
+    return index, None
+
+def _window_args(max_count):
+    start = max(request.args.get('start', 0, type=int), 0)
+    count = min(max(request.args.get('count', 200, type=int), 0), max_count)
+    return start, count
+
+@app.route('/file_diff/<diff_id>')
+def file_diff_summary(diff_id):
+    """比较结果的概况：文件名、编码、行数、hunk 数和表格总行数"""
+    from utils.diff_store import DiffIndex
+
+    index, error = _get_diff(diff_id, DiffIndex)
+    if error:
+        return error
+    return jsonify(index.summary())
+
+@app.route('/file_diff/<diff_id>/view')
+def file_diff_view(diff_id):
+    """查看保存的比较结果（压缩包中单个文件的对比也在这里打开）"""
+    from utils.diff_store import DiffIndex
+
+    index, error = _get_diff(diff_id, DiffIndex)
+    if error:
+        return error
+    return render_template('file_diff.html', diff_id=diff_id, diff=index.summary())
+
+@app.route('/file_diff/<diff_id>/hunks')
+def file_diff_hunks(diff_id):
+    """第 start 个开始的 count 个 hunk 在表格中的位置和两边的行号范围"""
+    from utils.diff_store import DiffIndex, MAX_WINDOW_HUNKS
+
+    index, error = _get_diff(diff_id, DiffIndex)
+    if error:
+        return error
+    start, count = _window_args(MAX_WINDOW_HUNKS)
+    return jsonify({'start': start, 'hunk_count': len(index.hunks), 'hunks': index.hunk_window(start, count)})
+
+@app.route('/file_diff/<diff_id>/rows')
+def file_diff_rows(diff_id):
+    """表格中第 start 行开始的 count 行：[左侧行号, 左侧 HTML, 左侧样式, 右侧行号, 右侧 HTML, 右侧样式]，
+    hunk 之间的分隔行为 null"""
+    from utils.diff_store import DiffIndex, MAX_WINDOW_ROWS
+
+    index, error = _get_diff(diff_id, DiffIndex)
+    if error:
+        return error
+    start, count = _window_args(MAX_WINDOW_ROWS)
+    try:
+        with metrics.stage('file_diff', 'render'):
+            rows = index.row_window(start, count)
+    except KeyError:
+        # 读取时刚好被淘汰
+        return _expired()
+    return jsonify({'start': start, 'total_rows': index.total_rows, 'rows': rows})
+
+@app.route('/file_diff/<tree_id>/stats')
+def tree_diff_stats(tree_id):
+    """逐行比较压缩包中所有修改过的文件（在进程池中并行），每完成一个返回一行 JSON：增删行数、是否二进制等"""
+    from utils.tree_diff import MODIFIED, TreeCompare, iter_tree_stats
+
+    tree, error = _get_diff(tree_id, TreeCompare)
+    if error:
+        return error
+    parallel = max(1, app.config['WORKER_PROCESSES'])
+    # 同时最多解压 parallel 对文件，按其中最大的几对预留内存预算
+    sizes = sorted((_entry_bytes(change) for change in tree.changes if change['status'] == MODIFIED), reverse=True)
+    stream = iter_tree_stats(
+        tree, worker_pool, parallel=parallel,
+        max_file_bytes=app.config['TREE_DIFF_MAX_FILE_BYTES'], sampled=metrics.enabled()
+    )
+    return _with_budget('file_diff', sum(sizes[:parallel]), Response, stream, mimetype='application/x-ndjson')
+
+def _entry_bytes(change):
+    """比较压缩包中一个文件时解压出的字节数，超过 TREE_DIFF_MAX_FILE_BYTES 的文件不解压"""
+    sizes = (change['from_size'] or 0, change['to_size'] or 0)
+    return 0 if max(sizes) > app.config['TREE_DIFF_MAX_FILE_BYTES'] else sum(sizes)
+
+@app.route('/file_diff/<tree_id>/files/<int:n>')
+def tree_diff_file(tree_id, n):
+    """查看压缩包中第 n 个有变化的文件：文本文件按 /stats 已经算好的 hunk 建立索引后跳转到对比页面"""
+    from utils.tree_diff import TreeCompare
+
+    tree, error = _get_diff(tree_id, TreeCompare)
+    if error:
+        return error
+    if not 0 <= n < len(tree.changes):
+        abort(404)
+    diff_id = tree.diff_ids.get(n)
+    if diff_id and _diff_store().get(diff_id) is not None:
+        return redirect(url_for('file_diff_view', diff_id=diff_id))
+
+    return _with_budget('file_diff', _entry_bytes(tree.changes[n]), _tree_diff_entry, tree, n)
+
+def _tree_diff_entry(tree, n):
+    from utils.diff_engine import compare_binary, decode_lines
+    from utils.diff_store import DiffIndex
+    from utils.tree_diff import entry_diff
+
+    path = tree.changes[n]['path']
+    names = {'from_name': f"{tree.info['from_name']}/{path}", 'to_name': f"{tree.info['to_name']}/{path}"}
+    try:
+        result = entry_diff(tree, n, worker_pool, app.config['TREE_DIFF_MAX_FILE_BYTES'])
+        if result.get('too_large'):
+            return f'{path}：文件过大，只比较了大小和 CRC32', 413
+        old, new = tree.read(n)
+    except ValueError:
+        # 读取时刚好被淘汰
+        return _expired()
+    if result['binary']:
+        return render_template('file_diff.html', binary_result=compare_binary(old, new), **names)
+
+    with metrics.stage('tree_diff', 'decode'):
+        fromlines = decode_lines(old, result['encodings'][0])
+        tolines = decode_lines(new, result['encodings'][1])
+    del old, new
+    index = DiffIndex(fromlines, tolines, hunks=result['hunks'], info=dict(
+        names, from_encoding=result['encodings'][0], to_encoding=result['encodings'][1]
+    ))
+    diff_id = tree.diff_ids[n] = _diff_store().add(index)
+    return redirect(url_for('file_diff_view', diff_id=diff_id))
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5083, debug=True)
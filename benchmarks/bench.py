@@ -0,0 +1,438 @@
+"""图片拼接、Icon 制作和文件对比的性能基准测试
+
+每个用例在单独的子进程中运行，这样峰值内存（RSS）互不影响。
+路由用例通过 Flask 测试客户端调用，图片处理在请求线程内执行（WORKER_PROCESSES=0），
+并且关闭结果缓存，保证每次都真正执行。
+
+用法:
+    python benchmarks/bench.py                          # 快速档：1MP/12MP 图片，10KB/1MB 文本
+    python benchmarks/bench.py --full                   # 完整档：加上 50MP 图片和 50MB 文本
+    python benchmarks/bench.py --cases route_icon,route_file_diff
+    python benchmarks/bench.py --cases merge_grid_images,merge_grid_images_numpy   # 比较两种合成方式
+    python benchmarks/bench.py --output result.json     # 结果写成 JSON
+    python benchmarks/bench.py --save-baseline          # 保存为基线 benchmarks/baseline.json
+    python benchmarks/bench.py --baseline benchmarks/baseline.json   # 与基线比较，变慢时退出码为 1
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import sys
+import time
+from queue import Empty
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+QUICK_IMAGE_SIZES = [1, 12]          # 百万像素
+FULL_IMAGE_SIZES = [1, 12, 50]
+QUICK_TEXT_SIZES = [10 * 1024, 1024 * 1024]          # 字节
+FULL_TEXT_SIZES = [10 * 1024, 1024 * 1024, 50 * 1024 * 1024]
+
+# 完整档的请求体（6 张 50MP 图片约 120MB，两个 50MB 文本约 105MB）超过应用默认的 MAX_CONTENT_LENGTH，
+# 路由用例的测试客户端把上限放宽到这个值
+BENCH_MAX_CONTENT_LENGTH = 512 * 1024 * 1024
+
+# 单个用例（准备 + 预热 + 计时）的默认超时，秒
+CASE_TIMEOUT = 1800
+
+
+# ---------------------------------------------------------------- 合成输入
+
+def synthetic_image(megapixels: float, seed: int = 0, alpha: bool = False):
+    """渐变 + 噪点的合成图片，4:3 比例，比纯噪点更接近真实照片的编码特性"""
+    import numpy as np
+    from PIL import Image
+
+    height = int((megapixels * 1000 * 1000 * 3 / 4) ** 0.5)
+    width = int(height * 4 / 3)
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    channels = [
+        (x + y) / 2,
+        np.broadcast_to(x, (height, width)),
+        np.broadcast_to(y, (height, width)),
+    ]
+    if alpha:
+        channels.append(np.full((height, width), 255, dtype=np.float32))
+    pixels = np.stack([np.asarray(c) for c in channels], axis=-1)
+    pixels += rng.normal(0, 12, pixels.shape[:2] + (1,)).astype(np.float32)
+    pixels = np.clip(pixels, 0, 255).astype(np.uint8)
+    return Image.fromarray(pixels, 'RGBA' if alpha else 'RGB')
+
+
+def encoded_image(megapixels: float, seed: int = 0, fmt: str = 'JPEG') -> bytes:
+    buffer = io.BytesIO()
+    synthetic_image(megapixels, seed).save(buffer, format=fmt, quality=90)
+    return buffer.getvalue()
+
+
+def synthetic_text(size: int, seed: int = 0) -> bytes:
+    """类似日志的文本行"""
+    import random
+
+    rng = random.Random(seed)
+    lines = []
+    total = 0
+    i = 0
+    while total < size:
+        line = f'2024-01-01 12:{i // 60 % 60:02d}:{i % 60:02d} INFO worker-{rng.randint(1, 8)} ' \
+               f'request id={rng.getrandbits(32):08x} took {rng.randint(1, 999)}ms\n'
+        lines.append(line)
+        total += len(line)
+        i += 1
+    return ''.join(lines).encode('utf-8')
+
+
+def modified_text(data: bytes, every: int = 500) -> bytes:
+    """每隔 every 行改动一行，模拟两个版本的文件"""
+    lines = data.split(b'\n')
+    for k in range(0, len(lines), every):
+        lines[k] = b'changed ' + lines[k]
+    return b'\n'.join(lines)
+
+
+# ---------------------------------------------------------------- 用例
+
+def _client():
+    import app as app_module
+    from utils.cache import ResultCache
+
+    app_module.result_cache = ResultCache(0)  # 关闭缓存
+    app_module.app.config['TESTING'] = True
+    app_module.app.config['MAX_CONTENT_LENGTH'] = BENCH_MAX_CONTENT_LENGTH
+    return app_module.app.test_client()
+
+
+def _post(client, url, data):
+    response = client.post(url, data=data, content_type='multipart/form-data')
+    body = response.get_data()  # 流式响应也要读完
+    if response.status_code != 200:
+        raise RuntimeError(f'{url} 返回 {response.status_code}: {body[:200]!r}')
+    return len(body)
+
+
+def setup_merge_two_images(size):
+    return [synthetic_image(size, seed=i, alpha=True) for i in range(2)]
+
+
+def run_merge_two_images(images):
+    from utils.image_processor import merge_two_images
+    merge_two_images(images)
+
+
+def setup_merge_three_images(size):
+    return [synthetic_image(size, seed=i, alpha=True) for i in range(3)]
+
+
+def run_merge_three_images(images):
+    from utils.image_processor import merge_three_images
+    merge_three_images(images)
+
+
+def setup_merge_grid_images(size):
+    return [synthetic_image(size, seed=i, alpha=True) for i in range(6)]
+
+
+def run_merge_grid_images(images):
+    from utils.image_processor import merge_grid_images
+    merge_grid_images(images, 2, 3)
+
+
+def run_merge_grid_images_numpy(images):
+    from utils.image_processor import merge_grid_images
+    merge_grid_images(images, 2, 3, backend='numpy')
+
+
+def setup_process_images(size):
+    return [encoded_image(size, seed=i) for i in range(6)]
+
+
+def run_process_images(blobs):
+    from config import Config
+    from utils.merge_engine import process_images
+    process_images([(f'{i}.jpg', io.BytesIO(blob)) for i, blob in enumerate(blobs)],
+                   Config.MERGE_MAX_OUTPUT_PIXELS)
+
+
+def setup_route_merge(size):
+    return _client(), [encoded_image(size, seed=i) for i in range(2)]
+
+
+def run_route_merge(state):
+    client, blobs = state
+    _post(client, '/merge', {
+        'image1': [(io.BytesIO(blob), f'{i}.jpg') for i, blob in enumerate(blobs)],
+        'add_text': 'on',
+    })
+
+
+def setup_route_multi_merge(size):
+    return _client(), [encoded_image(size, seed=i) for i in range(6)]
+
+
+def run_route_multi_merge(state):
+    client, blobs = state
+    _post(client, '/multi_merge_process', {
+        'images': [(io.BytesIO(blob), f'{i}.jpg') for i, blob in enumerate(blobs)],
+    })
+
+
+def setup_route_icon(size):
+    blob = encoded_image(size)
+    from PIL import Image
+    width, height = Image.open(io.BytesIO(blob)).size
+    return _client(), blob, min(width, height) // 2
+
+
+def run_route_icon(state):
+    client, blob, crop_size = state
+    _post(client, '/icon_maker_process', {
+        'image': (io.BytesIO(blob), 'image.jpg'),
+        'crop_x': '10', 'crop_y': '10', 'crop_size': str(crop_size), 'scale': '1.0',
+    })
+
+
+def setup_route_file_diff(size):
+    old = synthetic_text(size)
+    return _client(), old, modified_text(old)
+
+
+def run_route_file_diff(state):
+    client, old, new = state
+    _post(client, '/file_diff', {
+        'files': [(io.BytesIO(old), 'old.log'), (io.BytesIO(new), 'new.log')],
+    })
+
+
+def setup_visual_diff(size):
+    from PIL import ImageDraw
+    before = synthetic_image(size)
+    after = before.copy()
+    width, height = after.size
+    ImageDraw.Draw(after).rectangle((width // 4, height // 3, width // 4 + width // 10, height // 3 + height // 20),
+                                    fill=(255, 0, 0))
+    return before, after
+
+
+def run_visual_diff(images):
+    from utils.visual_diff import compare_images
+    compare_images(*images)
+
+
+# 用例名: (准备函数, 执行函数, 输入类型)
+CASES = {
+    'merge_two_images': (setup_merge_two_images, run_merge_two_images, 'image'),
+    'merge_three_images': (setup_merge_three_images, run_merge_three_images, 'image'),
+    'merge_grid_images': (setup_merge_grid_images, run_merge_grid_images, 'image'),
+    'merge_grid_images_numpy': (setup_merge_grid_images, run_merge_grid_images_numpy, 'image'),
+    'process_images': (setup_process_images, run_process_images, 'image'),
+    'route_merge': (setup_route_merge, run_route_merge, 'image'),
+    'route_multi_merge': (setup_route_multi_merge, run_route_multi_merge, 'image'),
+    'route_icon': (setup_route_icon, run_route_icon, 'image'),
+    'route_file_diff': (setup_route_file_diff, run_route_file_diff, 'text'),
+    'visual_diff': (setup_visual_diff, run_visual_diff, 'image'),
+}
+
+# 每个用例处理的图片张数，用于计算吞吐量
+IMAGE_COUNTS = {
+    'merge_two_images': 2, 'merge_three_images': 3, 'merge_grid_images': 6, 'merge_grid_images_numpy': 6,
+    'process_images': 6, 'route_merge': 2, 'route_multi_merge': 6, 'route_icon': 1, 'visual_diff': 2,
+}
+
+
+# ---------------------------------------------------------------- 执行与统计
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位是 KB，macOS 是字节
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _run_case(name, size, iterations, queue):
+    """子进程入口：准备输入、预热一次，然后计时"""
+    os.environ['WORKER_PROCESSES'] = '0'
+    import contextlib
+
+    setup, run, _ = CASES[name]
+    # 被测代码里的 print 不计入结果，也不刷屏
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            state = setup(size)
+            run(state)
+            latencies = []
+            for _ in range(iterations):
+                start = time.perf_counter()
+                run(state)
+                latencies.append(time.perf_counter() - start)
+    except Exception as e:
+        queue.put({'error': f'{type(e).__name__}: {e}'})
+        return
+    queue.put({'latencies': latencies, 'peak_rss_mb': _peak_rss_mb()})
+
+
+def _wait_result(process, queue, timeout):
+    """等待子进程放回结果；子进程异常退出（例如内存不足被杀掉）或超时返回 {'error': 说明}"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            pass
+        if not process.is_alive():
+            # 子进程退出前放入的结果可能还没有从管道中读出
+            try:
+                return queue.get(timeout=1)
+            except Empty:
+                return {'error': f'子进程异常退出（exitcode={process.exitcode}）'}
+        if time.monotonic() > deadline:
+            process.terminate()
+            return {'error': f'超过 {timeout} 秒没有完成'}
+
+
+def run_case(name, size, iterations, timeout=CASE_TIMEOUT):
+    """在子进程中运行一个用例；失败时返回的结果只有 case、size 和 error"""
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_run_case, args=(name, size, iterations, queue))
+    process.start()
+    raw = _wait_result(process, queue, timeout)
+    process.join()
+    if 'error' in raw:
+        return {'case': name, 'size': size, 'error': raw['error']}
+
+    latencies = raw['latencies']
+    kind = CASES[name][2]
+    p50 = _percentile(latencies, 50)
+    result = {
+        'case': name,
+        'size': size,
+        'iterations': iterations,
+        'p50_ms': p50 * 1000,
+        'p90_ms': _percentile(latencies, 90) * 1000,
+        'p99_ms': _percentile(latencies, 99) * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'peak_rss_mb': raw['peak_rss_mb'],
+    }
+    if kind == 'image':
+        result['throughput'] = size * IMAGE_COUNTS[name] / p50
+        result['throughput_unit'] = 'MP/s'
+    else:
+        result['throughput'] = size * 2 / 1024 / 1024 / p50
+        result['throughput_unit'] = 'MB/s'
+    return result
+
+
+def _key(result):
+    return f"{result['case']}@{result['size']}"
+
+
+def compare(results, baseline, tolerance):
+    """与基线比较，返回退化的用例说明列表"""
+    base = {_key(r): r for r in baseline['results'] if 'error' not in r}
+    regressions = []
+    for result in results:
+        if 'error' in result:
+            continue
+        old = base.get(_key(result))
+        if old is None:
+            continue
+        if result['p50_ms'] > old['p50_ms'] * (1 + tolerance):
+            regressions.append(f"{_key(result)}: p50 {old['p50_ms']:.1f}ms -> {result['p50_ms']:.1f}ms")
+        if result['peak_rss_mb'] and old.get('peak_rss_mb') \
+                and result['peak_rss_mb'] > old['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f"{_key(result)}: 峰值内存 {old['peak_rss_mb']:.0f}MB -> "
+                               f"{result['peak_rss_mb']:.0f}MB")
+    return regressions
+
+
+def _size_label(result):
+    if CASES[result['case']][2] == 'image':
+        return f"{result['size']}MP"
+    return f"{result['size'] / 1024:.0f}KB" if result['size'] < 1024 * 1024 \
+        else f"{result['size'] / 1024 / 1024:.0f}MB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='flask_utils 性能基准测试')
+    parser.add_argument('--full', action='store_true', help='包含 50MP 图片和 50MB 文本')
+    parser.add_argument('--cases', help='只运行这些用例（逗号分隔）')
+    parser.add_argument('--iterations', type=int, default=5, help='每个用例计时的次数')
+    parser.add_argument('--output', help='把结果写入 JSON 文件')
+    parser.add_argument('--baseline', help='与该基线文件比较，变慢时退出码为 1')
+    parser.add_argument('--save-baseline', action='store_true', help=f'把结果保存为 {DEFAULT_BASELINE}')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='允许的退化比例，默认 0.2（20%%）')
+    parser.add_argument('--timeout', type=int, default=CASE_TIMEOUT, help=f'单个用例的超时（秒），默认 {CASE_TIMEOUT}')
+    args = parser.parse_args()
+
+    names = args.cases.split(',') if args.cases else list(CASES)
+    unknown = [name for name in names if name not in CASES]
+    if unknown:
+        parser.error(f'未知用例: {", ".join(unknown)}')
+    image_sizes = FULL_IMAGE_SIZES if args.full else QUICK_IMAGE_SIZES
+    text_sizes = FULL_TEXT_SIZES if args.full else QUICK_TEXT_SIZES
+
+    results = []
+    print(f"{'用例':<26}{'规模':>8}{'p50(ms)':>11}{'p90(ms)':>11}{'p99(ms)':>11}{'峰值RSS(MB)':>13}{'吞吐量':>16}")
+    for name in names:
+        sizes = image_sizes if CASES[name][2] == 'image' else text_sizes
+        for size in sizes:
+            result = run_case(name, size, args.iterations, args.timeout)
+            results.append(result)
+            if 'error' in result:
+                print(f"{name:<26}{_size_label(result):>8}  失败: {result['error']}", flush=True)
+                continue
+            rss = f"{result['peak_rss_mb']:.0f}" if result['peak_rss_mb'] else '-'
+            print(f"{name:<26}{_size_label(result):>8}{result['p50_ms']:>11.1f}{result['p90_ms']:>11.1f}"
+                  f"{result['p99_ms']:>11.1f}{rss:>13}"
+                  f"{result['throughput']:>11.1f} {result['throughput_unit']}", flush=True)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'iterations': args.iterations,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(DEFAULT_BASELINE, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f'已保存基线: {DEFAULT_BASELINE}')
+
+    failed = [result for result in results if 'error' in result]
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('\n性能退化:')
+            for line in regressions:
+                print(f'  {line}')
+            sys.exit(1)
+        print('\n与基线相比没有退化')
+    if failed:
+        print(f'\n{len(failed)} 个用例失败')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
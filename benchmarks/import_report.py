@@ -0,0 +1,168 @@
+"""启动开销报告：导入 app.py 的耗时、各工具第一个请求的延迟和进程内存，以及加载了哪些重量级模块
+
+每个场景在单独的子进程中运行（全新的解释器，没有任何模块缓存），
+用来确认只用到某一种工具的进程不会加载其它工具的依赖。
+
+用法:
+    python benchmarks/import_report.py                  # 所有场景
+    python benchmarks/import_report.py --top 20         # 另外列出 import app 耗时最多的 20 个模块（-X importtime）
+    python benchmarks/import_report.py --output result.json
+"""
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# 关心的重量级依赖
+HEAVY_MODULES = ['PIL.Image', 'numpy', 'chardet', 'magic', 'utils.merge_engine', 'utils.icon_maker',
+                 'utils.diff_engine']
+
+
+def _png_bytes(size=(64, 48), color=(200, 100, 50)) -> bytes:
+    from PIL import Image
+    output = io.BytesIO()
+    Image.new('RGB', size, color).save(output, format='PNG')
+    return output.getvalue()
+
+
+# 场景: 准备请求数据，返回在测试客户端上发出第一个请求的函数（准备数据不计入请求耗时）
+def _prepare_index():
+    return lambda client: client.get('/')
+
+
+def _prepare_merge():
+    images = [_png_bytes(), _png_bytes(color=(0, 0, 0))]
+    return lambda client: client.post('/merge', data={
+        'image1': [(io.BytesIO(images[0]), 'a.png'), (io.BytesIO(images[1]), 'b.png')]
+    })
+
+
+def _prepare_icon():
+    image = _png_bytes((256, 256))
+    return lambda client: client.post('/icon_maker_upload', data={'image': (io.BytesIO(image), 'a.png')})
+
+
+def _prepare_file_diff():
+    return lambda client: client.post('/file_diff', data={
+        'files': [(io.BytesIO(b'a\nb\nc\n'), 'a.txt'), (io.BytesIO(b'a\nB\nc\n'), 'b.txt')]
+    })
+
+
+def _prepare_metrics():
+    return lambda client: client.get('/metrics')
+
+
+SCENARIOS = {
+    'import': None,
+    'index': _prepare_index,
+    'merge': _prepare_merge,
+    'icon': _prepare_icon,
+    'file_diff': _prepare_file_diff,
+    'metrics': _prepare_metrics,
+}
+
+
+def _rss_mb():
+    """进程的峰值常驻内存（MB），不支持的平台返回 None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位是 KB，macOS 是字节
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+def run_scenario(name: str) -> dict:
+    """在当前进程中执行一个场景，只能在全新的子进程里调用"""
+    started = time.perf_counter()
+    from app import app
+    import_seconds = time.perf_counter() - started
+    loaded_at_import = [m for m in HEAVY_MODULES if m in sys.modules]
+
+    result = {'scenario': name, 'import_ms': import_seconds * 1000, 'request_ms': None, 'status': None}
+    prepare = SCENARIOS[name]
+    if prepare is not None:
+        send = prepare()
+        client = app.test_client()
+        started = time.perf_counter()
+        response = send(client)
+        response.get_data()
+        result['request_ms'] = (time.perf_counter() - started) * 1000
+        result['status'] = response.status_code
+    result['rss_mb'] = _rss_mb()
+    result['heavy_at_import'] = loaded_at_import
+    result['heavy_after_request'] = [m for m in HEAVY_MODULES if m in sys.modules]
+    return result
+
+
+def _run_in_subprocess(name: str) -> dict:
+    env = dict(os.environ, WORKER_PROCESSES='0', METRICS_SAMPLE_RATE='0')
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', name],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def top_imports(count: int):
+    """用 -X importtime 统计 import app 时累计耗时最多的模块"""
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app'],
+        cwd=ROOT, env=dict(os.environ, WORKER_PROCESSES='0'), capture_output=True, text=True, check=True
+    ).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        rows.append((int(cumulative_us), int(self_us), module.rstrip()))
+    rows.sort(reverse=True)
+    return rows[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='flask_utils 启动开销报告')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--scenarios', help='只运行这些场景（逗号分隔）')
+    parser.add_argument('--top', type=int, default=0, help='列出 import app 耗时最多的 N 个模块')
+    parser.add_argument('--output', help='把结果写入 JSON 文件')
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_scenario(args.child)))
+        return
+
+    names = args.scenarios.split(',') if args.scenarios else list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f'未知场景: {", ".join(unknown)}')
+
+    results = []
+    print(f'{"场景":<12}{"import(ms)":>12}{"首个请求(ms)":>14}{"RSS(MB)":>10}  加载的重量级模块')
+    for name in names:
+        result = _run_in_subprocess(name)
+        results.append(result)
+        request_ms = f'{result["request_ms"]:.1f}' if result['request_ms'] is not None else '-'
+        rss = f'{result["rss_mb"]:.1f}' if result['rss_mb'] is not None else '-'
+        print(f'{name:<12}{result["import_ms"]:>12.1f}{request_ms:>14}{rss:>10}  '
+              f'{", ".join(result["heavy_after_request"]) or "-"}')
+
+    if args.top:
+        print(f'\nimport app 累计耗时最多的 {args.top} 个模块:')
+        for cumulative_us, self_us, module in top_imports(args.top):
+            print(f'{cumulative_us / 1000:>10.1f} ms  {module}')
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
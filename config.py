@@ -4,3 +4,90 @@ import os
 class Config:
     MAX_CONTENT_LENGTH = 64 * 1024 * 1024  # 64MB
     SECRET_KEY = os.getenv('SECRET_KEY', 'dev_key')
+    # 多图拼接输出画布的最大像素数，超出时按比例缩小（None 表示不限制）
+    MERGE_MAX_OUTPUT_PIXELS = 36 * 1000 * 1000
+    # 多图拼接最多接受的图片数，超过 6 张时拼成联系表（grid 网格或 masonry 瀑布流）
+    MULTI_MERGE_MAX_IMAGES = 500
+    # 联系表：每个格子的宽度、输出的最大像素数，以及超过多少像素时把画布放到磁盘临时文件中
+    CONTACT_SHEET_TILE_WIDTH = 320
+    CONTACT_SHEET_MAX_OUTPUT_PIXELS = 200 * 1000 * 1000
+    CONTACT_SHEET_MEMMAP_PIXELS = 32 * 1000 * 1000
+    # 各路由上传图片的像素预算，只读取文件头检查，超出时在解码之前拒绝：单张上限、所有图片合计上限
+    PIXEL_BUDGETS = {
+        'merge': {'image': 50 * 1000 * 1000, 'total': 100 * 1000 * 1000},
+        'multi_merge': {'image': 50 * 1000 * 1000, 'total': 300 * 1000 * 1000},
+        'contact_sheet': {'image': 50 * 1000 * 1000, 'total': 2000 * 1000 * 1000},
+        'icon': {'image': 80 * 1000 * 1000, 'total': 80 * 1000 * 1000},
+    }
+    # 各路由的输出编码（见 utils/encoders.py）：format 为 JPEG/WEBP/AVIF/PNG，quality 为质量，
+    # effort 为 0（最快）到 6（最慢、文件最小），progressive/optimize 为 JPEG 渐进式和霍夫曼表优化，
+    # budget_ms 为编码时间预算，预计超出时自动降低编码强度。图标只能是 PNG，只有 effort/optimize 起作用
+    ENCODER_PROFILES = {
+        'merge': {'format': 'JPEG', 'quality': 90},
+        'multi_merge': {'format': 'JPEG', 'quality': 90},
+        'contact_sheet': {'format': 'JPEG', 'quality': 85, 'budget_ms': 2000},
+        'icon': {'format': 'PNG', 'effort': 3},
+        'visual_diff': {'format': 'JPEG', 'quality': 90},
+    }
+    # 双图对比的差异模式：任一颜色通道的差值超过该值才算变化（0-255），可以忽略 JPEG 压缩带来的细微差别
+    VISUAL_DIFF_THRESHOLD = 16
+    # 差异模式先对齐再比较：自动检测的整体平移（滚动、移动）最多多少像素，0 为不对齐
+    VISUAL_DIFF_MAX_SHIFT = 64
+    # 多图拼接前用感知哈希（dHash）查找重复或几乎相同的图片：哈希最多相差几位算重复（64 位中），
+    # 文件内容到哈希的持久索引（SQLite，未设置时放在 Flask 的 instance 目录中）及其最大条目数
+    DEDUP_MAX_DISTANCE = 4
+    DEDUP_INDEX_PATH = os.getenv('FLASK_UTILS_DEDUP_INDEX')
+    DEDUP_INDEX_MAX_ENTRIES = 100000
+    # 多图拼接的合成方式：'pillow'（逐张 paste）或 'numpy'（写入预分配数组），两者输出相同，
+    # 基准测试中 pillow 更快，所以默认使用 pillow
+    MERGE_COMPOSE_BACKEND = os.getenv('MERGE_COMPOSE_BACKEND', 'pillow')
+    # Icon 制作的上传会话（原图解码后的金字塔）在内存中保留的总字节数
+    ICON_SESSION_MAX_BYTES = 512 * 1024 * 1024
+    # 批量生成图标：最多处理的图片数（包括 ZIP 中的文件），以及解压后的总字节数上限
+    ICON_BATCH_MAX_IMAGES = 2000
+    ICON_BATCH_MAX_BYTES = 2 * 1024 * 1024 * 1024
+    # 文件对比的结果（hunk 索引和两边被 hunk 覆盖的行）保存在磁盘临时文件中，页面滚动时按需读取，
+    # 这是这些临时文件的总字节数上限，超出时淘汰最久未用的结果
+    DIFF_STORE_MAX_BYTES = 1024 * 1024 * 1024
+    # 压缩包目录树对比：每个压缩包最多的文件数，以及逐行比较的单个文件上限（更大的文件只比较大小和 CRC32）
+    TREE_DIFF_MAX_ENTRIES = 20000
+    TREE_DIFF_MAX_FILE_BYTES = 32 * 1024 * 1024
+    # 上传的文件超过这个大小时转存到磁盘临时文件（目录为 UPLOAD_SPOOL_DIR，未设置时使用系统临时目录），
+    # 处理时映射（mmap）到内存而不是读成 bytes
+    UPLOAD_SPOOL_THRESHOLD = 1024 * 1024
+    UPLOAD_SPOOL_DIR = os.getenv('FLASK_UTILS_UPLOAD_DIR')
+    # 各路由同时处理的上传数据在内存中占用的字节数上限（所有并发请求合计，按请求大小计算），
+    # 超出时返回 503 让客户端稍后重试；解码后的像素另有 PIXEL_BUDGETS 限制。文件对比解码后的行比原文件大几倍，预算相应更大
+    UPLOAD_MEMORY_BUDGETS = {
+        'merge': 256 * 1024 * 1024,
+        'multi_merge': 512 * 1024 * 1024,
+        'icon': 256 * 1024 * 1024,
+        'icon_batch': 256 * 1024 * 1024,
+        'file_diff': 512 * 1024 * 1024,
+    }
+    # 处理结果（拼接图片、ICO 等）在内存中保留的总字节数
+    RESULT_STORE_MAX_BYTES = 256 * 1024 * 1024
+    # 结果按内容寻址，内容不会变化，可以让浏览器长期缓存（秒）
+    RESULT_MAX_AGE = 24 * 3600
+    # 结果缓存：内存上限，以及可选的磁盘缓存目录和磁盘上限
+    CACHE_MAX_BYTES = 128 * 1024 * 1024
+    CACHE_DIR = os.getenv('FLASK_UTILS_CACHE_DIR')
+    CACHE_DISK_MAX_BYTES = 1024 * 1024 * 1024
+    # 图片处理进程池：进程数（0 表示在请求线程内执行）、排队任务上限、单个任务超时（秒）
+    WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', os.cpu_count() or 1))
+    WORKER_QUEUE_SIZE = 16
+    JOB_TIMEOUT = 120
+    # 队列已满时告诉客户端多少秒后重试
+    WORKER_RETRY_AFTER = 5
+    # 多图拼接后台任务：执行线程数、排队任务上限、结束后保留状态的时间（秒）
+    ASYNC_JOB_THREADS = 4
+    ASYNC_JOB_MAX_PENDING = 32
+    ASYNC_JOB_TTL = 600
+    # 生产环境服务（serve.py，waitress）：监听地址、端口、处理请求的线程数，
+    # 以及停止时等待正在处理的请求完成的最长时间（秒）
+    SERVER_HOST = os.getenv('SERVER_HOST', '0.0.0.0')
+    SERVER_PORT = int(os.getenv('SERVER_PORT', 5080))
+    SERVER_THREADS = int(os.getenv('SERVER_THREADS', 16))
+    SERVER_SHUTDOWN_TIMEOUT = 30
+    # 记录各处理阶段耗时的请求比例（0 关闭，1 记录全部），结果见 /metrics
+    METRICS_SAMPLE_RATE = float(os.getenv('METRICS_SAMPLE_RATE', 1.0))
@@ -0,0 +1,99 @@
+# 生产环境入口：waitress 多线程处理请求，图片处理交给进程池，可以用满所有 CPU 核心
+# 用法：python serve.py（监听地址、端口、线程数见 config.py 中的 SERVER_*，也可以用环境变量设置）
+import logging
+import signal
+import threading
+import time
+
+from waitress import create_server, wasyncore
+from waitress.channel import HTTPChannel
+from waitress.server import BaseWSGIServer
+
+from app import app, worker_pool, job_manager
+from utils.warmup import warm_up
+
+logger = logging.getLogger('serve')
+
+# 收到 SIGTERM / SIGINT 后设置，事件循环在下一轮检查
+_stopping = threading.Event()
+
+
+def _handle_signal(signum, frame):
+    _stopping.set()
+
+
+def _socket_map(server):
+    # 监听多个地址时 create_server 返回 MultiSocketServer，它的连接表是 map
+    return server.map if hasattr(server, 'map') else server._map
+
+
+def _run_until(server, done):
+    """运行 waitress 的事件循环，直到 done() 为真"""
+    socket_map = _socket_map(server)
+    while socket_map and not done():
+        wasyncore.loop(timeout=server.adj.asyncore_loop_timeout, map=socket_map,
+                       use_poll=server.adj.asyncore_use_poll, count=1)
+
+
+def _stop_accepting(socket_map):
+    """关闭监听的 socket，已经建立的连接不受影响"""
+    for dispatcher in list(socket_map.values()):
+        if isinstance(dispatcher, BaseWSGIServer):
+            dispatcher.accepting = False
+            # BaseWSGIServer.close 还会关闭唤醒事件循环用的 trigger，排空期间仍然需要它
+            wasyncore.dispatcher.close(dispatcher)
+
+
+def _drained(socket_map) -> bool:
+    """没有正在处理的请求，响应也都已经写到 socket"""
+    return not any(
+        channel.requests or channel.total_outbufs_len
+        for channel in list(socket_map.values())
+        if isinstance(channel, HTTPChannel)
+    )
+
+
+def preload():
+    """启动服务前预热主进程和所有工作进程"""
+    started = time.perf_counter()
+    warm_up(app.config['ENCODER_PROFILES'])
+    worker_pool.start()
+    logger.info('预热完成（%d 个工作进程），用时 %.2f 秒', worker_pool.processes, time.perf_counter() - started)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    preload()
+
+    server = create_server(
+        app,
+        host=app.config['SERVER_HOST'],
+        port=app.config['SERVER_PORT'],
+        threads=app.config['SERVER_THREADS'],
+        ident='flask_utils'
+    )
+    signal.signal(signal.SIGTERM, _handle_signal)
+    signal.signal(signal.SIGINT, _handle_signal)
+    logger.info('Server running on http://localhost:%d/ （%d 个线程）',
+                app.config['SERVER_PORT'], app.config['SERVER_THREADS'])
+    socket_map = _socket_map(server)
+    try:
+        _run_until(server, _stopping.is_set)
+    finally:
+        # 先停止接受新连接；事件循环继续运行，直到正在处理的请求都已经把响应发送完
+        # （或者超过 SERVER_SHUTDOWN_TIMEOUT），最后才关闭连接、进程池和后台任务
+        logger.info('正在停止服务...')
+        _stop_accepting(socket_map)
+        deadline = time.monotonic() + app.config['SERVER_SHUTDOWN_TIMEOUT']
+        _run_until(server, lambda: _drained(socket_map) or time.monotonic() >= deadline)
+        if not _drained(socket_map):
+            logger.warning('等待超时，仍有请求未处理完')
+        server.task_dispatcher.shutdown(cancel_pending=True, timeout=max(deadline - time.monotonic(), 0))
+        wasyncore.close_all(socket_map)
+        job_manager.shutdown()
+        worker_pool.shutdown()
+        logger.info('服务已停止')
+
+
+if __name__ == '__main__':
+    main()
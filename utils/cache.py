@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+
+def make_cache_key(operation: str, blobs: List[bytes], params: Dict[str, Any]) -> str:
+    """根据操作名、输入文件内容和处理参数计算缓存键"""
+    h = hashlib.sha256(operation.encode('utf-8'))
+    for blob in blobs:
+        h.update(len(blob).to_bytes(8, 'big'))
+        h.update(blob)
+    h.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _value_size(value: Any) -> int:
+    """估算缓存值占用的字节数（bytes 或 {名称: bytes}）"""
+    if isinstance(value, dict):
+        return sum(len(v) for v in value.values())
+    return len(value)
+
+
+class ResultCache:
+    """处理结果缓存：内存 LRU 一级缓存 + 可选的磁盘二级缓存
+
+    值可以是 bytes 或 {名称: bytes}。磁盘目录总大小超过 disk_max_bytes 时
+    按最后访问时间淘汰最旧的文件。
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: Optional[str] = None,
+                 disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._size = 0
+        self._disk_size = 0
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk_size = sum(entry.stat().st_size for entry in os.scandir(disk_dir)
+                                  if entry.is_file())
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return value
+
+        value = self._disk_get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+        self._memory_set(key, value)
+        return value
+
+    def set(self, key: str, value: Any):
+        self._memory_set(key, value)
+        self._disk_set(key, value)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'items': len(self._items),
+                'bytes': self._size,
+                'disk_bytes': self._disk_size,
+            }
+
+    def _memory_set(self, key: str, value: Any):
+        size = _value_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return
+            self._items[key] = value
+            self._size += size
+            while self._size > self.max_bytes:
+                _, old_value = self._items.popitem(last=False)
+                self._size -= _value_size(old_value)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key + '.pkl')
+
+    def _disk_get(self, key: str) -> Optional[Any]:
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path)  # 记录访问时间，用于淘汰
+            return value
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def _disk_set(self, key: str, value: Any):
+        if not self.disk_dir or not self.disk_max_bytes:
+            return
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+        # 先写临时文件再改名，避免并发读取到写了一半的文件
+        fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            self._disk_size += size
+            if self._disk_size <= self.disk_max_bytes:
+                return
+        self._disk_evict()
+
+    def _disk_evict(self):
+        """删除最久未访问的文件，直到磁盘缓存回到上限以内"""
+        entries = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.is_file() and entry.name.endswith('.pkl'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        with self._lock:
+            self._disk_size = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if self._disk_size <= self.disk_max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                    self._disk_size -= size
+                except OSError:
+                    pass
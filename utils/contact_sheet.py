@@ -0,0 +1,224 @@
+import io
+import math
+import mmap
+import os
+import statistics
+import tempfile
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from utils import metrics
+from utils.cache import ResultCache, make_cache_key
+from utils.encoders import encode_image, max_dimension_for
+from utils.image_processor import Box, decode_for_tile, has_alpha, resize_tile
+from utils.merge_engine import draw_labels
+from utils.worker_pool import WorkerPool
+
+# 支持的布局：grid 为固定行列，masonry 为等宽列的瀑布流
+LAYOUTS = ('grid', 'masonry')
+# 每个格子的默认宽度，以及格子之间、格子与边缘的间距
+TILE_WIDTH = 320
+GAP = 8
+BACKGROUND = (255, 255, 255)
+# memmap 画布每次填充背景色的行数，填完即从内存中释放
+FILL_ROWS = 256
+
+# 输入图片：文件路径（进程池中使用，不复制内容）或内存中的数据
+Source = Union[str, bytes]
+
+
+def _default_cols(count: int) -> int:
+    return max(1, math.ceil(math.sqrt(count)))
+
+def plan_grid(sizes: List[Tuple[int, int]], cols: int, tile_width: int,
+              gap: int = GAP) -> Tuple[Tuple[int, int], List[Box]]:
+    """rows×cols 网格：格子大小相同（高宽比取所有图片的中位数），图片等比缩放后居中"""
+    rows = math.ceil(len(sizes) / cols)
+    cell_height = max(1, round(tile_width * statistics.median(h / w for w, h in sizes)))
+    boxes = []
+    for i, (w, h) in enumerate(sizes):
+        ratio = min(tile_width / w, cell_height / h)
+        tw, th = max(1, round(w * ratio)), max(1, round(h * ratio))
+        row, col = divmod(i, cols)
+        x = gap + col * (tile_width + gap) + (tile_width - tw) // 2
+        y = gap + row * (cell_height + gap) + (cell_height - th) // 2
+        boxes.append((x, y, tw, th))
+    canvas_size = (gap + cols * (tile_width + gap), gap + rows * (cell_height + gap))
+    return canvas_size, boxes
+
+def plan_masonry(sizes: List[Tuple[int, int]], cols: int, tile_width: int,
+                 gap: int = GAP) -> Tuple[Tuple[int, int], List[Box]]:
+    """瀑布流：所有图片缩放到相同宽度，依次放进当前最短的一列"""
+    heights = [gap] * cols
+    boxes = []
+    for w, h in sizes:
+        th = max(1, round(h * tile_width / w))
+        col = heights.index(min(heights))
+        boxes.append((gap + col * (tile_width + gap), heights[col], tile_width, th))
+        heights[col] += th + gap
+    canvas_size = (gap + cols * (tile_width + gap), max(heights))
+    return canvas_size, boxes
+
+def plan_contact_sheet(sizes: List[Tuple[int, int]], layout: str = 'grid', cols: Optional[int] = None,
+                       tile_width: int = TILE_WIDTH, max_output_pixels: Optional[int] = None,
+                       max_dimension: int = 65500) -> Tuple[Tuple[int, int], List[Box]]:
+    """规划任意数量图片的布局，输出超出像素上限或输出格式的尺寸上限时缩小格子宽度"""
+    if layout not in LAYOUTS:
+        raise ValueError(f'不支持的布局: {layout}')
+    planner = plan_grid if layout == 'grid' else plan_masonry
+    cols = min(cols or _default_cols(len(sizes)), len(sizes))
+
+    canvas_size, boxes = planner(sizes, cols, tile_width)
+    factor = 1.0
+    if max_output_pixels and canvas_size[0] * canvas_size[1] > max_output_pixels:
+        factor = math.sqrt(max_output_pixels / (canvas_size[0] * canvas_size[1]))
+    factor = min(factor, max_dimension / max(canvas_size))
+    if factor < 1.0:
+        canvas_size, boxes = planner(sizes, cols, max(1, int(tile_width * factor)))
+    return canvas_size, boxes
+
+def _open(source: Source) -> Image.Image:
+    return Image.open(source if isinstance(source, str) else io.BytesIO(source))
+
+def _load_tile(source: Source, size: Tuple[int, int]) -> Image.Image:
+    """解码一张图片并缩放到格子尺寸，透明部分铺上背景色"""
+    tile = decode_for_tile(_open(source), size, 'contact_sheet')
+    tile = resize_tile(tile, size, 'contact_sheet')
+    if has_alpha(tile):
+        background = Image.new('RGB', size, BACKGROUND)
+        background.paste(tile, mask=tile.getchannel('A'))
+        tile = background
+    return tile
+
+def _release_rows(canvas: np.memmap, start: int, end: int) -> int:
+    """把 memmap 画布 [start, end) 行刷回磁盘并从进程内存中丢掉，返回实际释放到的行
+
+    flush 只是把脏页写回文件，页面仍然算在 RSS 里；madvise(MADV_DONTNEED) 之后
+    再访问会从文件重新读入。只释放整页，跨页的那一行留到下一次。
+    """
+    row_bytes = canvas.strides[0]
+    begin = start * row_bytes // mmap.PAGESIZE * mmap.PAGESIZE
+    stop = min(end, canvas.shape[0]) * row_bytes // mmap.PAGESIZE * mmap.PAGESIZE
+    if stop <= begin:
+        return start
+    canvas._mmap.flush(begin, stop - begin)
+    if hasattr(mmap, 'MADV_DONTNEED'):
+        canvas._mmap.madvise(mmap.MADV_DONTNEED, begin, stop - begin)
+    return stop // row_bytes
+
+def _fill_background(canvas: np.memmap):
+    """分段填充背景色，每段填完即释放，不会让整张画布同时留在内存中"""
+    released = 0
+    for top in range(0, canvas.shape[0], FILL_ROWS):
+        canvas[top:top + FILL_ROWS, :, :3] = BACKGROUND
+        released = _release_rows(canvas, released, top + FILL_ROWS)
+    _release_rows(canvas, released, canvas.shape[0])
+
+def _write_tiles(sources: List[Source], boxes: List[Box], canvas, labels: Optional[List[str]],
+                 progress: Optional[Callable]):
+    """按从上到下的顺序逐张解码并写入画布（Image 或 memmap 数组），写完立即释放"""
+    order = sorted(range(len(sources)), key=lambda i: (boxes[i][1], boxes[i][0]))
+    is_array = isinstance(canvas, np.ndarray)
+    released = 0
+    for n, i in enumerate(order):
+        x, y, w, h = boxes[i]
+        if progress:
+            progress('decode', n + 1, len(order))
+        tile = _load_tile(sources[i], (w, h))
+        if labels:
+            draw_labels(tile, [(0, 0, w, h)], [labels[i]])
+        with metrics.stage('contact_sheet', 'paste'):
+            if is_array:
+                # 之后的格子都从 y 或更靠下的位置开始，y 以上的行已经写完，写回磁盘并从内存中丢掉
+                released = _release_rows(canvas, released, y)
+                canvas[y:y + h, x:x + w, :3] = np.asarray(tile)
+            else:
+                canvas.paste(tile, (x, y))
+        del tile
+
+def _encode_sheet(sheet: Image.Image, encoder: Optional[Dict[str, Any]],
+                  progress: Optional[Callable]) -> bytes:
+    if progress:
+        progress('encode')
+    return encode_image(sheet, encoder, 'contact_sheet')
+
+def render_contact_sheet(sources: List[Source], layout: str = 'grid', cols: Optional[int] = None,
+                         tile_width: int = TILE_WIDTH, max_output_pixels: Optional[int] = None,
+                         memmap_pixels: Optional[int] = None, encoder: Optional[Dict[str, Any]] = None,
+                         labels: Optional[List[str]] = None, progress: Optional[Callable] = None) -> bytes:
+    """把任意数量的图片拼成一张联系表，按 encoder 编码，labels 为每张图片左上角的文字
+
+    只读取图片头信息规划布局，然后逐张解码、缩放、写入画布，同一时间只持有一张解码后的图片。
+    输出超过 memmap_pixels 像素时画布放在临时文件映射的 RGBX 数组里，
+    每写完一行格子就刷回磁盘并释放映射的页面，内存占用只和一行格子有关，而与图片总数无关。
+    sources 为文件路径时按需读取，不需要把所有输入都放在内存中。
+    """
+    sizes = []
+    for source in sources:
+        with _open(source) as img:
+            sizes.append(img.size)
+    metrics.count('flask_utils_input_pixels_total', sum(w * h for w, h in sizes), operation='contact_sheet')
+    metrics.count('flask_utils_operations_total', 1, operation='contact_sheet')
+
+    canvas_size, boxes = plan_contact_sheet(sizes, layout, cols, tile_width, max_output_pixels,
+                                            max_dimension_for(encoder))
+    width, height = canvas_size
+
+    if memmap_pixels is not None and width * height > memmap_pixels:
+        with tempfile.TemporaryFile() as backing:
+            canvas = np.memmap(backing, dtype=np.uint8, mode='w+', shape=(height, width, 4))
+            _fill_background(canvas)
+            _write_tiles(sources, boxes, canvas, labels, progress)
+            canvas.flush()
+            # 直接映射数组的内存，编码时不再复制整张画布
+            sheet = Image.frombuffer('RGBX', canvas_size, canvas, 'raw', 'RGBX', 0, 1)
+            result = _encode_sheet(sheet, encoder, progress)
+            del sheet, canvas
+    else:
+        sheet = Image.new('RGB', canvas_size, BACKGROUND)
+        _write_tiles(sources, boxes, sheet, labels, progress)
+        result = _encode_sheet(sheet, encoder, progress)
+
+    metrics.count('flask_utils_output_bytes_total', len(result), operation='contact_sheet')
+    return result
+
+def process_contact_sheet(files: List[Tuple[str, any]], layout: str = 'grid', cols: Optional[int] = None,
+                          tile_width: int = TILE_WIDTH, max_output_pixels: Optional[int] = None,
+                          memmap_pixels: Optional[int] = None, encoder: Optional[Dict[str, Any]] = None,
+                          labels: Optional[List[str]] = None, cache: Optional[ResultCache] = None,
+                          pool: Optional[WorkerPool] = None, progress: Optional[Callable] = None,
+                          spool_dir: Optional[str] = None) -> bytes:
+    """与 process_images 相同的缓存和进程池处理，用于超过 6 张图片的拼接
+
+    输入写到 spool_dir 下的临时文件里，只把路径交给进程池，工作进程按需逐张读取，
+    不会把所有图片的内容复制进参数、在 web 进程和工作进程里各留一份。
+    """
+    from utils.uploads import upload_buffers
+
+    with tempfile.TemporaryDirectory(dir=spool_dir) as directory:
+        with upload_buffers([file for filename, file in files]) as buffers:
+            cache_key = None
+            if cache is not None:
+                cache_key = make_cache_key('contact_sheet', buffers, {
+                    'layout': layout, 'cols': cols, 'tile_width': tile_width, 'max_output_pixels': max_output_pixels,
+                    'encoder': encoder, 'labels': labels
+                })
+                cached = cache.get(cache_key)
+                if cached is not None:
+                    return cached
+            paths = []
+            for i, buffer in enumerate(buffers):
+                paths.append(os.path.join(directory, str(i)))
+                with open(paths[-1], 'wb') as spool:
+                    spool.write(buffer)
+
+        args = (paths, layout, cols, tile_width, max_output_pixels, memmap_pixels, encoder, labels, progress)
+        if pool is not None:
+            result = pool.run(render_contact_sheet, *args, wait=progress is not None)
+        else:
+            result = render_contact_sheet(*args)
+    if cache_key is not None:
+        cache.set(cache_key, result)
+    return result
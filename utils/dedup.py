@@ -0,0 +1,159 @@
+import hashlib
+import io
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import imagehash
+from PIL import Image
+
+from utils import metrics
+from utils.worker_pool import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+# dHash 的边长：8 表示 64 位哈希
+HASH_SIZE = 8
+
+# 两张图片的哈希最多相差几位时视为重复（0 只认完全相同的画面）
+MAX_DISTANCE = 4
+
+# 多图拼接的去重方式：off 不检查，flag 只提示，drop 去掉重复的图片（每组保留按文件名排序的第一张）
+DEDUP_MODES = ('off', 'flag', 'drop')
+
+# 计算哈希前把图片缩小到的边长；dHash 只需要 9×8 个像素，JPEG 按这个尺寸 draft 解码
+REDUCED_SIZE = 64
+
+
+def perceptual_hash(blob: bytes, hash_size: int = HASH_SIZE) -> str:
+    """图片的差值哈希（dHash），十六进制字符串
+
+    JPEG 用 draft 按 1/2～1/8 的比例解码，其它格式解码后用 reduce 缩小，不需要完整尺寸的缩放。
+    """
+    img = Image.open(io.BytesIO(blob))
+    img.draft('L', (REDUCED_SIZE, REDUCED_SIZE))
+    img.thumbnail((REDUCED_SIZE, REDUCED_SIZE), Image.Resampling.BOX, reducing_gap=2.0)
+    return str(imagehash.dhash(img, hash_size))
+
+
+def hash_images(blobs: List[bytes]) -> List[Optional[str]]:
+    """计算一组图片的哈希，在工作进程中执行；无法解码的图片为 None（不参与去重）"""
+    hashes = []
+    with metrics.stage('dedup', 'hash'):
+        for blob in blobs:
+            try:
+                hashes.append(perceptual_hash(blob))
+            except Exception:
+                hashes.append(None)
+    metrics.count('flask_utils_operations_total', len(blobs), operation='dedup')
+    return hashes
+
+
+def group_duplicates(hashes: Sequence[Optional[str]], max_distance: int = MAX_DISTANCE) -> List[List[int]]:
+    """按下标顺序把图片分组：每组的第一张为保留的代表，之后的图片与某组代表的哈希相差不超过
+    max_distance 位时归入该组（有多个时取相差最少的）
+
+    只和代表比较，不会因为 A 像 B、B 像 C 就把与 A 相差很多的 C 也当作 A 的重复。
+    返回至少有两张图片的组，组内和组之间都按下标排列。
+    """
+    groups = []  # [(代表的哈希, [下标])]
+    for i, h in enumerate(hashes):
+        if h is None:
+            continue
+        value = int(h, 16)
+        best = None
+        for representative, members in groups:
+            distance = bin(representative ^ value).count('1')
+            if distance <= max_distance and (best is None or distance < best[0]):
+                best = (distance, members)
+        if best is None:
+            groups.append((value, [i]))
+        else:
+            best[1].append(i)
+    return [members for representative, members in groups if len(members) > 1]
+
+
+class HashIndex:
+    """文件内容（sha256）到感知哈希的持久索引，保存在 SQLite 中
+
+    同一个文件再次上传时（包括之前的请求）直接查到哈希，不需要解码。
+    条目超过 max_entries 时删除最早写入的。
+    """
+
+    def __init__(self, path: str, max_entries: int = 100000):
+        self.max_entries = max_entries
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS hashes (digest BLOB PRIMARY KEY, phash TEXT NOT NULL)')
+        self._lock = threading.Lock()
+
+    def get_many(self, digests: Iterable[bytes]) -> Dict[bytes, str]:
+        digests = list(set(digests))
+        result = {}
+        with self._lock:
+            # SQLite 一条语句的参数个数有限，分批查询
+            for start in range(0, len(digests), 500):
+                batch = digests[start:start + 500]
+                rows = self._conn.execute(
+                    f'SELECT digest, phash FROM hashes WHERE digest IN ({",".join("?" * len(batch))})', batch
+                )
+                result.update(rows)
+        return result
+
+    def put_many(self, items: Dict[bytes, str]):
+        if not items:
+            return
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                self._conn.executemany('INSERT OR REPLACE INTO hashes (digest, phash) VALUES (?, ?)', items.items())
+                # rowid 按写入顺序递增，只保留最近写入的 max_entries 条
+                self._conn.execute(
+                    'DELETE FROM hashes WHERE rowid <= (SELECT MAX(rowid) FROM hashes) - ?', (self.max_entries,)
+                )
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def find_duplicates(files: List[Tuple[str, object]], index: Optional[HashIndex] = None,
+                    pool: Optional[WorkerPool] = None, max_distance: int = MAX_DISTANCE,
+                    wait: bool = False) -> List[List[int]]:
+    """找出一组上传的图片（[(文件名, 文件对象)]）中重复或几乎相同的，返回重复组（下标）
+
+    先按文件内容的 sha256 查索引，只有没见过的文件才解码计算哈希（交给进程池，wait 同 WorkerPool.run）。
+    """
+    from utils.uploads import upload_buffers
+
+    with upload_buffers([file for filename, file in files]) as buffers:
+        digests = [hashlib.sha256(buffer).digest() for buffer in buffers]
+        known = index.get_many(digests) if index is not None else {}
+        # 同一个请求中内容完全相同的文件只计算一次
+        missing = {}
+        for digest, buffer in zip(digests, buffers):
+            if digest not in known and digest not in missing:
+                missing[digest] = bytes(buffer)
+    metrics.count('flask_utils_dedup_index_hits_total', len(digests) - len(missing))
+
+    if missing:
+        blobs = list(missing.values())
+        hashes = pool.run(hash_images, blobs, wait=wait) if pool is not None else hash_images(blobs)
+        computed = {digest: h for digest, h in zip(missing, hashes) if h is not None}
+        known.update(computed)
+        if index is not None:
+            try:
+                index.put_many(computed)
+            except sqlite3.Error:
+                # 索引只是加速，写入失败不影响这次的结果
+                logger.exception('写入哈希索引失败')
+    return group_duplicates([known.get(digest) for digest in digests], max_distance)
@@ -0,0 +1,415 @@
+import bisect
+import codecs
+import hashlib
+import html
+import io
+import re
+from difflib import SequenceMatcher
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import chardet
+
+# (tag, i1, i2, j1, j2)，和 difflib.SequenceMatcher.get_opcodes() 的格式一致
+Opcode = Tuple[str, int, int, int, int]
+
+# 表格中的一行：(左侧行号, 左侧 HTML, 左侧样式, 右侧行号, 右侧 HTML, 右侧样式)，没有对应行时行号为 ''
+DiffRow = Tuple[Any, str, str, Any, str, str]
+
+# 没有唯一行可以作为锚点的区间，两边行数乘积不超过该值时才逐行精确比较（difflib 是平方复杂度）
+EXACT_DIFF_LIMIT = 1000 * 1000
+
+# 更大的区间改用连续几行组成的窗口作锚点（重复的行很多时，连续几行的组合通常仍然唯一），
+# 窗口从 ANCHOR_WIDTHS 中依次尝试；都找不到时用 Myers 算法，编辑数超过 MYERS_MAX_EDITS 才整段视为替换
+ANCHOR_WIDTHS = (4, 16, 64)
+MYERS_MAX_EDITS = 1000
+
+# 编码检测和二进制判断只看文件开头这么多字节
+SAMPLE_SIZE = 64 * 1024
+
+# Latin-1 文本被误解码成 GB18030 时的特征：夹在两个 ASCII 字母中间的汉字（"Gr鲞e"）或私用区字符
+_MISDECODED_GB18030 = re.compile('[A-Za-z][^\x00-\x7f][A-Za-z]|[\ue000-\uf8ff]')
+_NON_ASCII = re.compile('[^\x00-\x7f]')
+
+# chardet 的置信度低于该值时不采用它的猜测：单字节编码几乎能解码任何字节，猜错了只会得到乱码
+MIN_CONFIDENCE = 0.3
+
+# 二进制比较时逐块查找第一个不同的位置
+COMPARE_BLOCK_SIZE = 1024 * 1024
+
+_BOMS = (
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+
+def is_binary(data: Any) -> bool:
+    """开头的样本中有 NUL 字节（且不是 UTF-16/32 文本）就当作二进制文件"""
+    sample = bytes(data[:SAMPLE_SIZE])
+    if any(sample.startswith(bom) for bom, _ in _BOMS):
+        return False
+    return b'\x00' in sample
+
+
+def _decodes(sample: bytes, encoding: str) -> bool:
+    try:
+        codecs.getincrementaldecoder(encoding)().decode(sample, final=len(sample) < SAMPLE_SIZE)
+        return True
+    except (UnicodeDecodeError, LookupError):
+        return False
+
+
+def _looks_like_gb18030(sample: bytes) -> bool:
+    """样本能严格按 GB18030 解码，并且不像是碰巧能解码的 Latin-1 文本
+
+    Latin-1 的重音字母后面跟着字母时正好组成合法的双字节，这样解码出的字符超过非 ASCII 字符的四分之一时不采用。
+    """
+    try:
+        text = codecs.getincrementaldecoder('gb18030')().decode(sample, final=len(sample) < SAMPLE_SIZE)
+    except UnicodeDecodeError:
+        return False
+    return len(_MISDECODED_GB18030.findall(text)) * 4 <= len(_NON_ASCII.findall(text))
+
+
+def _is_single_byte(encoding: str) -> bool:
+    """每个字节都单独解码成一个字符的编码（cp125x、latin-1、koi8-r 等），未知的编码也按单字节处理"""
+    try:
+        return len(bytes(range(0x80, 0x100)).decode(encoding, errors='replace')) == 0x80
+    except LookupError:
+        return True
+
+
+def detect_encoding(data: Any) -> str:
+    """从开头的样本判断文本编码：BOM → UTF-8 → chardet（多字节）→ GB18030 → chardet（单字节）→ cp1252 / latin-1
+
+    单字节编码能解码几乎所有字节，所以先严格按 GB18030 试一次，再考虑 chardet 猜的单字节编码；
+    chardet 置信度低于 MIN_CONFIDENCE 的猜测不采用，按最常见的 cp1252（不能解码时 latin-1）处理。
+
+    >>> detect_encoding('café naïve résumé\\n'.encode('latin-1'))
+    'cp1252'
+    >>> detect_encoding(("print('hello') # 改变\\n" + 'x = 1\\n' * 50).encode('gbk'))
+    'gb18030'
+    """
+    sample = bytes(data[:SAMPLE_SIZE])
+    for bom, encoding in _BOMS:
+        if sample.startswith(bom):
+            return encoding
+    # 样本末尾可能截断了一个多字节字符，增量解码器会忽略这一点
+    if _decodes(sample, 'utf-8'):
+        return 'utf-8'
+    guess = chardet.detect(sample)
+    encoding = (guess.get('encoding') or '').lower()
+    # GB2312 / GBK 统一按超集 GB18030 解码，避免生僻字出错
+    if encoding in ('gb2312', 'gbk'):
+        encoding = 'gb18030'
+    if encoding and encoding != 'gb18030' and (guess.get('confidence') or 0) < MIN_CONFIDENCE:
+        encoding = ''
+    if encoding and not _is_single_byte(encoding) and _decodes(sample, encoding):
+        return encoding
+    if _looks_like_gb18030(sample):
+        return 'gb18030'
+    # _decodes 对未知的编码返回 False
+    if encoding and _decodes(sample, encoding):
+        return encoding
+    if _decodes(sample, 'cp1252'):
+        return 'cp1252'
+    return 'latin-1'
+
+
+def decode_lines(data: Any, encoding: str) -> List[str]:
+    """按给定编码解码为行列表，无法解码的字节用替换字符表示
+
+    和文本模式的 readlines() 一样把 \\r\\n、\\r 统一成 \\n 再分行。
+    """
+    return io.StringIO(str(data, encoding, errors='replace'), newline=None).readlines()
+
+
+def compare_binary(a: Any, b: Any) -> Dict[str, Any]:
+    """二进制文件比较：大小不同直接判定不同，大小相同时再比较哈希"""
+    result = {
+        'size_a': len(a),
+        'size_b': len(b),
+        'sha256_a': None,
+        'sha256_b': None,
+        'identical': False,
+        'first_diff_offset': None,
+    }
+    if len(a) == len(b):
+        result['sha256_a'] = hashlib.sha256(a).hexdigest()
+        result['sha256_b'] = hashlib.sha256(b).hexdigest()
+        result['identical'] = result['sha256_a'] == result['sha256_b']
+    if not result['identical']:
+        result['first_diff_offset'] = _first_diff_offset(a, b)
+    return result
+
+
+def _first_diff_offset(a: Any, b: Any) -> Optional[int]:
+    """逐块比较，找到第一个不同字节的位置"""
+    size = min(len(a), len(b))
+    for start in range(0, size, COMPARE_BLOCK_SIZE):
+        block_a = a[start:start + COMPARE_BLOCK_SIZE]
+        block_b = b[start:start + COMPARE_BLOCK_SIZE]
+        if block_a != block_b:
+            for k in range(len(block_a)):
+                if block_a[k] != block_b[k]:
+                    return start + k
+    return size if len(a) != len(b) else None
+
+
+def hash_lines(a: Sequence[str], b: Sequence[str]) -> Tuple[List[int], List[int]]:
+    """把两边的行映射为整数 ID，相同内容的行 ID 相同，之后只比较整数"""
+    ids = {}
+    a_ids = [ids.setdefault(line, len(ids)) for line in a]
+    b_ids = [ids.setdefault(line, len(ids)) for line in b]
+    return a_ids, b_ids
+
+
+def _longest_increasing(pairs: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """patience 排序：按 a 的顺序给出 (i, j)，求 j 严格递增的最长子序列"""
+    tails = []      # tails[k] = 长度为 k+1 的子序列末尾的 j
+    tail_idx = []   # 对应 pairs 中的下标
+    prev = [-1] * len(pairs)
+    for idx, (i, j) in enumerate(pairs):
+        k = bisect.bisect_left(tails, j)
+        if k == len(tails):
+            tails.append(j)
+            tail_idx.append(idx)
+        else:
+            tails[k] = j
+            tail_idx[k] = idx
+        prev[idx] = tail_idx[k - 1] if k > 0 else -1
+    result = []
+    idx = tail_idx[-1] if tail_idx else -1
+    while idx != -1:
+        result.append(pairs[idx])
+        idx = prev[idx]
+    result.reverse()
+    return result
+
+
+def _unique_anchors(a: List[int], a_lo: int, a_hi: int,
+                    b: List[int], b_lo: int, b_hi: int, width: int = 1) -> List[Tuple[int, int]]:
+    """区间内在两边都只出现一次的行，按 patience 算法取出互相不交叉的锚点
+
+    width 大于 1 时比较的是从每一行开始的连续 width 行，锚点仍然是窗口的第一行。
+    """
+    def key(lines, k):
+        return lines[k] if width == 1 else tuple(lines[k:k + width])
+
+    counts = {}
+    for i in range(a_lo, a_hi - width + 1):
+        entry = counts.get(key(a, i))
+        counts[key(a, i)] = [i, -1, 1 if entry is None else 2]
+    for j in range(b_lo, b_hi - width + 1):
+        entry = counts.get(key(b, j))
+        if entry is None or entry[2] != 1:
+            continue
+        if entry[1] == -1:
+            entry[1] = j
+        else:
+            entry[2] = 2
+    pairs = sorted((i, j) for i, j, n in counts.values() if n == 1 and j != -1)
+    return _longest_increasing(pairs)
+
+
+def _myers_blocks(a: List[int], a_lo: int, a_hi: int, b: List[int], b_lo: int, b_hi: int,
+                  max_edits: int) -> Optional[List[Tuple[int, int, int]]]:
+    """Myers 差分算法求最短编辑路径上的相同块 (i, j, n)，编辑数超过 max_edits 时返回 None
+
+    时间约为 O(N + D²)，D 为编辑数；保存每一步各对角线到达的位置用于回溯，内存 O(D²)。
+    """
+    n, m = a_hi - a_lo, b_hi - b_lo
+    trace = []
+    v = {1: 0}
+    for d in range(min(max_edits, n + m) + 1):
+        reached = {}
+        for k in range(-d, d + 1, 2):
+            # 从相邻对角线走一步：k+1 向下（插入）或 k-1 向右（删除），取走得更远的
+            x = v[k + 1] if k == -d or (k != d and v[k - 1] < v[k + 1]) else v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            reached[k] = x
+            if x >= n and y >= m:
+                trace.append(reached)
+                return _myers_path(trace, n, m, a_lo, b_lo)
+        trace.append(reached)
+        v = reached
+    return None
+
+
+def _myers_path(trace: List[Dict[int, int]], x: int, y: int, a_lo: int, b_lo: int) -> List[Tuple[int, int, int]]:
+    """从终点沿 trace 回溯，取出路径上每一段对角线（相同的行）"""
+    blocks = []
+    for d in range(len(trace) - 1, 0, -1):
+        k = x - y
+        prev = trace[d - 1]
+        down = k == -d or (k != d and prev[k - 1] < prev[k + 1])
+        prev_k = k + 1 if down else k - 1
+        prev_x = prev[prev_k]
+        start_x = prev_x if down else prev_x + 1
+        if x > start_x:
+            blocks.append((a_lo + start_x, b_lo + start_x - k, x - start_x))
+        x, y = prev_x, prev_x - prev_k
+    if x:
+        blocks.append((a_lo, b_lo, x))
+    return blocks
+
+
+def matching_blocks(a: List[int], b: List[int]) -> List[Tuple[int, int, int]]:
+    """patience diff：返回 (i, j, n) 形式的相同块，最后以 (len(a), len(b), 0) 结尾
+
+    先去掉公共前缀和后缀，再用两边都唯一的行作锚点把问题切成互不相关的小段，
+    每一段单独比较，所以时间和内存基本与文件大小成线性关系。
+    没有唯一行的小段用 difflib 精确比较，大段依次改用唯一的连续多行窗口作锚点、Myers 算法。
+    """
+    blocks = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        a_lo, a_hi, b_lo, b_hi = stack.pop()
+
+        # 公共前缀
+        start = 0
+        while a_lo + start < a_hi and b_lo + start < b_hi and a[a_lo + start] == b[b_lo + start]:
+            start += 1
+        if start:
+            blocks.append((a_lo, b_lo, start))
+            a_lo += start
+            b_lo += start
+
+        # 公共后缀
+        end = 0
+        while a_lo < a_hi - end and b_lo < b_hi - end and a[a_hi - end - 1] == b[b_hi - end - 1]:
+            end += 1
+        if end:
+            blocks.append((a_hi - end, b_hi - end, end))
+            a_hi -= end
+            b_hi -= end
+
+        if a_lo == a_hi or b_lo == b_hi:
+            continue
+
+        large = (a_hi - a_lo) * (b_hi - b_lo) > EXACT_DIFF_LIMIT
+        anchors = _unique_anchors(a, a_lo, a_hi, b, b_lo, b_hi)
+        for width in ANCHOR_WIDTHS:
+            if anchors or not large:
+                break
+            anchors = _unique_anchors(a, a_lo, a_hi, b, b_lo, b_hi, width)
+        if anchors:
+            # 锚点之间的区间分别处理
+            prev_i, prev_j = a_lo, b_lo
+            for i, j in anchors:
+                blocks.append((i, j, 1))
+                stack.append((prev_i, i, prev_j, j))
+                prev_i, prev_j = i + 1, j + 1
+            stack.append((prev_i, a_hi, prev_j, b_hi))
+        elif not large:
+            matcher = SequenceMatcher(None, a[a_lo:a_hi], b[b_lo:b_hi], autojunk=False)
+            for i, j, n in matcher.get_matching_blocks():
+                if n:
+                    blocks.append((a_lo + i, b_lo + j, n))
+        else:
+            # 编辑太多时整段视为替换，保证最坏情况下也不会退化成平方复杂度
+            blocks.extend(_myers_blocks(a, a_lo, a_hi, b, b_lo, b_hi, MYERS_MAX_EDITS) or [])
+
+    blocks.sort()
+    # 合并相邻的块
+    merged = []
+    for i, j, n in blocks:
+        if merged and merged[-1][0] + merged[-1][2] == i and merged[-1][1] + merged[-1][2] == j:
+            last_i, last_j, last_n = merged[-1]
+            merged[-1] = (last_i, last_j, last_n + n)
+        else:
+            merged.append((i, j, n))
+    merged.append((len(a), len(b), 0))
+    return merged
+
+
+def diff_opcodes(a: Sequence[str], b: Sequence[str]) -> List[Opcode]:
+    """比较两组文本行，返回 equal / replace / delete / insert 操作列表"""
+    a_ids, b_ids = hash_lines(a, b)
+    opcodes = []
+    i = j = 0
+    for block_i, block_j, n in matching_blocks(a_ids, b_ids):
+        if i < block_i and j < block_j:
+            opcodes.append(('replace', i, block_i, j, block_j))
+        elif i < block_i:
+            opcodes.append(('delete', i, block_i, j, block_j))
+        elif j < block_j:
+            opcodes.append(('insert', i, block_i, j, block_j))
+        if n:
+            opcodes.append(('equal', block_i, block_i + n, block_j, block_j + n))
+        i, j = block_i + n, block_j + n
+    return opcodes
+
+
+def group_hunks(opcodes: List[Opcode], context: int = 5) -> List[List[Opcode]]:
+    """把操作列表分成若干块，每块前后保留 context 行相同内容"""
+    return list(SequenceMatcher.get_grouped_opcodes(_OpcodeHolder(opcodes), context))
+
+
+class _OpcodeHolder:
+    """让 SequenceMatcher.get_grouped_opcodes 直接使用已经算好的 opcodes"""
+
+    def __init__(self, opcodes: List[Opcode]):
+        self._opcodes = opcodes
+
+    def get_opcodes(self) -> List[Opcode]:
+        return self._opcodes
+
+
+def _clean(line: str) -> str:
+    return line.rstrip('\r\n')
+
+
+def _highlight_pair(old: str, new: str) -> Tuple[str, str]:
+    """只标出两行之间不同的中间部分（公共前缀和后缀之外）"""
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-suffix - 1] == new[-suffix - 1]:
+        suffix += 1
+
+    def mark(text: str) -> str:
+        middle_end = len(text) - suffix
+        return (html.escape(text[:prefix])
+                + '<span class="diff_chg">' + html.escape(text[prefix:middle_end]) + '</span>'
+                + html.escape(text[middle_end:]))
+
+    return mark(old), mark(new)
+
+
+def opcode_rows(tag: str, old_no: int, old_lines: Sequence[str],
+                new_no: int, new_lines: Sequence[str]) -> Iterator[DiffRow]:
+    """一段操作（或其中连续的一部分）对应的表格行（左右并排）
+
+    old_lines / new_lines 为这部分在两边实际存在的行，old_no / new_no 为其中第一行的行号（从 1 开始）。
+    """
+    if tag == 'equal':
+        for k, line in enumerate(old_lines):
+            text = html.escape(_clean(line))
+            yield (old_no + k, text, '', new_no + k, text, '')
+        return
+    for k in range(max(len(old_lines), len(new_lines))):
+        has_old = k < len(old_lines)
+        has_new = k < len(new_lines)
+        old = _clean(old_lines[k]) if has_old else ''
+        new = _clean(new_lines[k]) if has_new else ''
+        if has_old and has_new:
+            old_html, new_html = _highlight_pair(old, new)
+            yield (old_no + k, old_html, '', new_no + k, new_html, '')
+        elif has_old:
+            yield (old_no + k, html.escape(old), 'diff_sub', '', '', '')
+        else:
+            yield ('', '', '', new_no + k, html.escape(new), 'diff_add')
+
+
+def opcode_row_count(opcode: Opcode) -> int:
+    """一段操作在表格中占的行数：相同的部分一行对一行，其余按两边较多的一边"""
+    tag, i1, i2, j1, j2 = opcode
+    return i2 - i1 if tag == 'equal' else max(i2 - i1, j2 - j1)
@@ -0,0 +1,204 @@
+import bisect
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence
+
+from utils.diff_engine import DiffRow, Opcode, diff_opcodes, group_hunks, opcode_row_count, opcode_rows
+
+# 每隔多少行记录一次该行在暂存文件中的位置，读取任意一行最多从前面的索引点向后跳过这么多行
+LINE_INDEX_STEP = 256
+
+# 一次请求最多返回的表格行数 / hunk 数
+MAX_WINDOW_ROWS = 2000
+MAX_WINDOW_HUNKS = 1000
+
+
+class _LineSpool:
+    """一侧文件中被 hunk 覆盖的行，去掉换行符后按 UTF-8 逐行写入磁盘临时文件
+
+    内存中只保留稀疏的 (行号, 文件位置) 索引：每个不连续区间的第一行，以及行号是 LINE_INDEX_STEP 倍数的行。
+    """
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        self._lines = []    # 索引点的行号（从 0 开始），递增
+        self._offsets = []  # 索引点在文件中的位置
+        self._end = None    # 已写入的最后一行之后的行号
+        self.size = 0
+
+    def append(self, lines: Sequence[str], start: int, end: int):
+        """写入 lines[start:end]，各次写入的区间必须递增（可以与上一次相接，不能重叠）"""
+        chunk = []
+        position = self.size
+        for n in range(start, end):
+            if (n == start and n != self._end) or n % LINE_INDEX_STEP == 0:
+                self._lines.append(n)
+                self._offsets.append(position)
+            data = lines[n].rstrip('\r\n').encode('utf-8') + b'\n'
+            chunk.append(data)
+            position += len(data)
+        self._file.write(b''.join(chunk))
+        self.size = position
+        self._end = max(end, self._end or 0)
+
+    def read(self, start: int, end: int) -> List[str]:
+        """读出第 start 到 end 行（不含 end），这些行必须在同一个已写入的区间内；调用方负责加锁"""
+        if start >= end:
+            return []
+        k = bisect.bisect_right(self._lines, start) - 1
+        self._file.seek(self._offsets[k])
+        for _ in range(start - self._lines[k]):
+            self._file.readline()
+        return [self._file.readline()[:-1].decode('utf-8') for _ in range(end - start)]
+
+    def close(self):
+        self._file.close()
+
+
+class DiffIndex:
+    """一次文本比较的结果：各 hunk 的操作列表和它在表格中的起始行，两边被 hunk 覆盖的行在磁盘暂存文件中
+
+    内存占用只与 hunk 数（和稀疏的行索引）有关，与文件大小、渲染后的 HTML 大小无关，
+    任意一段表格行都在请求时从暂存文件读出并渲染。
+    """
+
+    def __init__(self, a: Sequence[str], b: Sequence[str], context: int = 5, info: Optional[Dict[str, Any]] = None,
+                 hunks: Optional[List[List[Opcode]]] = None):
+        # hunks 可以是已经算好的结果（例如在工作进程中比较的），这里只建立索引
+        if hunks is None:
+            hunks = group_hunks(diff_opcodes(a, b), context)
+        self.identical = all(tag == 'equal' for hunk in hunks for tag, *_ in hunk)
+        self.hunks: List[List[Opcode]] = [] if self.identical else hunks
+        self.info = info or {}
+        self.from_line_count = len(a)
+        self.to_line_count = len(b)
+
+        # row_starts[k] 为第 k 个 hunk 在表格中的第一行；第一个之后的 hunk 前面有一行分隔符
+        self.row_starts = []
+        self._spools = (_LineSpool(), _LineSpool())
+        self._lock = threading.Lock()
+        self._closed = False
+        total = 0
+        for k, hunk in enumerate(self.hunks):
+            self.row_starts.append(total)
+            total += (1 if k else 0) + sum(opcode_row_count(opcode) for opcode in hunk)
+            self._spools[0].append(a, hunk[0][1], hunk[-1][2])
+            self._spools[1].append(b, hunk[0][3], hunk[-1][4])
+        self.total_rows = total
+
+    @property
+    def spool_bytes(self) -> int:
+        return self._spools[0].size + self._spools[1].size
+
+    def summary(self) -> Dict[str, Any]:
+        """比较结果的概况，可以直接转换为 JSON"""
+        return dict(
+            self.info,
+            identical=self.identical,
+            from_lines=self.from_line_count,
+            to_lines=self.to_line_count,
+            hunk_count=len(self.hunks),
+            total_rows=self.total_rows,
+        )
+
+    def hunk_window(self, start: int, count: int) -> List[Dict[str, Any]]:
+        """第 start 个开始的最多 count 个 hunk 的位置：表格中的起始行和行数，以及两边对应的行号范围（从 1 开始）"""
+        result = []
+        for k in range(max(start, 0), min(start + count, len(self.hunks))):
+            hunk = self.hunks[k]
+            end = self.row_starts[k + 1] if k + 1 < len(self.hunks) else self.total_rows
+            result.append({
+                'index': k,
+                'row': self.row_starts[k],
+                'rows': end - self.row_starts[k],
+                'from_start': hunk[0][1] + 1,
+                'from_count': hunk[-1][2] - hunk[0][1],
+                'to_start': hunk[0][3] + 1,
+                'to_count': hunk[-1][4] - hunk[0][3],
+            })
+        return result
+
+    def row_window(self, start: int, count: int) -> List[Optional[DiffRow]]:
+        """表格中第 start 行开始的最多 count 行，hunk 之间的分隔行为 None
+
+        已被淘汰（close）的结果抛出 KeyError。
+        """
+        start = max(start, 0)
+        end = min(start + count, self.total_rows)
+        rows = []
+        if start >= end:
+            return rows
+        with self._lock:
+            if self._closed:
+                raise KeyError('diff closed')
+            k = bisect.bisect_right(self.row_starts, start) - 1
+            row = self.row_starts[k]
+            while k < len(self.hunks) and row < end:
+                if k:
+                    if row >= start:
+                        rows.append(None)
+                    row += 1
+                for opcode in self.hunks[k]:
+                    n = opcode_row_count(opcode)
+                    lo, hi = max(start - row, 0), min(end - row, n)
+                    if lo < hi:
+                        rows.extend(self._opcode_rows(opcode, lo, hi))
+                    row += n
+                    if row >= end:
+                        break
+                k += 1
+        return rows
+
+    def _opcode_rows(self, opcode: Opcode, lo: int, hi: int) -> List[DiffRow]:
+        """一段操作中第 lo 到 hi 行（不含 hi）"""
+        tag, i1, i2, j1, j2 = opcode
+        old = self._spools[0].read(i1 + lo, min(i1 + hi, i2))
+        # 相同的部分两边内容一样，只读一边
+        new = old if tag == 'equal' else self._spools[1].read(j1 + lo, min(j1 + hi, j2))
+        return list(opcode_rows(tag, i1 + lo + 1, old, j1 + lo + 1, new))
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            for spool in self._spools:
+                spool.close()
+
+
+class DiffStore:
+    """保存文件对比结果，页面按需取出任意一段表格行（虚拟滚动）
+
+    保存的对象需要有 spool_bytes 属性和 close() 方法（DiffIndex，以及压缩包对比的 TreeCompare）。
+    暂存文件的总字节数超过 max_bytes 时按最近最少使用的顺序淘汰，淘汰时删除暂存文件。
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def add(self, index: Any) -> str:
+        """保存比较结果，返回 diff ID"""
+        diff_id = uuid.uuid4().hex
+        evicted = []
+        with self._lock:
+            self._items[diff_id] = index
+            self._size += index.spool_bytes
+            while self._size > self.max_bytes and len(self._items) > 1:
+                _, old = self._items.popitem(last=False)
+                self._size -= old.spool_bytes
+                evicted.append(old)
+        for old in evicted:
+            old.close()
+        return diff_id
+
+    def get(self, diff_id: str) -> Optional[Any]:
+        """不存在或已被淘汰时返回 None"""
+        with self._lock:
+            index = self._items.get(diff_id)
+            if index is not None:
+                self._items.move_to_end(diff_id)
+            return index
+
@@ -0,0 +1,142 @@
+import io
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from PIL import Image, features
+
+from utils import metrics
+
+try:
+    # 旧版本 Pillow 需要这个插件才能编码 AVIF，新版本自带
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+# 格式: (MIME 类型, 扩展名, 是否支持透明通道, 单边最大尺寸)
+FORMATS = {
+    'JPEG': ('image/jpeg', 'jpg', False, 65500),
+    'WEBP': ('image/webp', 'webp', True, 16383),
+    'AVIF': ('image/avif', 'avif', True, 65536),
+    'PNG': ('image/png', 'png', True, 2 ** 31 - 1),
+}
+
+# 编码配置的默认值
+# effort: 0（最快、文件最大）到 6（最慢、文件最小），对应 WebP 的 method、AVIF 的 speed、PNG 的压缩级别
+# progressive / optimize: JPEG 渐进式和霍夫曼表优化；optimize 对 PNG 也有效
+# budget_ms: 编码时间预算，预计超出时依次关闭 optimize、progressive，再降低 effort
+DEFAULT_PROFILE = {
+    'format': 'JPEG',
+    'quality': 90,
+    'effort': 4,
+    'progressive': False,
+    'optimize': False,
+    'budget_ms': None,
+}
+
+MAX_EFFORT = 6
+
+# 各编码参数下每百万像素的耗时（秒），按实际编码结果滑动平均，用于预测是否超出预算
+_cost_per_mp: Dict[tuple, float] = {}
+_cost_lock = threading.Lock()
+_COST_SMOOTHING = 0.3
+
+
+def resolve_profile(profile: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """补全默认值并检查格式是否可用，配置有误时抛出 ValueError"""
+    resolved = dict(DEFAULT_PROFILE)
+    resolved.update(profile or {})
+    resolved['format'] = resolved['format'].upper()
+    fmt = resolved['format']
+    if fmt not in FORMATS:
+        raise ValueError(f'不支持的输出格式: {fmt}')
+    if fmt in ('WEBP', 'AVIF') and not features.check(fmt.lower()):
+        raise ValueError(f'当前 Pillow 不支持 {fmt} 编码')
+    if not 0 <= resolved['effort'] <= MAX_EFFORT:
+        raise ValueError(f'effort 需要在 0-{MAX_EFFORT} 之间: {resolved["effort"]}')
+    return resolved
+
+
+def mimetype_for(profile: Optional[Dict[str, Any]] = None) -> str:
+    return FORMATS[resolve_profile(profile)['format']][0]
+
+
+def extension_for(profile: Optional[Dict[str, Any]] = None) -> str:
+    return FORMATS[resolve_profile(profile)['format']][1]
+
+
+def max_dimension_for(profile: Optional[Dict[str, Any]] = None) -> int:
+    return FORMATS[resolve_profile(profile)['format']][3]
+
+
+def _save_params(fmt: str, quality: int, effort: int, progressive: bool, optimize: bool) -> Dict[str, Any]:
+    """把通用的 quality / effort 换算成各格式自己的参数"""
+    if fmt == 'JPEG':
+        return {'quality': quality, 'progressive': progressive, 'optimize': optimize}
+    if fmt == 'WEBP':
+        return {'quality': quality, 'method': effort}
+    if fmt == 'AVIF':
+        # speed: 0 最慢，10 最快
+        return {'quality': quality, 'speed': 10 - effort}
+    # PNG 是无损的，quality 不起作用；effort 0-6 对应压缩级别 1-9
+    return {'compress_level': 1 + round(effort * 8 / MAX_EFFORT), 'optimize': optimize}
+
+
+def _fit_budget(fmt: str, megapixels: float, budget_ms: Optional[float], effort: int,
+                progressive: bool, optimize: bool):
+    """根据以往的编码耗时降低编码强度，直到预计耗时不超出预算"""
+    if not budget_ms:
+        return effort, progressive, optimize
+    while True:
+        with _cost_lock:
+            cost = _cost_per_mp.get((fmt, effort, progressive, optimize))
+        # 没有记录的参数无法预测，按原样编码并记录耗时
+        if cost is None or cost * megapixels * 1000 <= budget_ms:
+            return effort, progressive, optimize
+        if optimize:
+            optimize = False
+        elif progressive:
+            progressive = False
+        elif effort > 0:
+            effort -= 1
+        else:
+            return effort, progressive, optimize
+
+
+def _record_cost(key: tuple, megapixels: float, seconds: float):
+    if megapixels <= 0:
+        return
+    cost = seconds / megapixels
+    with _cost_lock:
+        old = _cost_per_mp.get(key)
+        _cost_per_mp[key] = cost if old is None else old + _COST_SMOOTHING * (cost - old)
+
+
+def encode_image(img: Image.Image, profile: Optional[Dict[str, Any]] = None,
+                 operation: str = 'encode') -> bytes:
+    """按编码配置编码图片
+
+    不支持透明通道的格式（JPEG）先转换为 RGB（透明部分直接丢弃 alpha，与原来一致）；其余格式保留 RGBA。
+    编码耗时记录在 operation 的 encode 阶段。
+    """
+    profile = resolve_profile(profile)
+    fmt = profile['format']
+    if not FORMATS[fmt][2]:
+        # RGBX（联系表的映射画布）JPEG 可以直接编码，不必复制
+        if img.mode not in ('RGB', 'RGBX', 'L'):
+            img = img.convert('RGB')
+    elif img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+
+    megapixels = img.size[0] * img.size[1] / 1e6
+    effort, progressive, optimize = _fit_budget(
+        fmt, megapixels, profile['budget_ms'], profile['effort'], profile['progressive'], profile['optimize']
+    )
+    params = _save_params(fmt, profile['quality'], effort, progressive, optimize)
+
+    output = io.BytesIO()
+    started = time.perf_counter()
+    with metrics.stage(operation, 'encode'):
+        img.save(output, format=fmt, **params)
+    _record_cost((fmt, effort, progressive, optimize), megapixels, time.perf_counter() - started)
+    return output.getvalue()
@@ -0,0 +1,243 @@
+import io
+import math
+import posixpath
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from utils import metrics
+from utils.icon_maker import crop_scaled, make_icon_files
+from utils.validation import ICON_MIMETYPES, ValidationError, inspect_image
+from utils.worker_pool import WorkerPool
+
+# 裁剪方式：center 取居中的最大正方形，saliency 取细节（梯度）最多的正方形，boxes 使用每个文件指定的裁剪框
+CROP_POLICIES = ('center', 'saliency', 'boxes')
+
+# 图标最大 512×512，解码时（JPEG draft）保证裁剪框缩小后不小于这个边长
+MIN_CROP_SIZE = 512
+
+# 计算显著性时把图片缩小到的长边
+SALIENCY_SIZE = 256
+
+# (文件名, 读取内容的函数)
+BatchEntry = Tuple[str, Callable[[], bytes]]
+
+
+def _is_hidden(name: str) -> bool:
+    return name.startswith('__MACOSX/') or posixpath.basename(name).startswith('.')
+
+
+def _read_all(stream: BinaryIO) -> bytes:
+    stream.seek(0)
+    return stream.read()
+
+
+def list_batch_entries(uploads: List[Tuple[str, BinaryIO]], max_images: int, max_bytes: int) -> List[BatchEntry]:
+    """展开上传的文件（文件对象）：ZIP 压缩包中的每个文件都是一张图片，其余文件本身就是图片
+
+    只读取 ZIP 的目录，每张图片的内容在处理到它时才读取或解压。图片数超过 max_images、
+    或者解压后的总大小超过 max_bytes 时抛出 ValidationError。
+    """
+    # 工作进程也会导入本模块，只在主进程中用到的 uploads（依赖 Flask）在这里导入
+    from utils.uploads import stream_size
+
+    entries = []
+    total = 0
+    for filename, stream in uploads:
+        if not zipfile.is_zipfile(stream):
+            entries.append((filename, partial(_read_all, stream)))
+            total += stream_size(stream)
+            continue
+        try:
+            archive = zipfile.ZipFile(stream)
+        except zipfile.BadZipFile:
+            raise ValidationError(f'{filename}：压缩包已损坏')
+        for info in archive.infolist():
+            if info.is_dir() or _is_hidden(info.filename):
+                continue
+            entries.append((info.filename, partial(archive.read, info)))
+            total += info.file_size
+        if len(entries) > max_images:
+            break
+    if not entries:
+        raise ValidationError('没有找到图片')
+    if len(entries) > max_images:
+        raise ValidationError(f'最多处理 {max_images} 张图片')
+    if total > max_bytes:
+        raise ValidationError(f'文件总大小超出限制（最多 {max_bytes // (1024 * 1024)} MB）')
+    return entries
+
+
+def center_box(size: Tuple[int, int]) -> Tuple[int, int, int]:
+    """居中的最大正方形 (x, y, 边长)"""
+    width, height = size
+    side = min(width, height)
+    return (width - side) // 2, (height - side) // 2, side
+
+
+def saliency_box(img: Image.Image) -> Tuple[int, int, int]:
+    """沿长边滑动最大的正方形，取梯度能量最大的位置 (x, y, 边长)
+
+    在缩小后的灰度图上计算，梯度幅值的前缀和让每个位置的能量都是 O(1) 求出。
+    """
+    width, height = img.size
+    side = min(width, height)
+    if width == height:
+        return 0, 0, side
+
+    small = img.convert('L')
+    small.thumbnail((SALIENCY_SIZE, SALIENCY_SIZE), Image.Resampling.BOX)
+    gray = np.asarray(small, dtype=np.float32)
+    gy, gx = np.gradient(gray)
+    energy = np.hypot(gx, gy)
+
+    # 沿长边的能量分布，以及缩小后的正方形边长
+    axis_energy = energy.sum(axis=0 if width > height else 1)
+    factor = len(axis_energy) / max(width, height)
+    window = min(len(axis_energy), max(1, round(side * factor)))
+    cumsum = np.concatenate(([0.0], np.cumsum(axis_energy)))
+    sums = cumsum[window:] - cumsum[:-window]
+    # 主体比正方形小时会有一段位置的能量几乎相同，取这段的中间，让主体居中
+    best = np.flatnonzero(sums >= sums.max() * 0.99)
+    offset = min(round((best[0] + best[-1]) / 2 / factor), max(width, height) - side)
+    return (offset, 0, side) if width > height else (0, offset, side)
+
+
+def make_batch_icons(blob: bytes, policy: str = 'center', box: Optional[List[int]] = None,
+                     encoder: Optional[Dict[str, Any]] = None,
+                     max_pixels: Optional[int] = None) -> Dict[str, bytes]:
+    """按裁剪方式裁剪一张图片并生成整套图标文件，在工作进程中执行
+
+    JPEG 按裁剪框缩小到不小于 MIN_CROP_SIZE 的比例解码（draft），
+    所以批量结果中的 cropped_image.png 可能小于原图中的裁剪区域，各尺寸图标不受影响。
+    """
+    info = inspect_image(io.BytesIO(blob), ICON_MIMETYPES)
+    if max_pixels is not None and info.pixels > max_pixels:
+        raise ValidationError(f'图片尺寸过大（{info.width}×{info.height}）')
+    metrics.count('flask_utils_input_pixels_total', info.pixels, operation='icon_batch')
+    metrics.count('flask_utils_operations_total', 1, operation='icon_batch')
+
+    img = Image.open(io.BytesIO(blob))
+    width, height = img.size
+    if policy == 'boxes' and box:
+        x, y, side = (int(v) for v in box)
+    else:
+        # saliency 的位置在解码后计算，这里先取居中的正方形决定解码比例
+        x, y, side = center_box(img.size)
+    if side <= 0:
+        raise ValidationError('裁剪框无效')
+
+    if side > MIN_CROP_SIZE:
+        img.draft('RGB', (math.ceil(width * MIN_CROP_SIZE / side), math.ceil(height * MIN_CROP_SIZE / side)))
+    with metrics.stage('icon_batch', 'decode'):
+        img.load()
+    if policy == 'saliency':
+        x, y, side = saliency_box(img)
+    else:
+        factor = img.size[0] / width
+        x, y, side = round(x * factor), round(y * factor), max(1, round(side * factor))
+
+    with metrics.stage('icon_batch', 'convert'):
+        cropped_img = crop_scaled(img, 1.0, (x, y, x + side, y + side))
+    return make_icon_files(cropped_img, encoder)
+
+
+class _ChunkWriter:
+    """只支持 write 的输出流，zipfile 写入的数据暂存在这里，由生成器分块取走"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _output_dirs(names: List[str]) -> List[str]:
+    """每张图片的图标放在以文件名（去掉扩展名）命名的目录中，重名时加上序号
+
+    文件名可能来自上传的 ZIP，去掉其中的 '..'、'.' 和空的路径部分，输出的压缩包解压时不会写到目录外面。
+    """
+    used = set()
+    dirs = []
+    for name in names:
+        parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.', '..')]
+        base = posixpath.splitext('/'.join(parts))[0] or 'image'
+        candidate, n = base, 1
+        while candidate in used:
+            n += 1
+            candidate = f'{base}_{n}'
+        used.add(candidate)
+        dirs.append(candidate)
+    return dirs
+
+
+def iter_icon_archive(entries: List[BatchEntry], policy: str = 'center',
+                      boxes: Optional[Dict[str, List[int]]] = None,
+                      encoder: Optional[Dict[str, Any]] = None, pool: Optional[WorkerPool] = None,
+                      parallel: int = 1, max_pixels: Optional[int] = None,
+                      sampled: bool = False) -> Iterator[bytes]:
+    """批量生成图标并以 ZIP 流的形式逐块返回
+
+    同时最多处理 parallel 张图片（交给进程池），哪张先完成就先写入压缩包并发送出去，
+    所以内存中只有正在处理的几张图片，与图片总数无关。
+    处理失败的图片不会中断整个压缩包，原因写在压缩包里的 errors.txt 中。
+    响应发送时请求已经结束，sampled 为请求是否被采样，由调用方在请求内取得。
+    """
+    boxes = boxes or {}
+    dirs = _output_dirs([name for name, read in entries])
+    writer = _ChunkWriter()
+    errors = []
+    executor = ThreadPoolExecutor(max_workers=max(1, parallel))
+
+    def process(i):
+        # 在任务线程中解压，损坏的压缩包条目和其它失败一样记录到 errors.txt
+        name, read = entries[i]
+        args = (read(), policy, boxes.get(name), encoder, max_pixels)
+        with metrics.trace(sampled):
+            if pool is not None:
+                return pool.run(make_batch_icons, *args, wait=True)
+            return make_batch_icons(*args)
+
+    def submit(i):
+        return executor.submit(process, i)
+
+    try:
+        with zipfile.ZipFile(writer, 'w', zipfile.ZIP_STORED) as archive:
+            pending = {}
+            next_index = 0
+            while pending or next_index < len(entries):
+                while next_index < len(entries) and len(pending) < max(1, parallel):
+                    pending[submit(next_index)] = next_index
+                    next_index += 1
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = pending.pop(future)
+                    try:
+                        files = future.result()
+                    except Exception as e:
+                        errors.append(f'{entries[i][0]}: {str(e) or type(e).__name__}')
+                        continue
+                    with metrics.trace(sampled), metrics.stage('icon_batch', 'serialize'):
+                        for filename, data in files.items():
+                            archive.writestr(f'{dirs[i]}/{filename}', data)
+                    del files
+                yield writer.drain()
+            if errors:
+                archive.writestr('errors.txt', '\n'.join(errors) + '\n')
+        yield writer.drain()
+    finally:
+        # 客户端中途断开时不再处理剩下的图片
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,193 @@
+import io
+import math
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from utils import metrics
+from utils.encoders import encode_image
+from utils.icon_sessions import pick_level
+
+# favicon.ico 中包含的尺寸
+ICO_SIZES = [16, 32, 48, 64, 128, 256]
+
+# 单独输出的 PNG 图标（文件名: 边长）
+PNG_ICONS = {
+    'apple-touch-icon.png': 180,
+    'android-chrome-192x192.png': 192,
+    'android-chrome-512x512.png': 512,
+}
+
+# LANCZOS 滤波核的半径（以缩放后的像素为单位）
+LANCZOS_SUPPORT = 3
+
+# 并行编码使用的线程数（Pillow 编码时会释放 GIL）
+ENCODE_THREADS = 4
+
+
+def build_pyramid(img: Image.Image, sizes: List[int]) -> Dict[int, Image.Image]:
+    """生成各个尺寸的正方形图标
+
+    从大到小依次缩放，每一级都从上一级缩小，而不是每次都从原图缩放；
+    比原图还大的尺寸只能直接从原图放大。
+    """
+    levels = {}
+    current = img
+    for size in sorted(set(sizes), reverse=True):
+        if current.size[0] < size:
+            levels[size] = img.resize((size, size), Image.Resampling.LANCZOS)
+        else:
+            levels[size] = current.resize((size, size), Image.Resampling.LANCZOS)
+            current = levels[size]
+    return levels
+
+
+def _encode_ico(levels: Dict[int, Image.Image]) -> bytes:
+    """把金字塔中的各级直接写入 ICO，Pillow 不再自己缩放"""
+    largest = max(ICO_SIZES)
+    ico_bytes = io.BytesIO()
+    levels[largest].save(
+        ico_bytes,
+        format='ICO',
+        sizes=[(size, size) for size in ICO_SIZES],
+        append_images=[levels[size] for size in ICO_SIZES if size != largest]
+    )
+    return ico_bytes.getvalue()
+
+
+def _build_zip(files: Dict[str, bytes]) -> bytes:
+    """打包所有图标；PNG/ICO 本身已经压缩过，直接存储即可"""
+    zip_bytes = io.BytesIO()
+    with zipfile.ZipFile(zip_bytes, 'w', zipfile.ZIP_STORED) as zf:
+        for name, data in files.items():
+            zf.writestr(name, data)
+    return zip_bytes.getvalue()
+
+
+def make_icon_files(cropped_img: Image.Image, encoder: Optional[Dict[str, Any]] = None) -> Dict[str, bytes]:
+    """从裁剪好的正方形图片生成整套图标文件 {文件名: 内容}
+
+    encoder 只调整 PNG 的压缩强度，图标文件始终是 PNG。
+    """
+    with metrics.stage('icon', 'resize'):
+        levels = build_pyramid(cropped_img, ICO_SIZES + list(PNG_ICONS.values()))
+
+    png_profile = dict(encoder or {}, format='PNG')
+
+    # 各个文件互不依赖，并行编码
+    with metrics.stage('icon', 'encode'), ThreadPoolExecutor(max_workers=ENCODE_THREADS) as executor:
+        png_future = executor.submit(encode_image, cropped_img, png_profile, 'icon')
+        ico_future = executor.submit(_encode_ico, levels)
+        icon_futures = {name: executor.submit(encode_image, levels[size], png_profile, 'icon')
+                        for name, size in PNG_ICONS.items()}
+        files = {
+            'cropped_image.png': png_future.result(),
+            'favicon.ico': ico_future.result(),
+        }
+        for name, future in icon_futures.items():
+            files[name] = future.result()
+    return files
+
+
+def make_icon_bundle(cropped_img: Image.Image, encoder: Optional[Dict[str, Any]] = None) -> Dict[str, bytes]:
+    """从裁剪好的正方形图片生成整套图标
+
+    返回 {'png': 裁剪图 PNG, 'ico': 多尺寸 favicon.ico, 'zip': 所有文件的压缩包,
+    以及 'apple-touch-icon.png' 等单独的 PNG 图标}
+    """
+    files = make_icon_files(cropped_img, encoder)
+    result = dict(files)
+    result['png'] = files['cropped_image.png']
+    result['ico'] = files['favicon.ico']
+    with metrics.stage('icon', 'serialize'):
+        result['zip'] = _build_zip(files)
+    metrics.count('flask_utils_output_bytes_total', sum(len(data) for data in files.values()) + len(result['zip']),
+                  operation='icon')
+    return result
+
+
+def crop_scaled(img: Image.Image, scale: float, crop_box: Tuple[int, int, int, int],
+                scaled_size: Optional[Tuple[int, int]] = None) -> Image.Image:
+    """等价于「整张图缩放 scale 倍后再裁剪 crop_box」，但只处理裁剪区域
+
+    先把裁剪框换算回原图坐标，多留出 LANCZOS 滤波半径的边距后从原图裁出这一小块，
+    再用 resize 的 box 参数只对这一块重采样。超出图片范围的部分和原来一样是透明的。
+    scaled_size 为缩放后整张图的尺寸，默认按 scale 计算（从金字塔的某一级裁剪时由调用方给出）。
+    """
+    x0, y0, x1, y1 = crop_box
+    if scaled_size is not None:
+        new_width, new_height = scaled_size
+    elif scale == 1.0:
+        new_width, new_height = img.size
+    else:
+        # 与整图缩放时完全相同的目标尺寸和实际缩放比例
+        new_width = int(img.size[0] * scale)
+        new_height = int(img.size[1] * scale)
+    fx = img.size[0] / new_width
+    fy = img.size[1] / new_height
+
+    result = Image.new('RGBA', (x1 - x0, y1 - y0), (0, 0, 0, 0))
+    # 裁剪框与缩放后图片的交集
+    cx0, cy0 = max(x0, 0), max(y0, 0)
+    cx1, cy1 = min(x1, new_width), min(y1, new_height)
+    if cx0 >= cx1 or cy0 >= cy1:
+        return result
+
+    if (new_width, new_height) == img.size:
+        result.paste(img.crop((cx0, cy0, cx1, cy1)).convert('RGBA'), (cx0 - x0, cy0 - y0))
+        return result
+
+    # 交集在原图中的位置，以及滤波需要的额外边距
+    src_box = (cx0 * fx, cy0 * fy, cx1 * fx, cy1 * fy)
+    margin = math.ceil(LANCZOS_SUPPORT * max(fx, fy, 1.0)) + 2
+    left = max(0, math.floor(src_box[0]) - margin)
+    top = max(0, math.floor(src_box[1]) - margin)
+    right = min(img.size[0], math.ceil(src_box[2]) + margin)
+    bottom = min(img.size[1], math.ceil(src_box[3]) + margin)
+
+    region = img.crop((left, top, right, bottom)).convert('RGBA')
+    part = region.resize(
+        (cx1 - cx0, cy1 - cy0),
+        Image.Resampling.LANCZOS,
+        box=(src_box[0] - left, src_box[1] - top, src_box[2] - left, src_box[3] - top)
+    )
+    result.paste(part, (cx0 - x0, cy0 - y0))
+    return result
+
+
+def make_icon(blob: bytes, crop_x: int, crop_y: int, crop_size: int, scale: float,
+              encoder: Optional[Dict[str, Any]] = None) -> Dict[str, bytes]:
+    """裁剪图片并生成图标，返回值见 make_icon_bundle"""
+    # 打开图片（这里只读取头信息）
+    img = Image.open(io.BytesIO(blob))
+    metrics.count('flask_utils_input_pixels_total', img.size[0] * img.size[1], operation='icon')
+    metrics.count('flask_utils_operations_total', 1, operation='icon')
+    with metrics.stage('icon', 'decode'):
+        img.load()
+    
+    # 先裁剪再缩放，只处理需要的区域
+    crop_box = (crop_x, crop_y, crop_x + crop_size, crop_y + crop_size)
+    with metrics.stage('icon', 'convert'):
+        cropped_img = crop_scaled(img, scale, crop_box)
+    
+    return make_icon_bundle(cropped_img, encoder)
+
+
+def crop_from_levels(levels: List[Image.Image], crop_x: int, crop_y: int, crop_size: int,
+                     scale: float) -> Image.Image:
+    """从上传会话的金字塔中裁剪，结果与 make_icon 中对原图的裁剪相同
+
+    缩小时从不小于目标尺寸的最小一级开始缩放，需要读取和重采样的像素更少。
+    """
+    metrics.count('flask_utils_operations_total', 1, operation='icon')
+    width, height = levels[0].size
+    if scale == 1.0:
+        scaled_size = (width, height)
+    else:
+        scaled_size = (int(width * scale), int(height * scale))
+    level, level_scale = pick_level(levels, scale)
+    crop_box = (crop_x, crop_y, crop_x + crop_size, crop_y + crop_size)
+    with metrics.stage('icon', 'convert'):
+        return crop_scaled(level, level_scale, crop_box, scaled_size)
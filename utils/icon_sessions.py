@@ -0,0 +1,102 @@
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from typing import BinaryIO, List, Optional, Tuple
+
+from PIL import Image
+
+from utils import metrics
+from utils.worker_pool import WorkerPool
+
+# 金字塔最小一级的长边不小于这个尺寸（最大的图标是 512×512）
+MIN_LEVEL_SIZE = 512
+
+
+def _image_bytes(img: Image.Image) -> int:
+    return img.size[0] * img.size[1] * len(img.getbands())
+
+
+def build_levels(img: Image.Image, min_size: int = MIN_LEVEL_SIZE) -> List[Image.Image]:
+    """解码一次原图，生成逐级缩小一半的金字塔：levels[0] 为原图，每一级都从上一级 reduce(2) 得到"""
+    with metrics.stage('icon', 'decode'):
+        img.load()
+    if img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        with metrics.stage('icon', 'convert'):
+            img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+    levels = [img]
+    with metrics.stage('icon', 'resize'):
+        while max(levels[-1].size) // 2 >= min_size:
+            levels.append(levels[-1].reduce(2))
+    return levels
+
+
+def decode_levels(blob: bytes, min_size: int = MIN_LEVEL_SIZE) -> List[Image.Image]:
+    """解码图片并生成金字塔（见 build_levels），在工作进程中执行"""
+    levels = build_levels(Image.open(io.BytesIO(blob)), min_size)
+    metrics.count('flask_utils_operations_total', 1, operation='icon_session')
+    return levels
+
+
+def pick_level(levels: List[Image.Image], scale: float) -> Tuple[Image.Image, float]:
+    """选出缩放 scale 倍时可以使用的最小一级，返回 (该级图片, 相对该级的缩放比例)
+
+    只从不小于目标尺寸的级别缩小，保证结果与从原图缩放的清晰度相同。
+    """
+    width = levels[0].size[0]
+    chosen = levels[0]
+    for level in levels[1:]:
+        if level.size[0] < width * scale:
+            break
+        chosen = level
+    return chosen, scale * width / chosen.size[0]
+
+
+class IconSessionStore:
+    """icon_maker 的上传会话：原图只上传、解码一次，之后的裁剪请求通过会话 ID 引用
+
+    会话 ID 为原图内容的 sha256，重复上传同一张图片会复用已有的会话。
+    保存的是解码后的金字塔，总字节数超过 max_bytes 时按最近最少使用的顺序淘汰。
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def create(self, stream: BinaryIO, pool: Optional[WorkerPool] = None) -> Tuple[str, Tuple[int, int]]:
+        """解码上传的图片（文件对象）并保存金字塔，返回 (会话 ID, 原图尺寸)
+
+        会话 ID 直接对上传的缓冲区计算，已有会话时不读取内容；解码和生成金字塔交给进程池。
+        """
+        from utils.uploads import upload_buffers
+
+        with upload_buffers([stream]) as (buffer,):
+            session_id = hashlib.sha256(buffer).hexdigest()[:32]
+            with self._lock:
+                levels = self._items.get(session_id)
+                if levels is not None:
+                    self._items.move_to_end(session_id)
+                    return session_id, levels[0].size
+            blob = bytes(buffer)
+
+        levels = pool.run(decode_levels, blob) if pool is not None else decode_levels(blob)
+        del blob
+        size = sum(_image_bytes(level) for level in levels)
+        with self._lock:
+            if session_id not in self._items:
+                self._items[session_id] = levels
+                self._size += size
+                while self._size > self.max_bytes and len(self._items) > 1:
+                    _, old_levels = self._items.popitem(last=False)
+                    self._size -= sum(_image_bytes(level) for level in old_levels)
+        return session_id, levels[0].size
+
+    def get(self, session_id: str) -> Optional[List[Image.Image]]:
+        """返回金字塔各级图片（调用方不能修改），不存在或已被淘汰时返回 None"""
+        with self._lock:
+            levels = self._items.get(session_id)
+            if levels is not None:
+                self._items.move_to_end(session_id)
+            return levels
@@ -1,193 +1,200 @@
 from PIL import Image
-import io
-import base64
-from typing import List, Tuple
+import logging
+import math
+import numpy as np
+from typing import Callable, List, Optional, Tuple
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# 缩小倍数超过该值时先用 reduce 做整数倍缩小，再用 LANCZOS 精细缩放
+REDUCING_GAP = 3.0
+
+# (x, y, 宽, 高)
+Box = Tuple[int, int, int, int]
 
 def merge_images(images: List[Image.Image], count: int) -> Image.Image:
     """Merge multiple images based on count."""
-    print(f"\n=== 合并 {count} 张图片 ===")
-    
     if count < 2 or count > 6:
-        print(f"错误：图片数量 {count} 超出范围(2-6)")
+        logger.warning("图片数量 %d 超出范围(2-6)", count)
         return None
     
     # 确保所有图片都是有效的
     for i, img in enumerate(images):
         if not hasattr(img, 'size'):
-            print(f"错误：第 {i+1} 个图片对象无效，缺少 size 属性")
-            print(f"图片对象类型: {type(img)}")
+            logger.warning("第 %d 个图片对象无效，缺少 size 属性: %s", i + 1, type(img))
             return None
-        print(f"图片 {i+1} 大小: {img.size}")
     
     if count == 2:
-        print("使用左右拼接模式")
         return merge_two_images(images)
     elif count == 3:
-        print("使用上下拼接模式")
         return merge_three_images(images)
     elif count == 4:
-        print("使用2×2网格模式")
         return merge_four_images(images)
     else:  # 5 或 6 张图片
-        print("使用2×3网格模式")
         return merge_grid_images(images, 2, 3)
 
-def merge_two_images(images: List[Image.Image]) -> Image.Image:
-    """横向合并两张图片"""
-    print("\n=== 合并两张图片 ===")
-    # 调整到相同高度
-    target_height = max(img.size[1] for img in images)
-    print(f"目标高度: {target_height}")
-    
-    # 计算缩放后的宽度
-    ratios = [target_height / img.size[1] for img in images]
-    new_widths = [int(img.size[0] * ratio) for img, ratio in zip(images, ratios)]
-    print(f"缩放比例: {ratios}")
-    print(f"新宽度: {new_widths}")
-    
-    # 缩放图片
-    resized_images = [img.resize((new_width, target_height), Image.Resampling.LANCZOS)
-                     for img, new_width in zip(images, new_widths)]
-    
-    # 创建新图片
-    new_width = sum(new_widths)
-    return merge_two_images(images)
+def plan_two_images(sizes: List[Tuple[int, int]]) -> Tuple[Tuple[int, int], List[Box]]:
+    """左右拼接布局：所有图片调整到相同高度"""
+    target_height = max(h for w, h in sizes)
+    boxes = []
+    x_offset = 0
+    for w, h in sizes:
+        ratio = target_height / h
+        new_width = max(1, int(w * ratio))
+        boxes.append((x_offset, 0, new_width, target_height))
+        x_offset += new_width
+    return (x_offset, target_height), boxes
+
+def plan_three_images(sizes: List[Tuple[int, int]]) -> Tuple[Tuple[int, int], List[Box]]:
+    """上下拼接布局：所有图片调整到相同宽度"""
+    target_width = max(w for w, h in sizes)
+    boxes = []
+    y_offset = 0
+    for w, h in sizes:
+        ratio = target_width / w
+        new_height = max(1, int(h * ratio))
+        boxes.append((0, y_offset, target_width, new_height))
+        y_offset += new_height
+    return (target_width, y_offset), boxes
+
+def plan_grid_images(sizes: List[Tuple[int, int]], rows: int, cols: int) -> Tuple[Tuple[int, int], List[Box]]:
+    """网格布局：所有图片调整到最大宽高"""
+    max_width = max(w for w, h in sizes)
+    max_height = max(h for w, h in sizes)
+    boxes = []
+    for i in range(min(len(sizes), rows * cols)):
+        row = i // cols
+        col = i % cols
+        boxes.append((col * max_width, row * max_height, max_width, max_height))
+    return (max_width * cols, max_height * rows), boxes
+
+def plan_merge(sizes: List[Tuple[int, int]], count: int,
+               max_pixels: Optional[int] = None) -> Optional[Tuple[Tuple[int, int], List[Box]]]:
+    """只根据图片头信息里的尺寸计算画布大小和每张图片的最终位置、尺寸
+
+    max_pixels 限制输出画布的总像素数，超出时按比例缩小所有图片后重新布局。
+    """
+    if count < 2 or count > 6:
+        logger.warning("图片数量 %d 超出范围(2-6)", count)
+        return None
+
+    if count == 2:
+        planner = plan_two_images
+    elif count == 3:
+        planner = plan_three_images
+    elif count == 4:
+        planner = lambda s: plan_grid_images(s, 2, 2)
+    else:  # 5 或 6 张图片
+        planner = lambda s: plan_grid_images(s, 2, 3)
+
+    canvas_size, boxes = planner(sizes)
+    pixels = canvas_size[0] * canvas_size[1]
+    if max_pixels and pixels > max_pixels:
+        factor = math.sqrt(max_pixels / pixels)
+        sizes = [(max(1, int(w * factor)), max(1, int(h * factor))) for w, h in sizes]
+        canvas_size, boxes = planner(sizes)
+    return canvas_size, boxes
+
+def has_alpha(img: Image.Image) -> bool:
+    """图片是否带透明通道"""
+    return img.mode in ('RGBA', 'LA', 'PA', 'RGBa', 'La') or 'transparency' in img.info
+
+def decode_for_tile(img: Image.Image, tile_size: Tuple[int, int],
+                    operation: str = 'multi_merge') -> Image.Image:
+    """按最终尺寸解码图片
+
+    JPEG 通过 draft 直接以 1/2、1/4、1/8 的比例解码（结果不小于 tile_size），
+    只有带透明通道的图片才转换为 RGBA，其余统一为 RGB。
+    """
+    img.draft(None, tile_size)
+    with metrics.stage(operation, 'decode'):
+        img.load()
+    with metrics.stage(operation, 'convert'):
+        if has_alpha(img):
+            return img if img.mode == 'RGBA' else img.convert('RGBA')
+        if img.mode != 'RGB':
+            return img.convert('RGB')
+    return img
+
+def resize_tile(img: Image.Image, size: Tuple[int, int], operation: str) -> Image.Image:
+    """缩放到格子尺寸，尺寸已经一致时不做任何处理"""
+    if img.size == size:
+        return img
+    with metrics.stage(operation, 'resize'):
+        return img.resize(size, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+
+def compose_images(images: List[Image.Image], canvas_size: Tuple[int, int],
+                   boxes: List[Box], progress: Optional[Callable] = None,
+                   operation: str = 'multi_merge', backend: str = 'pillow') -> Image.Image:
+    """按布局缩放并粘贴图片，没有透明通道时直接使用 RGB 画布
+
+    progress(stage, current, total) 用于汇报 paste 阶段的进度（尺寸不符的图片在粘贴前缩放，不单独汇报）。
+    backend 为 'numpy' 时把所有格子写入同一个预先分配的数组，结果与 'pillow' 完全相同。
+    """
+    if backend == 'numpy':
+        return compose_images_numpy(images, canvas_size, boxes, progress, operation)
+
+    if any(img.mode == 'RGBA' for img in images):
+        merged = Image.new('RGBA', canvas_size, (0, 0, 0, 0))
+    else:
+        merged = Image.new('RGB', canvas_size, (0, 0, 0))
+
+    for i, (img, (x, y, w, h)) in enumerate(zip(images, boxes)):
+        img = resize_tile(img, (w, h), operation)
+        if progress:
+            progress('paste', i + 1, len(boxes))
+        with metrics.stage(operation, 'paste'):
+            merged.paste(img, (x, y))
+    return merged
+
+def compose_images_numpy(images: List[Image.Image], canvas_size: Tuple[int, int],
+                         boxes: List[Box], progress: Optional[Callable] = None,
+                         operation: str = 'multi_merge') -> Image.Image:
+    """compose_images 的 NumPy 实现
+
+    画布是一个预先分配好的 uint8 数组，每个格子缩放后直接写入对应的切片，
+    最后只构造一次 Image。没有透明通道时全程使用 3 通道，不需要再转换成 RGB。
+    """
+    alpha = any(img.mode == 'RGBA' for img in images)
+    mode = 'RGBA' if alpha else 'RGB'
+    canvas = np.zeros((canvas_size[1], canvas_size[0], 4 if alpha else 3), dtype=np.uint8)
+
+    for i, (img, (x, y, w, h)) in enumerate(zip(images, boxes)):
+        img = resize_tile(img, (w, h), operation)
+        if progress:
+            progress('paste', i + 1, len(boxes))
+        with metrics.stage(operation, 'paste'):
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert(mode)
+            target = canvas[y:y + h, x:x + w]
+            if alpha and img.mode == 'RGB':
+                # 与 paste 到 RGBA 画布相同：不透明
+                target[..., :3] = np.asarray(img)
+                target[..., 3] = 255
+            elif not alpha and img.mode == 'RGBA':
+                target[...] = np.asarray(img)[..., :3]
+            else:
+                target[...] = np.asarray(img)
+    return Image.fromarray(canvas, mode)
 
 def merge_two_images(images: List[Image.Image]) -> Image.Image:
     """横向合并两张图片"""
-    print("\n=== 合并两张图片 ===")
-    # 调整到相同高度
-    target_height = max(img.size[1] for img in images)
-    print(f"目标高度: {target_height}")
-    
-    # 计算缩放后的宽度
-    ratios = [target_height / img.size[1] for img in images]
-    new_widths = [int(img.size[0] * ratio) for img, ratio in zip(images, ratios)]
-    print(f"缩放比例: {ratios}")
-    print(f"新宽度: {new_widths}")
-    
-    # 缩放图片
-    resized_images = [img.resize((new_width, target_height), Image.Resampling.LANCZOS)
-                     for img, new_width in zip(images, new_widths)]
-    
-    # 创建新图片
-    new_width = sum(new_widths)
-    print(f"合并后总宽度: {new_width}")
-    merged = Image.new('RGBA', (new_width, target_height), (0, 0, 0, 0))
-    
-    # 粘贴图片
-    x_offset = 0
-    for i, img in enumerate(resized_images):
-        print(f"粘贴第 {i+1} 张图片到位置 x={x_offset}")
-        merged.paste(img, (x_offset, 0))
-        x_offset += img.size[0]
-    
-    return merged
+    canvas_size, boxes = plan_two_images([img.size for img in images])
+    return compose_images(images, canvas_size, boxes)
 
 def merge_three_images(images: List[Image.Image]) -> Image.Image:
     """纵向合并三张图片"""
-    print("\n=== 合并三张图片 ===")
-    # 调整到相同宽度
-    target_width = max(img.size[0] for img in images)
-    print(f"目标宽度: {target_width}")
-    
-    # 计算缩放后的高度
-    ratios = [target_width / img.size[0] for img in images]
-    new_heights = [int(img.size[1] * ratio) for img, ratio in zip(images, ratios)]
-    print(f"缩放比例: {ratios}")
-    print(f"新高度: {new_heights}")
-    
-    # 缩放图片
-    resized_images = [img.resize((target_width, new_height), Image.Resampling.LANCZOS)
-                     for img, new_height in zip(images, new_heights)]
-    
-    # 创建新图片
-    new_height = sum(new_heights)
-    print(f"合并后总高度: {new_height}")
-    merged = Image.new('RGBA', (target_width, new_height), (0, 0, 0, 0))
-    
-    # 粘贴图片
-    y_offset = 0
-    for i, img in enumerate(resized_images):
-        print(f"粘贴第 {i+1} 张图片到位置 y={y_offset}")
-        merged.paste(img, (0, y_offset))
-        y_offset += img.size[1]
-    
-    return merged
+    canvas_size, boxes = plan_three_images([img.size for img in images])
+    return compose_images(images, canvas_size, boxes)
 
 def merge_four_images(images: List[Image.Image]) -> Image.Image:
     """Merge four images in a 2x2 grid."""
     return merge_grid_images(images, 2, 2)
 
-def merge_grid_images(images: List[Image.Image], rows: int, cols: int) -> Image.Image:
+def merge_grid_images(images: List[Image.Image], rows: int, cols: int,
+                      backend: str = 'pillow') -> Image.Image:
     """网格布局合并图片"""
-    print(f"\n=== 网格合并图片 ({rows}×{cols}) ===")
-    
-    # 计算目标尺寸
-    max_width = max(img.size[0] for img in images)
-    max_height = max(img.size[1] for img in images)
-    print(f"单个图片最大尺寸: {max_width}×{max_height}")
-    
-    # 缩放所有图片到相同尺寸
-    resized_images = [img.resize((max_width, max_height), Image.Resampling.LANCZOS)
-                     for img in images]
-    print("已完成图片缩放")
-    
-    # 创建新图片
-    grid_width = max_width * cols
-    grid_height = max_height * rows
-    print(f"最终尺寸: {grid_width}×{grid_height}")
-    merged = Image.new('RGBA', (grid_width, grid_height), (0, 0, 0, 0))
-    
-    # 粘贴图片
-    for i, img in enumerate(resized_images):
-        if i >= rows * cols:
-            break
-        
-        row = i // cols
-        col = i % cols
-        x_offset = col * max_width
-        y_offset = row * max_height
-        print(f"粘贴第 {i+1} 张图片到位置 ({x_offset}, {y_offset})")
-        merged.paste(img, (x_offset, y_offset))
-    
-    return merged
-
-def process_images(files: List[Tuple[str, any]]) -> str:
-    """处理多个图片并返回base64编码的结果"""
-    print("\n=== 进入图片处理函数 ===")
-    print(f"接收到的文件数量: {len(files)}")
-    
-    # 打开图片
-    images = []
-    for filename, file in files:
-        print(f"正在处理文件: {filename}")
-        img = Image.open(file)
-        print(f"图片大小: {img.size}, 模式: {img.mode}")
-        images.append(img.convert('RGBA'))
-    
-    print(f"成功打开 {len(images)} 个图片")
-    print("开始合并图片...")
-    
-    # 合并图片
-    merged_image = merge_images(images, len(images))
-    
-    if merged_image is None:
-        print("错误：图片合并失败")
-        return None
-    
-    print("开始转换为JPEG格式...")
-    # 转换为RGB用于JPEG
-    merged_image = merged_image.convert('RGB')
-    
-    # 保存到字节流
-    print("保存到字节流...")
-    img_bytes = io.BytesIO()
-    merged_image.save(img_bytes, format='JPEG', quality=95)
-    img_bytes.seek(0)
-    
-    # 转换为base64
-    print("转换为base64...")
-    result = base64.b64encode(img_bytes.getvalue()).decode()
-    print("图片处理完成")
-    return result
\ No newline at end of file
+    canvas_size, boxes = plan_grid_images([img.size for img in images], rows, cols)
+    return compose_images(images, canvas_size, boxes, backend=backend)
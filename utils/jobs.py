@@ -0,0 +1,119 @@
+import multiprocessing
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from utils import metrics
+from utils.worker_pool import PoolBusyError
+
+
+class StageReporter:
+    """把任务当前所处的阶段写入共享字典
+
+    可以被 pickle，传给进程池中的工作进程后仍然写回主进程的字典。
+    """
+
+    def __init__(self, stages, job_id: str):
+        self.stages = stages
+        self.job_id = job_id
+
+    def __call__(self, stage: str, current: Optional[int] = None, total: Optional[int] = None):
+        self.stages[self.job_id] = (stage, current, total)
+
+
+class JobManager:
+    """后台任务：提交后立即返回任务 ID，通过 status() 查询进度和结果
+
+    任务在后台线程中执行（线程内再把 CPU 密集的部分交给进程池），
+    排队的任务超过 max_pending 时抛出 PoolBusyError；
+    结束超过 ttl 秒的任务会被清理。
+    """
+
+    def __init__(self, threads: int, max_pending: int, ttl: float, use_processes: bool):
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='job')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._use_processes = use_processes
+        self._stages = None
+
+    def _get_stages(self):
+        """阶段信息的共享字典；任务在其他进程中执行时需要 Manager 代理"""
+        with self._lock:
+            if self._stages is None:
+                if self._use_processes:
+                    self._stages = multiprocessing.Manager().dict()
+                else:
+                    self._stages = {}
+            return self._stages
+
+    def submit(self, fn: Callable, *args) -> str:
+        """提交任务，fn 的最后一个参数会收到一个 StageReporter"""
+        self._cleanup()
+        with self._lock:
+            pending = sum(1 for job in self._jobs.values() if job['state'] in ('queued', 'running'))
+            if pending >= self.max_pending:
+                raise PoolBusyError()
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {'state': 'queued', 'result': None, 'error': None, 'finished_at': None}
+        reporter = StageReporter(self._get_stages(), job_id)
+        self._executor.submit(self._run, job_id, fn, args, reporter)
+        return job_id
+
+    def _run(self, job_id: str, fn: Callable, args: tuple, reporter: StageReporter):
+        self._update(job_id, state='running')
+        try:
+            # 后台线程不继承请求的上下文，单独决定是否采样
+            with metrics.trace():
+                result = fn(*args, reporter)
+            self._update(job_id, state='done', result=result)
+        except Exception as e:
+            self._update(job_id, state='failed', error=str(e) or e.__class__.__name__)
+
+    def _update(self, job_id: str, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.update(fields)
+            if job['state'] in ('done', 'failed'):
+                job['finished_at'] = time.monotonic()
+
+    def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """返回 {state, stage, current, total, result, error}，任务不存在时返回 None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job = dict(job)
+        stages = self._get_stages()
+        stage, current, total = stages.get(job_id, (None, None, None))
+        if job['state'] in ('done', 'failed'):
+            stages.pop(job_id, None)
+        return {
+            'state': job['state'],
+            'stage': stage,
+            'current': current,
+            'total': total,
+            'result': job['result'],
+            'error': job['error'],
+        }
+
+    def _cleanup(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job['finished_at'] is not None and now - job['finished_at'] > self.ttl]
+            for job_id in expired:
+                del self._jobs[job_id]
+            stages = self._stages
+        if stages is not None:
+            for job_id in expired:
+                stages.pop(job_id, None)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
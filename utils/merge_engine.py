@@ -0,0 +1,173 @@
+import contextvars
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from PIL import Image, ImageDraw, ImageFont
+
+from utils import metrics
+from utils.cache import ResultCache, make_cache_key
+from utils.encoders import encode_image
+from utils.image_processor import Box, compose_images, decode_for_tile, plan_merge, resize_tile
+from utils.worker_pool import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+# 双图对比（/merge）勾选「添加文字」时的标签
+BEFORE_AFTER_LABELS = ['修改前', '修改后']
+
+# 并行解码、缩放各张图片的线程数（Pillow 解码和缩放时会释放 GIL）
+DECODE_THREADS = 4
+
+# 标签字体，依次尝试，都找不到时使用 Pillow 自带字体（不支持中文）
+FONT_CANDIDATES = [
+    'msyh.ttc',                                               # Windows 微软雅黑
+    'simhei.ttf',                                             # Windows 黑体
+    '/System/Library/Fonts/PingFang.ttc',                     # macOS
+    '/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc',  # Linux
+    '/usr/share/fonts/truetype/wqy/wqy-microhei.ttc',
+]
+
+# 标签距离格子左上角的距离，以及文字周围的留白
+LABEL_MARGIN = 20
+LABEL_PADDING = 4
+
+
+@lru_cache(maxsize=16)
+def load_font(size: int) -> ImageFont.ImageFont:
+    """按字号加载并缓存字体，同一进程内只加载一次"""
+    for path in FONT_CANDIDATES:
+        try:
+            return ImageFont.truetype(path, size)
+        except OSError:
+            continue
+    return ImageFont.load_default(size)
+
+
+@lru_cache(maxsize=256)
+def render_label(text: str, size: int) -> Image.Image:
+    """渲染一个标签（半透明白底黑字），结果缓存，粘贴时作为蒙版使用
+
+    返回的图片会被多个请求共享，调用方不能修改它。
+    """
+    font = load_font(size)
+    left, top, right, bottom = font.getbbox(text)
+    label = Image.new('RGBA', (right - left + 2 * LABEL_PADDING, bottom - top + 2 * LABEL_PADDING),
+                      (255, 255, 255, 160))
+    draw = ImageDraw.Draw(label)
+    draw.text((LABEL_PADDING - left, LABEL_PADDING - top), text, fill=(0, 0, 0, 255), font=font)
+    return label
+
+
+def label_size(tile_size: Tuple[int, int]) -> int:
+    """标签字号随格子大小变化，取偶数以提高缓存命中率"""
+    return max(14, min(tile_size) // 24 // 2 * 2)
+
+
+def draw_labels(canvas: Image.Image, boxes: List[Box], labels: List[str]):
+    """在每个格子的左上角贴上对应的标签"""
+    for (x, y, w, h), text in zip(boxes, labels):
+        if text:
+            label = render_label(text, label_size((w, h)))
+            canvas.paste(label, (x + min(LABEL_MARGIN, w // 8), y + min(LABEL_MARGIN, h // 8)), label)
+
+
+def index_labels(count: int) -> List[str]:
+    """多图拼接的序号标签"""
+    return [str(i + 1) for i in range(count)]
+
+
+def _load_tile(blob: bytes, size: Tuple[int, int], operation: str) -> Image.Image:
+    img = decode_for_tile(Image.open(io.BytesIO(blob)), size, operation)
+    return resize_tile(img, size, operation)
+
+
+def load_tiles(blobs: List[bytes], boxes: List[Box], operation: str,
+               progress: Optional[Callable] = None) -> List[Image.Image]:
+    """并行解码并缩放各张图片，每张图片按格子尺寸解码（JPEG 使用 draft）"""
+    tiles = [None] * len(blobs)
+    with ThreadPoolExecutor(max_workers=min(DECODE_THREADS, len(blobs))) as executor:
+        # 每个任务复制一份上下文，这样线程内的阶段耗时同样被采样记录
+        futures = {
+            executor.submit(contextvars.copy_context().run, _load_tile, blob, (w, h), operation): i
+            for i, (blob, (x, y, w, h)) in enumerate(zip(blobs, boxes))
+        }
+        for done, future in enumerate(as_completed(futures)):
+            tiles[futures[future]] = future.result()
+            if progress:
+                progress('decode', done + 1, len(blobs))
+    return tiles
+
+
+def merge_blobs(blobs: List[bytes], max_output_pixels: Optional[int] = None,
+                progress: Optional[Callable] = None, backend: str = 'pillow',
+                encoder: Optional[Dict[str, Any]] = None, labels: Optional[List[str]] = None,
+                operation: str = 'multi_merge') -> Optional[bytes]:
+    """合并 2-6 张编码后的图片：读取头信息 → 规划布局 → 并行解码缩放 → 合成 → 标签 → 编码
+
+    progress(stage, current, total) 依次汇报 decode（解码时已经缩放到格子尺寸）/ paste / encode 阶段；
+    backend 见 compose_images，encoder 见 utils.encoders，labels 为每张图片左上角的文字。
+    """
+    # 打开图片（只读取头信息，不解码像素）
+    sizes = []
+    for blob in blobs:
+        with Image.open(io.BytesIO(blob)) as img:
+            sizes.append(img.size)
+    metrics.count('flask_utils_input_pixels_total', sum(w * h for w, h in sizes), operation=operation)
+    metrics.count('flask_utils_operations_total', 1, operation=operation)
+
+    plan = plan_merge(sizes, len(sizes), max_output_pixels)
+    if plan is None:
+        return None
+    canvas_size, boxes = plan
+
+    tiles = load_tiles(blobs, boxes, operation, progress)
+    merged_image = compose_images(tiles, canvas_size, boxes, progress, operation, backend)
+    del tiles
+    if labels:
+        draw_labels(merged_image, boxes, labels)
+
+    if progress:
+        progress('encode')
+    result = encode_image(merged_image, encoder, operation)
+    metrics.count('flask_utils_output_bytes_total', len(result), operation=operation)
+    return result
+
+
+def process_images(files: List[Tuple[str, Any]], max_output_pixels: Optional[int] = None,
+                   cache: Optional[ResultCache] = None, pool: Optional[WorkerPool] = None,
+                   progress: Optional[Callable] = None, backend: str = 'pillow',
+                   encoder: Optional[Dict[str, Any]] = None, labels: Optional[List[str]] = None,
+                   operation: str = 'multi_merge') -> Optional[bytes]:
+    """/merge 和 /multi_merge 共用的入口，返回编码后的字节
+
+    传入 cache 时，相同的输入和参数直接返回缓存结果，不做任何解码和编码；
+    传入 pool 时，整个流程在工作进程中执行。
+    传入 progress 时（后台任务）汇报处理阶段，并且在进程池排队而不是直接报忙。
+    """
+    from utils.uploads import upload_buffers
+
+    # 缓存键直接对上传文件的缓冲区（内存或 mmap）计算，命中缓存时不需要把内容读成 bytes
+    with upload_buffers([file for filename, file in files]) as buffers:
+        cache_key = None
+        if cache is not None:
+            cache_key = make_cache_key(operation, buffers, {
+                'max_output_pixels': max_output_pixels, 'encoder': encoder, 'labels': labels
+            })
+            cached = cache.get(cache_key)
+            if cached is not None:
+                return cached
+        blobs = [bytes(buffer) for buffer in buffers]
+
+    args = (blobs, max_output_pixels, progress, backend, encoder, labels, operation)
+    if pool is not None:
+        result = pool.run(merge_blobs, *args, wait=progress is not None)
+    else:
+        result = merge_blobs(*args)
+    if result is None:
+        logger.warning("图片合并失败: %s", [filename for filename, file in files])
+    elif cache_key is not None:
+        cache.set(cache_key, result)
+    return result
@@ -0,0 +1,173 @@
+import bisect
+import contextvars
+import random
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, Tuple
+
+# 阶段耗时直方图的桶（秒）
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# 各指标的说明，输出到 /metrics 的 HELP 行
+HELP = {
+    'flask_utils_stage_seconds': '各处理阶段（decode、convert、resize、paste、encode、serialize）的耗时',
+    'flask_utils_input_pixels_total': '输入图片的像素总数',
+    'flask_utils_output_bytes_total': '输出结果的字节总数',
+    'flask_utils_operations_total': '被采样的处理次数',
+}
+
+_NULL_STAGE = nullcontext()
+
+_sampled = contextvars.ContextVar('metrics_sampled', default=False)
+_sample_rate = 0.0
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+class Registry:
+    """计数器和直方图，可以导出快照在进程之间合并"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[Tuple[str, LabelKey], float] = {}
+        # (名称, 标签) -> [各桶计数..., 总和, 次数]
+        self.histograms: Dict[Tuple[str, LabelKey], list] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(BUCKETS, value)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0, 0]
+            hist[index] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': {key: list(hist) for key, hist in self.histograms.items()},
+            }
+
+    def merge(self, snapshot: Dict[str, Any]):
+        """合并其他进程（进程池中的工作进程）记录的指标"""
+        with self._lock:
+            for key, value in snapshot['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, other in snapshot['histograms'].items():
+                hist = self.histograms.get(key)
+                if hist is None:
+                    self.histograms[key] = list(other)
+                else:
+                    for i, value in enumerate(other):
+                        hist[i] += value
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render(self) -> str:
+        """Prometheus 文本格式"""
+        snapshot = self.snapshot()
+        lines = []
+        described = set()
+
+        def describe(name: str, kind: str):
+            if name not in described:
+                described.add(name)
+                if name in HELP:
+                    lines.append(f'# HELP {name} {HELP[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in sorted(snapshot['counters'].items()):
+            describe(name, 'counter')
+            lines.append(f'{name}{_format_labels(labels)} {value:g}')
+        for (name, labels), hist in sorted(snapshot['histograms'].items()):
+            describe(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), hist[:len(BUCKETS) + 1]):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", str(bound)),))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {hist[-2]:.6f}')
+            lines.append(f'{name}_count{_format_labels(labels)} {hist[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels: LabelKey) -> str:
+    if not labels:
+        return ''
+    parts = ','.join(f'{k}="{v}"' for k, v in labels)
+    return '{' + parts + '}'
+
+
+REGISTRY = Registry()
+
+
+def configure(sample_rate: float):
+    """设置采样比例：0 表示完全关闭，1 表示记录所有请求"""
+    global _sample_rate
+    _sample_rate = sample_rate
+
+
+def enabled() -> bool:
+    """当前请求/任务是否被采样"""
+    return _sampled.get()
+
+
+def start(sampled: bool = None) -> contextvars.Token:
+    """开始一次请求或任务，按采样比例决定是否记录"""
+    if sampled is None:
+        sampled = _sample_rate > 0 and (_sample_rate >= 1 or random.random() < _sample_rate)
+    return _sampled.set(sampled)
+
+
+def stop(token: contextvars.Token):
+    _sampled.reset(token)
+
+
+@contextmanager
+def trace(sampled: bool = None):
+    token = start(sampled)
+    try:
+        yield
+    finally:
+        stop(token)
+
+
+class _StageTimer:
+    __slots__ = ('operation', 'stage', 'started')
+
+    def __init__(self, operation: str, stage: str):
+        self.operation = operation
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        REGISTRY.observe('flask_utils_stage_seconds', time.perf_counter() - self.started,
+                         operation=self.operation, stage=self.stage)
+        return False
+
+
+def stage(operation: str, name: str):
+    """记录一个阶段的耗时；未被采样时返回空的上下文管理器，几乎没有开销"""
+    if not _sampled.get():
+        return _NULL_STAGE
+    return _StageTimer(operation, name)
+
+
+def count(name: str, value: float, **labels):
+    """累加计数器（未被采样时不记录）"""
+    if _sampled.get():
+        REGISTRY.inc(name, value, **labels)
@@ -0,0 +1,39 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+
+class ResultStore:
+    """按内容哈希保存处理结果（图片、ICO 等），供 /result/<result_id> 下载
+
+    总字节数超过 max_bytes 时按最近最少使用的顺序淘汰。
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def put(self, data: bytes, mimetype: str) -> str:
+        """保存结果并返回其 ID（内容的 sha256），相同内容只保存一份"""
+        result_id = hashlib.sha256(data).hexdigest()[:32]
+        with self._lock:
+            if result_id in self._items:
+                self._items.move_to_end(result_id)
+                return result_id
+            self._items[result_id] = (data, mimetype)
+            self._size += len(data)
+            while self._size > self.max_bytes and len(self._items) > 1:
+                _, (old_data, _) = self._items.popitem(last=False)
+                self._size -= len(old_data)
+        return result_id
+
+    def get(self, result_id: str) -> Optional[Tuple[bytes, str]]:
+        """返回 (数据, mimetype)，不存在或已被淘汰时返回 None"""
+        with self._lock:
+            item = self._items.get(result_id)
+            if item is not None:
+                self._items.move_to_end(result_id)
+            return item
@@ -0,0 +1,198 @@
+import json
+import posixpath
+import threading
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from utils import metrics
+from utils.diff_engine import decode_lines, detect_encoding, diff_opcodes, group_hunks, is_binary
+from utils.validation import ValidationError
+from utils.worker_pool import WorkerPool
+
+# 对比结果中的状态
+ADDED, REMOVED, MODIFIED = 'added', 'removed', 'modified'
+
+# 路径 -> (解压后的大小, CRC32)
+ZipIndex = Dict[str, Tuple[int, int]]
+
+
+def _is_hidden(name: str) -> bool:
+    return name.startswith('__MACOSX/') or posixpath.basename(name).startswith('.')
+
+
+def zip_index(archive: zipfile.ZipFile) -> ZipIndex:
+    """从 ZIP 的中央目录读出每个文件的大小和 CRC32，不解压任何内容"""
+    return {
+        info.filename: (info.file_size, info.CRC)
+        for info in archive.infolist()
+        if not info.is_dir() and not _is_hidden(info.filename)
+    }
+
+
+def compare_indexes(from_index: ZipIndex, to_index: ZipIndex) -> Tuple[List[Dict[str, Any]], int]:
+    """按路径比较两边的索引，返回 (有变化的文件列表, 相同的文件数)
+
+    大小和 CRC32 都相同的文件视为相同，不再解压比较。
+    """
+    changes = []
+    unchanged = 0
+    for path in sorted(from_index.keys() | to_index.keys()):
+        old, new = from_index.get(path), to_index.get(path)
+        if old == new:
+            unchanged += 1
+            continue
+        status = ADDED if old is None else REMOVED if new is None else MODIFIED
+        changes.append({
+            'path': path,
+            'status': status,
+            'from_size': old[0] if old else None,
+            'to_size': new[0] if new else None,
+        })
+    return changes, unchanged
+
+
+def diff_members(old: bytes, new: bytes, context: int = 5) -> Dict[str, Any]:
+    """逐行比较压缩包中的一对文本文件，在工作进程中执行
+
+    只返回编码、增删行数和 hunk（操作列表），查看具体内容时主进程再按这些 hunk 生成 DiffIndex，不必重新比较。
+    """
+    with metrics.stage('tree_diff', 'decode'):
+        encodings = [detect_encoding(old), detect_encoding(new)]
+        old_lines = decode_lines(old, encodings[0])
+        new_lines = decode_lines(new, encodings[1])
+    with metrics.stage('tree_diff', 'diff'):
+        opcodes = diff_opcodes(old_lines, new_lines)
+        hunks = group_hunks(opcodes)
+    metrics.count('flask_utils_operations_total', 1, operation='tree_diff')
+    return {
+        'binary': False,
+        'encodings': encodings,
+        'removed': sum(i2 - i1 for tag, i1, i2, j1, j2 in opcodes if tag != 'equal'),
+        'added': sum(j2 - j1 for tag, i1, i2, j1, j2 in opcodes if tag != 'equal'),
+        'hunks': hunks,
+    }
+
+
+def _read_member(archive: zipfile.ZipFile, path: str) -> bytes:
+    try:
+        return archive.read(path)
+    except KeyError:
+        return b''
+
+
+class TreeCompare:
+    """两个 ZIP 压缩包的目录树对比，接管传入的文件对象（上传的临时文件），close 时关闭
+
+    创建时只读取两边的中央目录，按路径比较大小和 CRC32；
+    有变化的文件在需要时（统计增删行数、查看内容）才解压，逐行比较的结果保存在 results 中。
+    """
+
+    def __init__(self, from_stream: BinaryIO, to_stream: BinaryIO, max_entries: int,
+                 info: Optional[Dict[str, Any]] = None):
+        # 工作进程也会导入本模块，只在主进程中用到的 uploads（依赖 Flask）在这里导入
+        from utils.uploads import stream_size
+
+        self.info = info or {}
+        self.spool_bytes = 0
+        self._files = [from_stream, to_stream]
+        self._archives = []
+        self._lock = threading.Lock()
+        try:
+            for stream in self._files:
+                self.spool_bytes += stream_size(stream)
+                self._archives.append(zipfile.ZipFile(stream))
+        except zipfile.BadZipFile:
+            self.close()
+            raise ValidationError('压缩包已损坏')
+        indexes = [zip_index(archive) for archive in self._archives]
+        if max(len(index) for index in indexes) > max_entries:
+            self.close()
+            raise ValidationError(f'压缩包中最多 {max_entries} 个文件')
+        self.changes, self.unchanged = compare_indexes(*indexes)
+        self.results: Dict[int, Dict[str, Any]] = {}
+        self.diff_ids: Dict[int, str] = {}
+
+    def summary(self) -> Dict[str, Any]:
+        """对比结果的概况，可以直接转换为 JSON"""
+        counts = {status: 0 for status in (ADDED, REMOVED, MODIFIED)}
+        for change in self.changes:
+            counts[change['status']] += 1
+        return dict(self.info, unchanged=self.unchanged, **counts)
+
+    def read(self, n: int) -> Tuple[bytes, bytes]:
+        """解压第 n 个有变化的文件的两个版本，不存在的一边为空；已被淘汰（close）时抛出 ValueError"""
+        path = self.changes[n]['path']
+        with self._lock:
+            return _read_member(self._archives[0], path), _read_member(self._archives[1], path)
+
+    def close(self):
+        with self._lock:
+            for archive in self._archives:
+                archive.close()
+            for stream in self._files:
+                stream.close()
+
+
+def entry_diff(tree: TreeCompare, n: int, pool: Optional[WorkerPool] = None,
+               max_file_bytes: Optional[int] = None, wait: bool = False) -> Dict[str, Any]:
+    """比较第 n 个有变化的文件，结果保存在 tree.results 中，重复调用直接返回
+
+    二进制文件和超过 max_file_bytes 的文件不逐行比较。
+    """
+    result = tree.results.get(n)
+    if result is not None:
+        return result
+    change = tree.changes[n]
+    if max_file_bytes is not None and max(change['from_size'] or 0, change['to_size'] or 0) > max_file_bytes:
+        result = {'binary': False, 'too_large': True}
+    else:
+        old, new = tree.read(n)
+        if is_binary(old) or is_binary(new):
+            result = {'binary': True}
+        elif pool is not None:
+            result = pool.run(diff_members, old, new, wait=wait)
+        else:
+            result = diff_members(old, new)
+    tree.results[n] = result
+    return result
+
+
+def _stats_line(n: int, result: Dict[str, Any]) -> bytes:
+    stats = {'index': n}
+    stats.update((key, value) for key, value in result.items() if key not in ('hunks', 'encodings'))
+    return (json.dumps(stats) + '\n').encode('utf-8')
+
+
+def iter_tree_stats(tree: TreeCompare, pool: Optional[WorkerPool] = None, parallel: int = 1,
+                    max_file_bytes: Optional[int] = None, sampled: bool = False) -> Iterator[bytes]:
+    """逐行比较所有修改过的文件，每完成一个就以 JSON Lines 的形式返回一行增删行数
+
+    同时最多比较 parallel 个文件（交给进程池），哪个先完成先返回。新增和删除的文件不在这里比较。
+    响应发送时请求已经结束，sampled 为请求是否被采样，由调用方在请求内取得。
+    """
+    indexes = [n for n, change in enumerate(tree.changes) if change['status'] == MODIFIED]
+    executor = ThreadPoolExecutor(max_workers=max(1, parallel))
+
+    def process(n):
+        with metrics.trace(sampled):
+            return entry_diff(tree, n, pool, max_file_bytes, wait=True)
+
+    try:
+        pending = {}
+        next_index = 0
+        while pending or next_index < len(indexes):
+            while next_index < len(indexes) and len(pending) < max(1, parallel):
+                pending[executor.submit(process, indexes[next_index])] = indexes[next_index]
+                next_index += 1
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                n = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {'error': str(e) or type(e).__name__}
+                yield _stats_line(n, result)
+    finally:
+        # 客户端中途断开时不再比较剩下的文件
+        executor.shutdown(wait=False, cancel_futures=True)
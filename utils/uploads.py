@@ -0,0 +1,136 @@
+import io
+import mmap
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Any, BinaryIO, Iterator, Optional
+
+from flask import Request, current_app
+
+# 上传的文件在内存中最多保留的字节数，更大的写入磁盘临时文件（Config.UPLOAD_SPOOL_THRESHOLD 未设置时使用）
+SPOOL_THRESHOLD = 1024 * 1024
+
+
+class UploadBudgetError(Exception):
+    """同一路由正在处理的上传数据已经占满内存预算，需要客户端稍后重试"""
+
+
+class SpooledRequest(Request):
+    """上传的文件先放在内存中，超过 UPLOAD_SPOOL_THRESHOLD 时转存到磁盘临时文件（UPLOAD_SPOOL_DIR）
+
+    Werkzeug 默认的阈值固定为 500KB；这里改为可配置，并且文件都是 SpooledTemporaryFile，
+    小文件用 upload_buffer 直接拿到内存缓冲区，大文件用 mmap 映射，都不需要再复制一份。
+    """
+
+    def _get_file_stream(self, total_content_length: Optional[int], content_type: Optional[str],
+                         filename: Optional[str] = None, content_length: Optional[int] = None) -> BinaryIO:
+        threshold = current_app.config.get('UPLOAD_SPOOL_THRESHOLD', SPOOL_THRESHOLD)
+        return tempfile.SpooledTemporaryFile(
+            max_size=threshold, mode='rb+', dir=current_app.config.get('UPLOAD_SPOOL_DIR')
+        )
+
+
+def upload_buffer(file) -> Any:
+    """不经过临时文件，直接拿到上传内容的只读缓冲区
+
+    file 可以是 FileStorage 或文件对象。内存中的文件（BytesIO）直接返回 memoryview，
+    磁盘临时文件用 mmap 映射，都不会额外复制一份数据。
+    """
+    stream = getattr(file, 'stream', file)
+    inner = getattr(stream, '_file', stream)  # SpooledTemporaryFile 内部真正的文件对象
+    if isinstance(inner, io.BytesIO):
+        return inner.getbuffer()
+    try:
+        # 写入的数据可能还在 Python 的缓冲区中，映射之前先写到文件
+        inner.flush()
+        fileno = inner.fileno()
+        if os.fstat(fileno).st_size > 0:
+            return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        pass
+    stream.seek(0)
+    return stream.read()
+
+
+def release_buffer(buffer: Any):
+    """释放 upload_buffer 返回的 mmap / memoryview"""
+    if isinstance(buffer, mmap.mmap):
+        buffer.close()
+    elif isinstance(buffer, memoryview):
+        buffer.release()
+
+
+@contextmanager
+def upload_buffers(files) -> Iterator[list]:
+    """一组文件的只读缓冲区，退出时释放"""
+    buffers = []
+    try:
+        for file in files:
+            buffers.append(upload_buffer(file))
+        yield buffers
+    finally:
+        for buffer in buffers:
+            release_buffer(buffer)
+
+
+def detach_stream(file) -> BinaryIO:
+    """从 FileStorage 中取出上传的文件对象（内存或磁盘临时文件），调用方负责关闭
+
+    请求结束时 Flask 会关闭所有上传的文件；响应是流式的、或者交给后台任务处理时，
+    取出来继续使用，不必先把内容读成 bytes 或者复制到另一个临时文件。
+    """
+    stream = file.stream
+    file.stream = io.BytesIO()
+    stream.seek(0)
+    return stream
+
+
+def stream_size(stream: BinaryIO) -> int:
+    """文件对象的总字节数，读写位置保持不变"""
+    position = stream.tell()
+    size = stream.seek(0, os.SEEK_END)
+    stream.seek(position)
+    return size
+
+
+class MemoryBudget:
+    """一个路由同时处理的上传数据在内存中最多占用的字节数（所有并发请求合计）
+
+    每个请求按它的大小预留，处理完归还；预留不到时抛出 UploadBudgetError（wait=True 时等待）。
+    单个请求超过整个预算时按整个预算预留，否则它永远无法处理。
+    流式响应要到发送完才归还，用 acquire / release 分开调用。
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes: int, wait: bool = False) -> int:
+        """预留 nbytes 字节，返回实际预留的字节数（交给 release 归还）"""
+        nbytes = min(max(nbytes, 0), self.max_bytes)
+        with self._cond:
+            while self._used + nbytes > self.max_bytes:
+                if not wait:
+                    raise UploadBudgetError()
+                self._cond.wait()
+            self._used += nbytes
+        return nbytes
+
+    def release(self, nbytes: int):
+        with self._cond:
+            self._used -= nbytes
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserve(self, nbytes: int, wait: bool = False):
+        nbytes = self.acquire(nbytes, wait)
+        try:
+            yield
+        finally:
+            self.release(nbytes)
+
+    def used(self) -> int:
+        with self._cond:
+            return self._used
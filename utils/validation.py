@@ -0,0 +1,115 @@
+import warnings
+from typing import Dict, List, NamedTuple, Optional
+
+from PIL import Image
+
+try:
+    import magic
+except ImportError:  # 没有安装 python-magic 或系统里找不到 libmagic（常见于 Windows）
+    magic = None
+
+# 嗅探文件类型时读取的字节数
+SNIFF_BYTES = 2048
+
+# libmagic 不可用或识别不出时使用的文件头签名：(偏移, 字节, MIME 类型)
+SIGNATURES = [
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (8, b'WEBP', 'image/webp'),
+    (4, b'ftypavif', 'image/avif'),
+    (4, b'ftypavis', 'image/avif'),
+    (0, b'BM', 'image/bmp'),
+]
+
+# 各路由接受的图片类型
+MERGE_MIMETYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp')
+ICON_MIMETYPES = ('image/jpeg', 'image/png', 'image/webp')
+
+
+class ValidationError(ValueError):
+    """上传的文件不是支持的图片，或者超出像素预算"""
+
+
+class ImageInfo(NamedTuple):
+    """只读取文件头得到的图片信息"""
+    mimetype: str
+    format: str
+    width: int
+    height: int
+    mode: str
+
+    @property
+    def pixels(self) -> int:
+        return self.width * self.height
+
+
+def _match_signature(head: bytes) -> Optional[str]:
+    for offset, signature, mimetype in SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            if mimetype == 'image/webp' and head[:4] != b'RIFF':
+                continue
+            return mimetype
+    return None
+
+
+def sniff_mimetype(head: bytes) -> Optional[str]:
+    """根据文件开头的字节判断类型，优先使用 libmagic"""
+    if magic is not None:
+        mimetype = magic.from_buffer(head, mime=True)
+        if mimetype and mimetype.startswith('image/'):
+            return mimetype
+    # 旧版本 libmagic 不认识 AVIF 等格式，再用内置的签名表确认一次
+    return _match_signature(head)
+
+
+def inspect_image(stream, allowed_mimetypes=MERGE_MIMETYPES) -> ImageInfo:
+    """检查上传文件的类型和尺寸，不解码像素，读完后把 stream 恢复到开头
+
+    类型由文件内容决定而不是文件名；不支持的类型或无法读取文件头时抛出 ValidationError。
+    """
+    head = stream.read(SNIFF_BYTES)
+    stream.seek(0)
+    mimetype = sniff_mimetype(head)
+    if mimetype not in allowed_mimetypes:
+        raise ValidationError('不支持的文件类型' + (f'（{mimetype}）' if mimetype else ''))
+
+    try:
+        with warnings.catch_warnings():
+            # 像素预算由调用方检查，这里不需要 Pillow 的解压炸弹警告
+            warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+            img = Image.open(stream)
+            info = ImageInfo(mimetype, img.format, img.size[0], img.size[1], img.mode)
+    except Image.DecompressionBombError:
+        raise ValidationError('图片尺寸过大')
+    except Exception:
+        raise ValidationError('无法读取图片信息，文件可能已损坏')
+    finally:
+        stream.seek(0)
+    return info
+
+
+def check_images(files: List, budget: Dict[str, int], allowed_mimetypes=MERGE_MIMETYPES) -> List[ImageInfo]:
+    """检查一组上传的图片（FileStorage）：类型、单张像素数（budget['image']）和合计像素数（budget['total']）
+
+    在任何解码之前调用，有问题时抛出 ValidationError，错误信息可以直接显示给用户。
+    """
+    infos = []
+    total = 0
+    for file in files:
+        try:
+            info = inspect_image(file.stream, allowed_mimetypes)
+        except ValidationError as e:
+            raise ValidationError(f'{file.filename}：{e}')
+        if info.pixels > budget['image']:
+            raise ValidationError(
+                f'{file.filename}：图片尺寸过大（{info.width}×{info.height}），'
+                f'单张最多 {budget["image"] / 1e6:g} 百万像素'
+            )
+        total += info.pixels
+        if total > budget['total']:
+            raise ValidationError(f'图片总像素数超出限制（最多 {budget["total"] / 1e6:g} 百万像素）')
+        infos.append(info)
+    return infos
+
@@ -0,0 +1,284 @@
+import io
+import json
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from utils import metrics
+from utils.encoders import encode_image
+from utils.image_processor import Box
+
+# 比较时的分块边长：整行块的字节完全相同时直接跳过，变化区域按块连通后再求精确的边界框
+TILE = 64
+
+# 默认的颜色容差：任一通道差值超过它才算变化，可以忽略 JPEG 压缩带来的细微差别
+THRESHOLD = 16
+
+# 对齐时搜索的最大整体平移（像素）：截图滚动或整体移动不超过这个距离时，先对齐再比较
+MAX_SHIFT = 64
+
+# 统计结果中最多列出的变化区域数
+MAX_REGIONS = 200
+
+# 高亮颜色，以及未变化区域淡化的程度（与白色混合的比例）
+HIGHLIGHT = (255, 0, 0)
+FADE = 0.6
+
+
+def _to_rgb(img: Image.Image) -> np.ndarray:
+    """截图通常已经是 RGB，直接使用解码后的像素；其它模式（包括 RGBA，丢弃透明通道）先转换"""
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return np.asarray(img)
+
+
+def _tile_counts(mask: np.ndarray) -> np.ndarray:
+    """每个 TILE×TILE 块中变化的像素数"""
+    height, width = mask.shape
+    rows, cols = -(-height // TILE), -(-width // TILE)
+    padded = np.zeros((rows * TILE, cols * TILE), dtype=np.uint8)
+    padded[:height, :width] = mask
+    return padded.reshape(rows, TILE, cols, TILE).sum(axis=(1, 3), dtype=np.int64)
+
+
+def diff_mask(before: np.ndarray, after: np.ndarray,
+              threshold: int = THRESHOLD) -> Tuple[np.ndarray, np.ndarray]:
+    """逐像素比较两张相同尺寸的 RGB 图片，返回 (变化像素的布尔掩码, 每块的变化像素数)
+
+    每 TILE 行为一条，先按字节比较整条，完全相同（截图中的大部分区域）直接跳过；
+    有差异的条带再找出字节不同的 TILE 列，只在这些块上逐像素计算各通道的差值，任一通道超过 threshold 即为变化。
+    """
+    height, width = before.shape[:2]
+    cols = -(-width // TILE)
+    mask = np.zeros((height, width), dtype=bool)
+    counts = np.zeros((-(-height // TILE), cols), dtype=np.int64)
+    for row, y in enumerate(range(0, height, TILE)):
+        band = slice(y, min(y + TILE, height))
+        a, b = before[band], after[band]
+        if a.tobytes() == b.tobytes():
+            continue
+        # 先沿行合并再合并通道；any(axis=(0, 2)) 一次归约两个轴要慢一个数量级
+        differs = np.logical_or.reduce(a != b, axis=0).any(axis=1)
+        tiles = np.zeros(cols, dtype=bool)
+        tiles[np.flatnonzero(differs) // TILE] = True
+        for c0, c1 in _runs(tiles):
+            x0, x1 = c0 * TILE, min(c1 * TILE, width)
+            sa, sb = a[:, x0:x1], b[:, x0:x1]
+            # |a - b| 在 uint8 内计算不会溢出；按通道切片取最大值比 max(axis=2) 快得多
+            delta = np.maximum(sa, sb)
+            delta -= np.minimum(sa, sb)
+            changed = np.maximum(np.maximum(delta[..., 0], delta[..., 1]), delta[..., 2]) > threshold
+            mask[band, x0:x1] = changed
+            counts[row, c0:c1] = np.add.reduceat(changed.sum(axis=0), np.arange(0, x1 - x0, TILE))
+    return mask, counts
+
+
+def _runs(flags: np.ndarray) -> List[Tuple[int, int]]:
+    """布尔数组中连续为 True 的区间 [(开始, 结束)]"""
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], flags.view(np.int8), [0]))))
+    return list(zip(edges[::2].tolist(), edges[1::2].tolist()))
+
+
+def find_regions(mask: np.ndarray, tile_counts: np.ndarray) -> List[Tuple[Box, int]]:
+    """把变化像素分组为区域，返回 [((x, y, 宽, 高), 变化像素数)]，按像素数从多到少排列
+
+    tile_counts 为每个 TILE×TILE 块中变化的像素数，相邻（包括对角）的有变化的块属于同一区域，
+    再在每个区域覆盖的块内求出精确到像素的边界框。
+    """
+    rows, cols = tile_counts.shape
+    seen = np.zeros((rows, cols), dtype=bool)
+    regions = []
+    for r, c in zip(*np.nonzero(tile_counts)):
+        start = (int(r), int(c))
+        if seen[start]:
+            continue
+        seen[start] = True
+        queue = deque([start])
+        r0 = r1 = start[0]
+        c0 = c1 = start[1]
+        pixels = 0
+        while queue:
+            r, c = queue.popleft()
+            pixels += int(tile_counts[r, c])
+            r0, r1, c0, c1 = min(r0, r), max(r1, r), min(c0, c), max(c1, c)
+            for nr in range(max(r - 1, 0), min(r + 2, rows)):
+                for nc in range(max(c - 1, 0), min(c + 2, cols)):
+                    if tile_counts[nr, nc] and not seen[nr, nc]:
+                        seen[nr, nc] = True
+                        queue.append((nr, nc))
+        y0, x0 = r0 * TILE, c0 * TILE
+        sub = mask[y0:(r1 + 1) * TILE, x0:(c1 + 1) * TILE]
+        ys = np.flatnonzero(sub.any(axis=1))
+        xs = np.flatnonzero(sub.any(axis=0))
+        box = (x0 + int(xs[0]), y0 + int(ys[0]), int(xs[-1] - xs[0]) + 1, int(ys[-1] - ys[0]) + 1)
+        regions.append((box, pixels))
+    regions.sort(key=lambda item: item[1], reverse=True)
+    return regions
+
+
+def _best_offset(before: np.ndarray, after: np.ndarray, max_shift: int) -> int:
+    """两条一维投影之间的最佳偏移 d（after[i] ≈ before[i - d]），重叠部分不少于一半；相差一样时取 |d| 小的"""
+    best, best_score = 0, None
+    min_overlap = min(len(before), len(after)) // 2
+    for d in sorted(range(-max_shift, max_shift + 1), key=abs):
+        lo, hi = max(0, d), min(len(after), len(before) + d)
+        if hi - lo < max(min_overlap, 1):
+            continue
+        score = np.abs(after[lo:hi] - before[lo - d:hi - d]).mean()
+        if best_score is None or score < best_score:
+            best, best_score = d, score
+    return best
+
+
+def _overlap(before_size: Tuple[int, int], after_size: Tuple[int, int], dx: int, dy: int):
+    """平移 (dx, dy) 后两张图片重叠的部分，返回 (修改前的切片, 修改后的切片)，没有重叠时为 None"""
+    x0, y0 = max(0, dx), max(0, dy)
+    x1, y1 = min(after_size[0], before_size[0] + dx), min(after_size[1], before_size[1] + dy)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return (slice(y0 - dy, y1 - dy), slice(x0 - dx, x1 - dx)), (slice(y0, y1), slice(x0, x1))
+
+
+def _sample_mismatch(before: np.ndarray, after: np.ndarray, dx: int, dy: int, threshold: int) -> float:
+    """平移 (dx, dy) 后，每隔 8 个像素抽样比较重叠部分的绿色通道，返回不同的比例（没有重叠时为 1）"""
+    overlap = _overlap(before.shape[1::-1], after.shape[1::-1], dx, dy)
+    if overlap is None:
+        return 1.0
+    (by, bx), (ay, ax) = overlap
+    a = before[by, bx, 1][::8, ::8].astype(np.int16)
+    b = after[ay, ax, 1][::8, ::8].astype(np.int16)
+    return float((np.abs(a - b) > threshold).mean())
+
+
+def _projections(image: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """每行、每列的平均亮度（只取绿色通道，每隔 4 列 / 4 行抽样）"""
+    green = image[..., 1]
+    rows = green[:, ::4].sum(axis=1, dtype=np.int64) / green[:, ::4].shape[1]
+    cols = green[::4].sum(axis=0, dtype=np.int64) / green[::4].shape[0]
+    return rows, cols
+
+
+def estimate_shift(before: np.ndarray, after: np.ndarray, max_shift: int = MAX_SHIFT,
+                   threshold: int = THRESHOLD) -> Tuple[int, int]:
+    """估计修改后的图片相对修改前的整体平移 (dx, dy)，即 after[y, x] ≈ before[y - dy, x - dx]
+
+    用每行、每列的平均亮度（投影）分别在 ±max_shift 内搜索偏移，截图滚动时行投影整体错开、列投影基本不变。
+    抽样比较确认平移后明显比不平移更吻合（不同的像素少一半以上）才采用，否则返回 (0, 0)；
+    只在一个方向上移动时另一个方向的估计可能有噪声，所以也分别试只取 dx 或只取 dy。
+    """
+    if max_shift <= 0:
+        return 0, 0
+    (rows_before, cols_before), (rows_after, cols_after) = _projections(before), _projections(after)
+    dy = _best_offset(rows_before, rows_after, max_shift)
+    dx = _best_offset(cols_before, cols_after, max_shift)
+    if (dx, dy) == (0, 0):
+        return 0, 0
+    candidates = {(dx, dy), (dx, 0), (0, dy)} - {(0, 0)}
+    mismatch, shift = min((_sample_mismatch(before, after, *shift, threshold), shift) for shift in candidates)
+    if mismatch < _sample_mismatch(before, after, 0, 0, threshold) / 2:
+        return shift
+    return 0, 0
+
+
+def compare_images(before: Image.Image, after: Image.Image, threshold: int = THRESHOLD,
+                   max_shift: int = MAX_SHIFT) -> Tuple[np.ndarray, List[Tuple[Box, int]], Tuple[int, int]]:
+    """先估计整体平移并对齐（见 estimate_shift），再比较两张图片，返回 (画布大小的变化掩码, 变化区域, 平移)"""
+    return compare_arrays(_to_rgb(before), _to_rgb(after), threshold, max_shift)
+
+
+def compare_arrays(a: np.ndarray, b: np.ndarray, threshold: int = THRESHOLD,
+                   max_shift: int = MAX_SHIFT) -> Tuple[np.ndarray, List[Tuple[Box, int]], Tuple[int, int]]:
+    """同 compare_images，输入为 RGB 像素数组
+
+    画布是对齐后两张图片的外接矩形，修改后的图片在画布中的位置为 (max(-dx, 0), max(-dy, 0))；
+    只在一张图片中存在的部分（尺寸不同、滚动后新出现或移出的内容）全部算作变化，两张都没有覆盖的角落不算。
+    """
+    dx, dy = estimate_shift(a, b, max_shift, threshold)
+    if a.shape == b.shape and (dx, dy) == (0, 0):
+        mask, counts = diff_mask(a, b, threshold)
+        return mask, find_regions(mask, counts), (0, 0)
+
+    before_size, after_size = a.shape[1::-1], b.shape[1::-1]
+    # 两张图片在画布中的位置
+    ax, ay = max(-dx, 0), max(-dy, 0)
+    bx, by = ax + dx, ay + dy
+    width = max(ax + after_size[0], bx + before_size[0])
+    height = max(ay + after_size[1], by + before_size[1])
+    mask = np.zeros((height, width), dtype=bool)
+    mask[by:by + before_size[1], bx:bx + before_size[0]] = True
+    mask[ay:ay + after_size[1], ax:ax + after_size[0]] = True
+    overlap = _overlap(before_size, after_size, dx, dy)
+    if overlap is not None:
+        (before_y, before_x), (after_y, after_x) = overlap
+        canvas = (slice(after_y.start + ay, after_y.stop + ay), slice(after_x.start + ax, after_x.stop + ax))
+        mask[canvas] = diff_mask(a[before_y, before_x], b[after_y, after_x], threshold)[0]
+    return mask, find_regions(mask, _tile_counts(mask)), (dx, dy)
+
+
+def render_overlay(after: Image.Image, mask: np.ndarray, regions: List[Tuple[Box, int]],
+                   offset: Tuple[int, int] = (0, 0)) -> Image.Image:
+    """在修改后的图片上标出变化：未变化的部分淡化，变化的像素染成高亮色，每个区域画出边框
+
+    offset 为 compare_images 返回的平移，用来确定修改后的图片在画布中的位置。
+    """
+    height, width = mask.shape
+    base = Image.new('RGB', (width, height), (255, 255, 255))
+    base.paste(after.convert('RGB'), (max(-offset[0], 0), max(-offset[1], 0)))
+    faded = Image.blend(base, Image.new('RGB', base.size, (255, 255, 255)), FADE)
+    tinted = Image.blend(base, Image.new('RGB', base.size, HIGHLIGHT), 0.5)
+    overlay = Image.composite(tinted, faded, Image.fromarray(mask))
+    draw = ImageDraw.Draw(overlay)
+    line = max(2, min(width, height) // 400)
+    for (x, y, w, h), pixels in regions[:MAX_REGIONS]:
+        draw.rectangle((x - line, y - line, x + w - 1 + line, y + h - 1 + line), outline=HIGHLIGHT, width=line)
+    return overlay
+
+
+def change_stats(before_size: Tuple[int, int], after_size: Tuple[int, int], mask: np.ndarray,
+                 regions: List[Tuple[Box, int]], compare_ms: float, offset: Tuple[int, int] = (0, 0)) -> Dict[str, Any]:
+    """变化统计，可以直接转换为 JSON；offset 为对齐时修改后的图片整体平移的 (dx, dy)"""
+    changed = sum(pixels for box, pixels in regions)
+    return {
+        'before_size': list(before_size),
+        'after_size': list(after_size),
+        'offset': list(offset),
+        'identical': changed == 0,
+        'changed_pixels': changed,
+        'changed_ratio': changed / mask.size if mask.size else 0.0,
+        'region_count': len(regions),
+        'regions': [{'box': list(box), 'pixels': pixels} for box, pixels in regions[:MAX_REGIONS]],
+        'compare_ms': round(compare_ms, 1),
+    }
+
+
+def visual_diff(before_blob: bytes, after_blob: bytes, threshold: int = THRESHOLD,
+                encoder: Optional[Dict[str, Any]] = None, max_shift: int = MAX_SHIFT) -> Dict[str, bytes]:
+    """比较修改前后的两张图片，返回 {'overlay': 编码后的高亮图, 'stats': JSON 格式的变化统计}
+
+    返回值只包含 bytes，可以直接放进结果缓存。
+    """
+    with metrics.stage('visual_diff', 'decode'):
+        before = Image.open(io.BytesIO(before_blob))
+        after = Image.open(io.BytesIO(after_blob))
+        before.load()
+        after.load()
+        # 转换成像素数组也算在解码中，比较用时只包括对齐和逐像素比较
+        a, b = _to_rgb(before), _to_rgb(after)
+    metrics.count('flask_utils_input_pixels_total', before.size[0] * before.size[1] + after.size[0] * after.size[1],
+                  operation='visual_diff')
+    metrics.count('flask_utils_operations_total', 1, operation='visual_diff')
+
+    started = time.perf_counter()
+    with metrics.stage('visual_diff', 'compare'):
+        mask, regions, offset = compare_arrays(a, b, threshold, max_shift)
+    compare_ms = (time.perf_counter() - started) * 1000
+
+    with metrics.stage('visual_diff', 'render'):
+        overlay = render_overlay(after, mask, regions, offset)
+    stats = change_stats(before.size, after.size, mask, regions, compare_ms, offset)
+    result = encode_image(overlay, encoder, 'visual_diff')
+    metrics.count('flask_utils_output_bytes_total', len(result), operation='visual_diff')
+    return {'overlay': result, 'stats': json.dumps(stats).encode('utf-8')}
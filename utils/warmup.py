@@ -0,0 +1,51 @@
+import io
+import logging
+import time
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# 预先加载的标签字号（label_size 的最小值，以及常见的格子尺寸对应的字号）
+WARM_FONT_SIZES = (14, 20, 26)
+
+
+def _warm_codecs():
+    """每种格式编码、解码一张很小的图片，加载对应的编解码库
+
+    直接调用 Image.save 而不是 encode_image，避免这次编码的耗时影响编码时间预算的估计。
+    """
+    from PIL import Image, features
+    from utils.encoders import FORMATS
+
+    img = Image.new('RGB', (16, 16), (255, 255, 255))
+    for fmt in FORMATS:
+        if fmt in ('WEBP', 'AVIF') and not features.check(fmt.lower()):
+            continue
+        data = io.BytesIO()
+        img.save(data, format=fmt)
+        data.seek(0)
+        Image.open(data).load()
+    img.save(io.BytesIO(), format='ICO', sizes=[(16, 16)])
+
+
+def warm_up(encoder_profiles: Optional[Dict[str, Dict[str, Any]]] = None):
+    """导入所有 Pillow 插件、加载编解码库和标签字体
+
+    在主进程启动时和每个工作进程启动时各执行一次，第一个请求不再承担这些开销。
+    传入 encoder_profiles 时同时检查各路由的输出编码配置，有误时抛出 ValueError。
+    app.py 启动时不导入图片处理模块，所以这些模块都在函数内导入。
+    """
+    from PIL import Image
+    from utils.encoders import resolve_profile
+    from utils.merge_engine import index_labels, load_font, render_label
+
+    started = time.perf_counter()
+    for profile in (encoder_profiles or {}).values():
+        resolve_profile(profile)
+    Image.init()
+    _warm_codecs()
+    for size in WARM_FONT_SIZES:
+        load_font(size)
+        for text in index_labels(6):
+            render_label(text, size)
+    logger.debug('预热完成，用时 %.3f 秒', time.perf_counter() - started)
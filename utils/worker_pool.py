@@ -0,0 +1,117 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional
+
+from utils import metrics
+
+
+class PoolBusyError(Exception):
+    """运行中和排队中的任务都已满，需要客户端稍后重试"""
+
+
+class JobTimeoutError(Exception):
+    """任务在规定时间内没有完成"""
+
+
+def _call_in_worker(fn: Callable, args: tuple, sampled: bool):
+    """在工作进程中执行任务，并把这次任务记录的指标一起带回主进程"""
+    metrics.REGISTRY.reset()
+    with metrics.trace(sampled):
+        result = fn(*args)
+    return result, metrics.REGISTRY.snapshot()
+
+
+class WorkerPool:
+    """把 Pillow 等 CPU 密集的任务放到进程池中执行，避免阻塞 Flask 的请求线程
+
+    同时运行的任务数为 processes，另外最多 queue_size 个任务排队，
+    再多的任务直接抛出 PoolBusyError。processes 为 0 时在当前线程内执行（调试用）。
+    任务函数和参数需要能被 pickle，所以只能传模块级函数和 bytes 等简单数据。
+    initializer 在每个工作进程启动时执行一次（预先导入插件等）。
+    """
+
+    def __init__(self, processes: int, queue_size: int, timeout: float,
+                 initializer: Optional[Callable] = None):
+        self.processes = processes
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.initializer = initializer
+        self._slots = threading.BoundedSemaphore(max(1, processes) + queue_size)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.processes, initializer=self.initializer)
+            return self._executor
+
+    def start(self):
+        """立即启动所有工作进程，而不是等到第一个任务提交时才启动"""
+        if self.processes <= 0:
+            return
+        executor = self._get_executor()
+        # 没有空闲进程时每提交一个任务就启动一个新进程
+        for future in [executor.submit(int) for _ in range(self.processes)]:
+            future.result()
+
+    def _reset_executor(self, executor: ProcessPoolExecutor):
+        """某个工作进程异常退出后整个进程池不可用，重新创建一个"""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def run(self, fn: Callable, *args, wait: bool = False) -> Any:
+        """提交任务并等待结果
+
+        wait=True 时（后台任务使用）队列满了会一直等到有空位，而不是抛出 PoolBusyError。
+        超时后请求立即返回 JobTimeoutError，但任务在工作进程中会继续跑完，
+        名额直到任务真正结束才释放，这样排队限制始终反映实际负载。
+        """
+        if not self._slots.acquire(blocking=wait):
+            raise PoolBusyError()
+        with self._lock:
+            self._in_flight += 1
+
+        if self.processes <= 0:
+            try:
+                return fn(*args)
+            finally:
+                self._release()
+
+        executor = self._get_executor()
+        try:
+            future = executor.submit(_call_in_worker, fn, args, metrics.enabled())
+        except BrokenProcessPool:
+            self._release()
+            self._reset_executor(executor)
+            raise
+        future.add_done_callback(lambda f: self._release())
+        try:
+            result, snapshot = future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise JobTimeoutError()
+        except BrokenProcessPool:
+            self._reset_executor(executor)
+            raise
+        metrics.REGISTRY.merge(snapshot)
+        return result
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def in_flight(self) -> int:
+        """正在运行和排队中的任务数"""
+        return self._in_flight
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)